@@ -1,8 +1,14 @@
 from pathlib import Path
+import os
 import shutil
 import time
 import tempfile
 from logger import log_warning
+from cas_store import is_cas_manifest, load_cas_manifest, restore_cas_backup
+from archive_backup import is_archive_backup, load_archive_index, restore_archive, restore_archive_members
+from hashing import file_digest
+from scanner import scan_tree
+from journal import apply_journaled
 
 def clear_folder_contents(folder: Path):
     if not folder.exists() or not folder.is_dir():
@@ -22,12 +28,20 @@ def apply_to_original(original : Path, staging : Path):
     if not original.exists() or not staging.exists():
         raise ValueError("Original or Staging folder does not exist.")
     
+    # Staging may be hardlinked to the original (see copy_engine staging
+    # modes). Unlinking the original names is still safe: the staging names
+    # keep those inodes alive and are renamed back in below.
     clear_folder_contents(original)
     
     items = list(staging.iterdir())
     for item in items:
         try:
-            shutil.move(str(item), original / item.name)
+            target = original / item.name
+            # a leftover name pointing at the very same inode would make
+            # shutil.move treat the rename as a no-op, so drop it first
+            if target.is_file() and item.is_file() and os.path.samefile(item, target):
+                target.unlink()
+            shutil.move(str(item), target)
         except Exception as e:
             print(f"Error Occurred: {e}")
             raise
@@ -58,15 +72,198 @@ def apply_to_original(original : Path, staging : Path):
             log_warning(f"Could not delete or move staging folder: {staging}. Error: {e}")    
         
         
-def rollback_from_backup(original: Path, backup: Path):
+def apply_plan(original: Path, plan: dict, journal_path: Path, remove_dirs=()):
+    """Execute an organizer plan in place with same-filesystem renames.
+
+    Every rename goes through a write-ahead journal (see journal.py), so a
+    failed apply can be undone with undo_journal and a crashed one resumed.
+    """
+    if not original.exists() or not original.is_dir():
+        raise ValueError("Original must be a valid directory")
+
+    # every missing level is journaled, parents first, so undo removes
+    # them all in reverse
+    new_dirs = set()
+    for dst in plan.values():
+        rel_dir = os.path.dirname(dst)
+        while rel_dir and rel_dir not in new_dirs and not (original / rel_dir).exists():
+            new_dirs.add(rel_dir)
+            rel_dir = os.path.dirname(rel_dir)
+    operations = []
+    for rel_dir in sorted(new_dirs, key=lambda d: (d.count(os.sep), d)):
+        operations.append({"op": "mkdir", "path": rel_dir})
+    for src, dst in plan.items():
+        operations.append({"op": "rename", "src": src, "dst": dst})
+    # expected deepest first, see organizer.plan_emptied_dirs
+    for rel_dir in remove_dirs:
+        operations.append({"op": "rmdir", "path": rel_dir})
+
+    try:
+        apply_journaled(original, operations, journal_path)
+    except Exception as e:
+        print(f"Error Occurred: {e}")
+        raise
+
+
+def _backup_files(backup: Path) -> dict:
+    """{relative path: (size, mtime_ns, digest or None)} for a backup."""
+    if is_cas_manifest(backup):
+        return {
+            item["path"].replace("/", os.sep): (item["size"], item["mtime_ns"], item["digest"])
+            for item in load_cas_manifest(backup)["files"]
+        }
+    if is_archive_backup(backup):
+        return {
+            item["path"].replace("/", os.sep): (item["size"], item["mtime_ns"], item["digest"])
+            for item in load_archive_index(backup)["files"]
+        }
+    return {e.rel_path: (e.size, e.mtime_ns, None) for e in scan_tree(backup).files()}
+
+
+def _backup_digest(backup: Path, rel_path: str, known: tuple) -> str:
+    return known[2] if known[2] is not None else file_digest(backup / rel_path)
+
+
+def _remove_empty_parents(original: Path, rel_dirs: set, keep: set):
+    # deepest first, stop at the first folder that still has content
+    for rel_dir in sorted(rel_dirs, key=lambda d: d.count(os.sep), reverse=True):
+        while rel_dir and rel_dir not in keep:
+            try:
+                os.rmdir(original / rel_dir)
+            except OSError:
+                break
+            rel_dir = os.path.dirname(rel_dir)
+
+
+def selective_rollback(original: Path, backup: Path, verify_hash: bool = False) -> dict:
+    """Make `original` match `backup` by touching only what differs.
+
+    Files are compared by path, size and mtime (plus content hash when
+    `verify_hash` is set). Files missing from the original are renamed back
+    from an extra file with the same name, size and mtime (or, with
+    `verify_hash`, the same content) when possible, otherwise restored from
+    the backup. Extra files are deleted, and folders emptied by
+    that are removed. Returns counts of each kind of change.
+    """
+    expected = _backup_files(backup)
+    current = {e.rel_path: e for e in scan_tree(original).files()}
+
+    def matches(rel_path, entry, known) -> bool:
+        if entry.size != known[0] or entry.mtime_ns != known[1]:
+            return False
+        if verify_hash:
+            return file_digest(original / rel_path) == _backup_digest(backup, rel_path, known)
+        return True
+
+    to_restore = []
+    for rel_path, known in expected.items():
+        entry = current.get(rel_path)
+        if entry is None or not matches(rel_path, entry, known):
+            to_restore.append(rel_path)
+
+    extras = {}
+    for rel_path, entry in current.items():
+        if rel_path not in expected:
+            extras.setdefault((entry.size, entry.mtime_ns), []).append(rel_path)
+
+    extra_digests = {}
+
+    def extra_digest(candidate):
+        if candidate not in extra_digests:
+            extra_digests[candidate] = file_digest(original / candidate)
+        return extra_digests[candidate]
+
+    def pick(rel_path, known, candidates):
+        # size and mtime alone do not identify a file: without a hash
+        # check, only a moved file that kept its name counts as the same
+        if verify_hash:
+            digest = _backup_digest(backup, rel_path, known)
+            return next((c for c in candidates if extra_digest(c) == digest), None)
+        name = os.path.basename(rel_path)
+        return next((c for c in candidates if os.path.basename(c) == name), None)
+
+    touched_dirs = set()
+    renamed = 0
+    copy_back = []
+    for rel_path in to_restore:
+        known = expected[rel_path]
+        candidates = extras.get((known[0], known[1]))
+        target = original / rel_path
+        candidate = pick(rel_path, known, candidates) if candidates and not os.path.lexists(target) else None
+        if candidate is not None:
+            candidates.remove(candidate)
+            target.parent.mkdir(parents=True, exist_ok=True)
+            os.rename(original / candidate, target)
+            touched_dirs.add(os.path.dirname(candidate))
+            renamed += 1
+            continue
+        copy_back.append(rel_path)
+
+    deleted = 0
+    for candidates in extras.values():
+        for rel_path in candidates:
+            os.unlink(original / rel_path)
+            touched_dirs.add(os.path.dirname(rel_path))
+            deleted += 1
+
+    if is_cas_manifest(backup):
+        restore_cas_backup(backup, original, paths={p.replace(os.sep, "/") for p in copy_back})
+    elif is_archive_backup(backup):
+        restore_archive_members(backup, original, {p.replace(os.sep, "/") for p in copy_back})
+    else:
+        for rel_path in copy_back:
+            target = original / rel_path
+            target.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copy2(backup / rel_path, target)
+
+    keep = {os.path.dirname(p) for p in expected}
+    for rel_path in expected:
+        parent = os.path.dirname(rel_path)
+        while parent:
+            keep.add(parent)
+            parent = os.path.dirname(parent)
+    _remove_empty_parents(original, touched_dirs, keep)
+
+    return {"renamed": renamed, "restored": len(copy_back), "deleted": deleted,
+            "unchanged": len(expected) - len(to_restore)}
+
+
+def rollback_from_backup(original: Path, backup: Path, selective: bool = True,
+                         verify_hash: bool = False):
     if not original.exists() or not original.is_dir():
         raise ValueError("Original must be a valid directory")
     
     if not backup.exists():
         raise FileNotFoundError("Backup does not exists. Cannot roll back.")
     
+    if selective:
+        try:
+            changes = selective_rollback(original, backup, verify_hash=verify_hash)
+            print(f"Rollback changes: {changes}")
+            return
+        except Exception as e:
+            # fall through to the full restore below
+            print(f"Selective rollback failed ({e}), restoring everything")
+            log_warning(f"Selective rollback failed, falling back to full restore: {e}")
+    
     clear_folder_contents(original)
     
+    if is_cas_manifest(backup):
+        try:
+            restore_cas_backup(backup, original)
+        except Exception as e:
+            print(f"Error while restoring from {backup.name}: {e}")
+            raise
+        return
+    
+    if is_archive_backup(backup):
+        try:
+            restore_archive(backup, original)
+        except Exception as e:
+            print(f"Error while restoring from {backup.name}: {e}")
+            raise
+        return
+    
     for item in backup.iterdir():
         try:
             if item.is_file():
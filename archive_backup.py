@@ -0,0 +1,320 @@
+import bisect
+import bz2
+import gzip
+import hashlib
+import json
+import lzma
+import os
+import tarfile
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+import cancel_state
+from cancel_state import CancellationError
+from copy_engine import PROGRESS_TICK
+from hashing import DEFAULT_HASH
+from progress import ProgressTracker
+from scanner import ScanManifest, scan_tree
+
+# A backup archive is a plain tar stream cut into ARCHIVE_BLOCK_SIZE blocks,
+# each compressed on its own. Concatenated gzip/xz/bz2 streams are still a
+# valid .tar.gz/.tar.xz/.tar.bz2, so `tar -x` reads it as usual, while the
+# sidecar <archive>.index.json maps every file to the blocks holding it.
+ARCHIVE_GZIP = "gz"
+ARCHIVE_XZ = "xz"
+ARCHIVE_BZIP2 = "bz2"
+ARCHIVE_COMPRESSIONS = (ARCHIVE_GZIP, ARCHIVE_XZ, ARCHIVE_BZIP2)
+ARCHIVE_FORMAT = "smart-file-manager-archive/1"
+ARCHIVE_BLOCK_SIZE = 4 * 1024 * 1024
+INDEX_SUFFIX = ".index.json"
+_READ_SIZE = 1024 * 1024
+
+_SUFFIXES = {ARCHIVE_GZIP: ".tar.gz", ARCHIVE_XZ: ".tar.xz", ARCHIVE_BZIP2: ".tar.bz2"}
+_OPENERS = {ARCHIVE_GZIP: gzip.open, ARCHIVE_XZ: lzma.open, ARCHIVE_BZIP2: bz2.open}
+
+
+def compress_block(compression: str, data: bytes) -> bytes:
+    if compression == ARCHIVE_GZIP:
+        return gzip.compress(data, compresslevel=6, mtime=0)
+    if compression == ARCHIVE_XZ:
+        return lzma.compress(data, preset=6)
+    return bz2.compress(data, 9)
+
+
+def decompress_block(compression: str, data: bytes) -> bytes:
+    if compression == ARCHIVE_GZIP:
+        return gzip.decompress(data)
+    if compression == ARCHIVE_XZ:
+        return lzma.decompress(data)
+    return bz2.decompress(data)
+
+
+def index_path_of(archive: Path) -> Path:
+    return archive.with_name(archive.name + INDEX_SUFFIX)
+
+
+def is_archive_backup(path: Path) -> bool:
+    return path.is_file() and path.name.endswith(tuple(_SUFFIXES.values())) \
+        and index_path_of(path).is_file()
+
+
+def load_archive_index(archive: Path) -> dict:
+    with open(index_path_of(archive), encoding="utf-8") as f:
+        data = json.load(f)
+    if data.get("format") != ARCHIVE_FORMAT:
+        raise ValueError(f"Not a backup archive index: {archive}")
+    return data
+
+
+def _make_pool(workers: int):
+    # compression is CPU bound; threads still help where processes are not
+    # available, as zlib/lzma/bz2 release the GIL
+    try:
+        return ProcessPoolExecutor(max_workers=workers)
+    except (OSError, NotImplementedError, ImportError):
+        return ThreadPoolExecutor(max_workers=workers)
+
+
+class _BlockWriter:
+    """File object for tarfile that compresses full blocks on a pool and writes them in order."""
+
+    def __init__(self, out, compression: str, pool, workers: int, block_size: int = ARCHIVE_BLOCK_SIZE):
+        self.out = out
+        self.compression = compression
+        self.pool = pool
+        self.block_size = block_size
+        self.max_in_flight = workers * 2
+        self.blocks = []               # [compressed offset, compressed size, raw offset, raw size]
+        self._buffer = bytearray()
+        self._raw_offset = 0           # raw bytes handed to the pool so far
+        self._written = 0
+        self._in_flight = deque()
+
+    def write(self, data) -> int:
+        self._buffer += data
+        while len(self._buffer) >= self.block_size:
+            self._submit(bytes(self._buffer[:self.block_size]))
+            del self._buffer[:self.block_size]
+        return len(data)
+
+    def tell(self) -> int:
+        return self._raw_offset + len(self._buffer)
+
+    def _submit(self, block: bytes):
+        while len(self._in_flight) >= self.max_in_flight:
+            self._collect()
+        self._in_flight.append((self._raw_offset, len(block),
+                                self.pool.submit(compress_block, self.compression, block)))
+        self._raw_offset += len(block)
+
+    def _collect(self):
+        raw_offset, raw_size, future = self._in_flight.popleft()
+        compressed = future.result()
+        self.out.write(compressed)
+        self.blocks.append([self._written, len(compressed), raw_offset, raw_size])
+        self._written += len(compressed)
+
+    def finish(self):
+        if self._buffer:
+            self._submit(bytes(self._buffer))
+            self._buffer.clear()
+        while self._in_flight:
+            self._collect()
+
+
+class _HashingReader:
+    """Feeds tarfile from a source file while hashing and counting what it reads."""
+
+    def __init__(self, f, digest, on_bytes):
+        self.f = f
+        self.digest = digest
+        self.on_bytes = on_bytes
+
+    def read(self, size=-1) -> bytes:
+        if cancel_state.cancel_requested:
+            raise CancellationError("Backup Cancel", "Backup cancelled by user")
+        data = self.f.read(size)
+        self.digest.update(data)
+        self.on_bytes(len(data))
+        return data
+
+
+def create_archive_backup(source_f: Path,
+                          backup_root: Path,
+                          total_files: int,
+                          progress_cb = None,
+                          manifest: ScanManifest = None,
+                          workers: int = None,
+                          compression: str = ARCHIVE_GZIP,
+                          block_size: int = ARCHIVE_BLOCK_SIZE) -> Path:
+    """Stream `source_f` into `<name>_backup_<ts>.tar.<ext>` with its block index.
+
+    Files are read once, in manifest order; their sha256 is taken from the
+    same reads and stored in the index. Returns the archive path. A
+    cancelled or failed run leaves nothing behind.
+    """
+    if not source_f.exists() or not source_f.is_dir():
+        raise ValueError("Source folder is not valid.")
+    if compression not in ARCHIVE_COMPRESSIONS:
+        raise ValueError(f"Unknown archive compression: {compression}")
+    if manifest is None:
+        manifest = scan_tree(source_f)
+
+    backup_root.mkdir(parents=True, exist_ok=True)
+    timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    suffix = _SUFFIXES[compression]
+    archive = backup_root / f"{source_f.name}_backup_{timestamp}{suffix}"
+    counter = 1
+    while archive.exists():
+        archive = backup_root / f"{source_f.name}_backup_{timestamp}({counter}){suffix}"
+        counter += 1
+
+    workers = workers or os.cpu_count() or 1
+    tracker = ProgressTracker(manifest.total_bytes)
+    files = []
+    processed = 0
+    last_report = 0.0
+
+    def on_bytes(n):
+        nonlocal last_report
+        tracker.add(n)
+        now = time.monotonic()
+        if progress_cb and now - last_report >= PROGRESS_TICK:
+            last_report = now
+            progress_cb(processed, total_files, "Backup", tracker.snapshot())
+
+    try:
+        with open(archive, "wb") as out, _make_pool(workers) as pool:
+            writer = _BlockWriter(out, compression, pool, workers, block_size)
+            with tarfile.open(fileobj=writer, mode="w", format=tarfile.PAX_FORMAT) as tar:
+                tar.copybufsize = _READ_SIZE
+                for entry in manifest.entries:
+                    if cancel_state.cancel_requested:
+                        raise CancellationError("Backup Cancel", "Backup cancelled by user")
+                    src = source_f / entry.rel_path
+                    arcname = entry.rel_path.replace(os.sep, "/")
+                    if entry.is_dir:
+                        tar.add(src, arcname=arcname, recursive=False)
+                        continue
+
+                    info = tar.gettarinfo(src, arcname=arcname)
+                    digest = hashlib.new(DEFAULT_HASH)
+                    with open(src, "rb") as f:
+                        tar.addfile(info, _HashingReader(f, digest, on_bytes))
+                    # data starts right after the header(s) tarfile just wrote
+                    data_offset = tar.offset - -(-info.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+                    files.append({
+                        "path": arcname,
+                        "size": info.size,
+                        "mtime_ns": entry.mtime_ns,
+                        "offset": data_offset,
+                        "digest": digest.hexdigest(),
+                    })
+                    # tarfile keeps every member otherwise
+                    tar.members.clear()
+                    processed += 1
+                    if progress_cb:
+                        progress_cb(processed, total_files, "Backup", tracker.snapshot())
+            writer.finish()
+            out.flush()
+            os.fsync(out.fileno())
+
+        index = {
+            "format": ARCHIVE_FORMAT,
+            "source": str(source_f),
+            "created": timestamp,
+            "compression": compression,
+            "algorithm": DEFAULT_HASH,
+            "block_size": block_size,
+            "blocks": writer.blocks,
+            "files": files,
+        }
+        index_tmp = archive.with_name(archive.name + INDEX_SUFFIX + ".tmp")
+        with open(index_tmp, "w", encoding="utf-8") as f:
+            json.dump(index, f, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(index_tmp, index_path_of(archive))
+    except BaseException:
+        for leftover in (archive, archive.with_name(archive.name + INDEX_SUFFIX + ".tmp")):
+            try:
+                leftover.unlink()
+            except FileNotFoundError:
+                pass
+        raise
+    return archive
+
+
+class ArchiveReader:
+    """Random access to single files of an archive through its block index."""
+
+    def __init__(self, archive: Path):
+        self.archive = archive
+        self.index = load_archive_index(archive)
+        self.compression = self.index["compression"]
+        self.blocks = self.index["blocks"]
+        self._raw_starts = [block[2] for block in self.blocks]
+        self._cached = (None, None)
+        self._f = open(archive, "rb")
+
+    def _block(self, number: int) -> bytes:
+        if self._cached[0] != number:
+            offset, size, _, _ = self.blocks[number]
+            self._f.seek(offset)
+            self._cached = (number, decompress_block(self.compression, self._f.read(size)))
+        return self._cached[1]
+
+    def iter_bytes(self, offset: int, size: int):
+        """Yield the raw tar bytes [offset, offset + size), decompressing only the blocks they span."""
+        end = offset + size
+        number = bisect.bisect_right(self._raw_starts, offset) - 1
+        while offset < end:
+            data = self._block(number)
+            start = self.blocks[number][2]
+            piece = data[offset - start:min(end - start, len(data))]
+            yield piece
+            offset += len(piece)
+            number += 1
+
+    def extract(self, item: dict, dest: Path):
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        with open(dest, "wb") as f:
+            for piece in self.iter_bytes(item["offset"], item["size"]):
+                f.write(piece)
+        os.utime(dest, ns=(item["mtime_ns"], item["mtime_ns"]))
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def restore_archive_members(archive: Path, target: Path, paths):
+    """Restore only `paths` ("/" separated, as in the index) from `archive`."""
+    wanted = set(paths)
+    with ArchiveReader(archive) as reader:
+        for item in reader.index["files"]:
+            if item["path"] in wanted:
+                reader.extract(item, target / Path(*item["path"].split("/")))
+
+
+def restore_archive(archive: Path, target: Path):
+    """Unpack the whole archive under `target` in one sequential streaming pass."""
+    index = load_archive_index(archive)
+    mtimes = {item["path"]: item["mtime_ns"] for item in index["files"]}
+    opener = _OPENERS[index["compression"]]
+    with opener(archive, "rb") as stream, tarfile.open(fileobj=stream, mode="r|") as tar:
+        if hasattr(tarfile, "data_filter"):
+            tar.extraction_filter = tarfile.data_filter
+        for member in tar:
+            tar.extract(member, target)
+            if member.name in mtimes:
+                # tar keeps mtime in seconds; the index has the exact value
+                mtime_ns = mtimes[member.name]
+                os.utime(target / Path(*member.name.split("/")), ns=(mtime_ns, mtime_ns))
@@ -1,70 +1,241 @@
 from pathlib import Path
+import os
+import re
 import shutil
 from datetime import datetime
-from cancel_state import cancel_requested
+from functools import partial
+from cancel_state import CancellationError
+from scanner import ScanManifest, scan_tree
+from cas_store import create_cas_backup
+from archive_backup import create_archive_backup, ARCHIVE_GZIP
+from hashing import DEFAULT_HASH
+from verify import write_checksums, load_checksums
+from checkpoint import (BackupCheckpoint, checkpoint_path_for, find_partial_backup, is_partial_backup,
+                        load_checkpoint)
+from copy_engine import (copy_manifest, copy_file, make_staging_copy_fn, make_link_dest_copy_fn, same_device,
+                         STAGING_AUTO, STAGING_COPY, COMPARE_MTIME, COMPARE_HASH)
 
-class CancellationError(Exception):
-    def __init__(self, phase: str, message:str = "Operation Cancelled"):
-        super().__init__(message)
-        self.phase = phase   # e.g., "backup" or "staging"
-        
-def count_files(source_f: Path) -> int:
+BACKUP_FULL = "full"
+BACKUP_INCREMENTAL = "incremental"
+BACKUP_CAS = "cas"              # content-addressed store, see cas_store.py
+BACKUP_ARCHIVE = "archive"      # one block-compressed tar, see archive_backup.py
+BACKUP_MODES = (BACKUP_FULL, BACKUP_INCREMENTAL, BACKUP_CAS, BACKUP_ARCHIVE)
+
+
+def count_files(source_f: Path, manifest: ScanManifest = None) -> int:
+    if manifest is not None:
+        return manifest.file_count
     if not source_f.exists() or not source_f.is_dir():
         return 0
-    return sum(1 for item in source_f.rglob("*") if item.is_file())
+    return scan_tree(source_f).file_count
+
+
+def find_previous_backup(source_f: Path, backup_root: Path):
+    """Most recent complete `<name>_backup_<timestamp>[(n)]` folder for this source, or None."""
+    if not backup_root.exists():
+        return None
+    pattern = re.compile(
+        re.escape(source_f.name)
+        + r"_backup_(\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2})(?:\((\d+)\))?$"
+    )
+    latest = None
+    latest_key = None
+    with os.scandir(backup_root) as it:
+        for item in it:
+            match = pattern.match(item.name)
+            if not match or not item.is_dir(follow_symlinks=False) or is_partial_backup(Path(item.path)):
+                continue
+            key = (match.group(1), int(match.group(2) or 0))
+            if latest_key is None or key > latest_key:
+                latest, latest_key = Path(item.path), key
+    return latest
 
 
 def create_backup(
     source_f: Path,
     backup_root: Path,
     total_files: int,
-    progress_cb = None
+    progress_cb = None,
+    manifest: ScanManifest = None,
+    workers: int = None,
+    mode: str = BACKUP_FULL,
+    compare: str = COMPARE_MTIME,
+    index = None,
+    compression: str = ARCHIVE_GZIP,
+    checksums: bool = True
     ) -> Path:
     
     if not source_f.exists() or not source_f.is_dir():
         raise ValueError("Source folder is not valid.")
 
+    if mode not in BACKUP_MODES:
+        raise ValueError(f"Unknown backup mode: {mode}")
+    if mode == BACKUP_CAS:
+        # returns the manifest file; a cancelled run only leaves objects
+        # behind, which later runs reuse
+        try:
+            return create_cas_backup(source_f, backup_root, total_files,
+                                     progress_cb=progress_cb,
+                                     manifest=manifest,
+                                     workers=workers,
+                                     index=index)
+        except CancellationError:
+            raise
+        except Exception as e:
+            print(f"Backup failed: {e}")
+            raise
+    if mode == BACKUP_ARCHIVE:
+        # returns the archive file; a cancelled run removes it
+        try:
+            return create_archive_backup(source_f, backup_root, total_files,
+                                         progress_cb=progress_cb,
+                                         manifest=manifest,
+                                         workers=workers,
+                                         compression=compression)
+        except CancellationError:
+            raise
+        except Exception as e:
+            print(f"Backup failed: {e}")
+            raise
+
     backup_root.mkdir(parents=True, exist_ok=True)
     
+    # look this up before the new folder exists so it cannot pick itself
+    previous_backup = None
+    if mode == BACKUP_INCREMENTAL:
+        previous_backup = find_previous_backup(source_f, backup_root)
+    
+    if manifest is None:
+        manifest = scan_tree(source_f)
+    
+    # hashed from the copy buffers themselves, see copy_engine.copy_file_hashed
+    algorithm = DEFAULT_HASH if checksums else None
+    digests = {} if checksums else None
+    
+    # a cancelled or crashed run of this source left a partial folder: keep
+    # what its checkpoint vouches for and copy only the rest
+    source_key = str(source_f.resolve())
+    backup_folder = find_partial_backup(source_f, backup_root, mode, algorithm)
+    resumed = backup_folder is not None
+    if resumed:
+        manifest_to_copy = resume_partial_backup(backup_folder, manifest, digests)
+        print(f"Resuming backup {backup_folder}: {manifest.file_count - manifest_to_copy.file_count} "
+              f"of {manifest.file_count} files already copied")
+    else:
+        backup_folder = new_backup_folder(source_f, backup_root)
+        backup_folder.mkdir()
+        manifest_to_copy = manifest
+    checkpoint = BackupCheckpoint(backup_folder, {"source": source_key, "mode": mode, "algorithm": algorithm})
+    
+    copy_fn = copy_file
+    if algorithm is not None:
+        copy_fn = partial(copy_file, algorithm=algorithm)
+    if previous_backup is not None:
+        print(f"Incremental backup against {previous_backup}")
+        previous_checksums = load_checksums(previous_backup) if checksums or compare == COMPARE_HASH else None
+        copy_fn = make_link_dest_copy_fn(manifest, backup_folder, previous_backup, compare, index,
+                                         algorithm, previous_checksums)
+    
+    entries = {entry.rel_path: entry for entry in manifest.files()}
+    prefix_len = len(os.path.join(str(backup_folder), ""))
+    
+    def checkpointed_copy(src, dst, bytes_cb = None, size = None):
+        digest = copy_fn(src, dst, bytes_cb, size)
+        entry = entries[str(dst)[prefix_len:]]
+        checkpoint.record(entry.rel_path.replace(os.sep, "/"), entry.size, entry.mtime_ns, digest)
+        return digest
+    
+    try:
+        copy_manifest(manifest_to_copy,
+                      backup_folder,
+                      manifest_to_copy.file_count if resumed else total_files,
+                      "Backup",
+                      "Backup Cancel",
+                      "Backup cancelled by user",
+                      progress_cb=progress_cb,
+                      workers=workers,
+                      copy_fn=checkpointed_copy,
+                      checksums=digests)
+    except BaseException as e:
+        # keep the partial folder; the next run resumes from the checkpoint
+        checkpoint.close()
+        if not isinstance(e, CancellationError):
+            print(f"Backup failed: {e}")
+        raise
+    
+    if resumed:
+        # a resumed backup is as new as the run that completed it
+        final_folder = new_backup_folder(source_f, backup_root)
+        os.replace(backup_folder, final_folder)
+        os.replace(checkpoint_path_for(backup_folder), checkpoint_path_for(final_folder))
+        checkpoint.path = checkpoint_path_for(final_folder)
+        backup_folder = final_folder
+    if digests is not None:
+        write_checksums(backup_folder, digests)
+    checkpoint.finish()
+
+    return backup_folder
+
+
+def new_backup_folder(source_f: Path, backup_root: Path) -> Path:
     timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
     backup_folder = backup_root / f"{source_f.name}_backup_{timestamp}"
     
     # checks whether that backup folder already exist or not
     counter = 1
-    while backup_folder.exists():
+    while backup_folder.exists() or checkpoint_path_for(backup_folder).exists():
         backup_folder = backup_root / f"{source_f.name}_backup_{timestamp}({counter})"
         counter += 1
-        
-    processed = 0
-        
-    try:
-        for item in source_f.rglob("*"):
-            if cancel_requested:
-                raise CancellationError("Backup Cancel", "Backup cancelled by user")
-            
-            if item.name in ["desktop.ini", "Thumbs.db"]:
-                continue
-            if item.is_file():
-                relative_path = item.relative_to(source_f)
-                dest_path = backup_folder / relative_path
-                dest_path.parent.mkdir(parents=True, exist_ok=True)
-                shutil.copy2(item, dest_path)
-                
-                processed += 1
-                if progress_cb:
-                    progress_cb(processed, total_files, "Backup")
-                    
-    except Exception as e:
-        print(f"Backup failed: {e}")
-        raise
-
     return backup_folder
+
+
+def resume_partial_backup(backup_folder: Path, manifest: ScanManifest, digests: dict = None) -> ScanManifest:
+    """Drop what a partial backup cannot vouch for; returns the part of `manifest` still to copy.
+
+    A checkpointed file is kept while the source file still has the size
+    and mtime it was copied with and the copy is still whole. Everything
+    else in the folder (torn copies, files since removed from the source)
+    is deleted.
+    """
+    _, records = load_checkpoint(backup_folder)
+    entries = {entry.rel_path: entry for entry in manifest.files()}
+    done = set()
+    for rel_path, record in records.items():
+        entry = entries.get(rel_path)
+        if entry is None or entry.size != record["size"] or entry.mtime_ns != record["mtime_ns"]:
+            continue
+        if digests is not None and not record.get("digest"):
+            continue
+        try:
+            if os.stat(backup_folder / rel_path).st_size != entry.size:
+                continue
+        except OSError:
+            continue
+        done.add(rel_path)
+        if digests is not None:
+            digests[rel_path] = record["digest"]
+    
+    wanted_dirs = {entry.rel_path for entry in manifest.dirs()}
+    for item in sorted(scan_tree(backup_folder).entries, key=lambda e: e.depth, reverse=True):
+        path = backup_folder / item.rel_path
+        try:
+            if item.is_file and item.rel_path not in done:
+                os.remove(path)
+            elif item.is_dir and item.rel_path not in wanted_dirs:
+                os.rmdir(path)
+        except OSError:
+            pass
+    return ScanManifest(manifest.root, [entry for entry in manifest.entries
+                                        if entry.is_dir or entry.rel_path not in done])
         
         
 def create_staging_copy(source_f: Path,
                         staging_root: Path,
                         total_files: int,
-                        progress_cb =None ) -> Path:
+                        progress_cb =None,
+                        manifest: ScanManifest = None,
+                        workers: int = None,
+                        mode: str = STAGING_AUTO) -> Path:
     
     if not source_f.exists() or not source_f.is_dir():
         raise ValueError("Source folder is not valid.")
@@ -77,25 +248,27 @@ def create_staging_copy(source_f: Path,
 
     staging_folder.mkdir(parents=True, exist_ok=True)
     
-    processed = 0
+    if manifest is None:
+        manifest = scan_tree(source_f)
+    
+    # links only make sense inside one filesystem
+    if mode != STAGING_COPY and not same_device(source_f, staging_folder):
+        print("Staging is on a different device, falling back to a full copy")
+        mode = STAGING_COPY
     
     try:
-        for item in source_f.rglob("*"):
-            if cancel_requested:
-                raise CancellationError("Staging Cancel","Cancellation requested during staging")
-            
-            if item.name in ["desktop.ini", "Thumbs.db"]:
-                continue
-            if item.is_file():
-                relative_path = item.relative_to(source_f)
-                dest_path = staging_folder / relative_path
-                dest_path.parent.mkdir(parents=True, exist_ok=True)
-                shutil.copy2(item, dest_path)
-                
-                processed += 1
-                if progress_cb:
-                    progress_cb(processed, total_files, "Staging")
-            
+        copy_manifest(manifest,
+                      staging_folder,
+                      total_files,
+                      "Staging",
+                      "Staging Cancel",
+                      "Cancellation requested during staging",
+                      progress_cb=progress_cb,
+                      workers=workers,
+                      copy_fn=make_staging_copy_fn(mode))
+    except CancellationError:
+        delete_folder(staging_folder)
+        raise
     except Exception as e:
         print(f"Creation of staging folder failed: {e}")
         raise
@@ -115,19 +288,32 @@ def delete_folder(folder : Path):
 def prepare_backup_staging(source_path :str,
                            backup_path : str,
                            staging_path :str,
-                           progress_cb = None) -> dict:
+                           progress_cb = None,
+                           workers: int = None,
+                           staging_mode: str = STAGING_AUTO,
+                           backup_mode: str = BACKUP_FULL,
+                           backup_compare: str = COMPARE_MTIME,
+                           index = None,
+                           archive_compression: str = ARCHIVE_GZIP,
+                           backup_checksums: bool = True,
+                           manifest: ScanManifest = None) -> dict:
     
     source = Path(source_path)
     backup_root = Path(backup_path)
-    staging_root = Path(staging_path)
+    # no staging path means the caller organizes in place from a plan
+    staging_root = Path(staging_path) if staging_path is not None else None
     
     if not source.exists() or not source.is_dir():
         raise ValueError("Source folder is not valid.")
     
     backup_root.mkdir(parents=True, exist_ok=True)
-    staging_root.mkdir(parents=True, exist_ok=True)
+    if staging_root is not None:
+        staging_root.mkdir(parents=True, exist_ok=True)
     
-    source_file_count = count_files(source)
+    # one walk of the source; every later phase reuses this manifest
+    if manifest is None:
+        manifest = scan_tree(source)
+    source_file_count = count_files(source, manifest)
     
     if source_file_count == 0:
         return {
@@ -141,31 +327,47 @@ def prepare_backup_staging(source_path :str,
         backup_folder = create_backup(source,
                                       backup_root,
                                       source_file_count,
-                                      progress_cb=progress_cb)
+                                      progress_cb=progress_cb,
+                                      manifest=manifest,
+                                      workers=workers,
+                                      mode=backup_mode,
+                                      compare=backup_compare,
+                                      index=index,
+                                      compression=archive_compression,
+                                      checksums=backup_checksums)
     except CancellationError:
-        if backup_folder and backup_folder.exists():
-            delete_folder(backup_folder)
-            return{
-                "status" : "CANCELLED",
-                "source_files" : source_file_count
-                }
+        # create_backup kept the partial folder and its checkpoint for the next run
+        return{
+            "status" : "CANCELLED",
+            "source_files" : source_file_count
+            }
     except Exception as e:
         print(f"Error occurred while taking backup: {e}")
         raise
         
+    if staging_root is None:
+        return {
+            "status": "READY",
+            "source_files": source_file_count,
+            "backup_folder": backup_folder,
+            "staging_folder": None,
+            "manifest": manifest
+        }
+        
     try:
         staging_folder = create_staging_copy(source,
                                              staging_root,
                                              source_file_count,
-                                             progress_cb=progress_cb)
+                                             progress_cb=progress_cb,
+                                             manifest=manifest,
+                                             workers=workers,
+                                             mode=staging_mode)
     except CancellationError:
-        if staging_folder and staging_folder.exists():
-            delete_folder(staging_folder)
-            return {
-                "status": "CANCELLED",
-                "source_files": source_file_count,
-                "backup_folder": backup_folder
-            }
+        return {
+            "status": "CANCELLED",
+            "source_files": source_file_count,
+            "backup_folder": backup_folder
+        }
     except Exception as e:
         print(f"Error Occurred while staging: {e}")
         raise
@@ -175,7 +377,8 @@ def prepare_backup_staging(source_path :str,
         "status": "READY",
         "source_files": source_file_count,
         "backup_folder": backup_folder,
-        "staging_folder": staging_folder
+        "staging_folder": staging_folder,
+        "manifest": manifest
     }
     
     
@@ -1,5 +1,12 @@
 cancel_requested = False
 
+
+class CancellationError(Exception):
+    def __init__(self, phase: str, message:str = "Operation Cancelled"):
+        super().__init__(message)
+        self.phase = phase   # e.g., "backup" or "staging"
+
+
 def request_cancel():
     global cancel_requested
     cancel_requested = True
@@ -7,4 +14,4 @@ def request_cancel():
     
 def reset_cancel():
     global cancel_requested
-    cancel_requested = False
\ No newline at end of file
+    cancel_requested = False
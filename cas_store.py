@@ -0,0 +1,215 @@
+import json
+import os
+import re
+import shutil
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+from copy_engine import run_file_tasks, copy_file
+from progress import ProgressTracker
+from hashing import DEFAULT_HASH
+from scanner import ScanManifest, scan_tree
+
+# Layout under the backup root:
+#   cas_store/objects/ab/cdef...      one file per distinct content
+#   cas_store/manifests/<name>_backup_<ts>.json
+#   cas_store/tmp/                    in-progress object writes
+CAS_DIR_NAME = "cas_store"
+CAS_FORMAT = "smart-file-manager-cas/1"
+# A running backup keeps a marker in tmp/; markers older than this are
+# leftovers of a crashed run
+RUN_MARKER_SUFFIX = ".running"
+RUN_MARKER_MAX_AGE = 24 * 60 * 60
+
+
+def store_paths(backup_root: Path) -> tuple:
+    store = backup_root / CAS_DIR_NAME
+    return store / "objects", store / "manifests", store / "tmp"
+
+
+def active_cas_runs(backup_root: Path) -> int:
+    """Number of backups into the store that are running right now, in any process."""
+    _, _, tmp_dir = store_paths(backup_root)
+    if not tmp_dir.is_dir():
+        return 0
+    cutoff = time.time() - RUN_MARKER_MAX_AGE
+    count = 0
+    for item in tmp_dir.glob(f"*{RUN_MARKER_SUFFIX}"):
+        try:
+            if item.stat().st_mtime > cutoff:
+                count += 1
+        except OSError:
+            pass
+    return count
+
+
+def object_path(objects_dir: Path, digest: str) -> Path:
+    return objects_dir / digest[:2] / digest[2:]
+
+
+def is_cas_manifest(path: Path) -> bool:
+    return path.is_file() and path.suffix == ".json" and path.parent.name == "manifests" \
+        and path.parent.parent.name == CAS_DIR_NAME
+
+
+def load_cas_manifest(manifest_path: Path) -> dict:
+    with open(manifest_path, encoding="utf-8") as f:
+        data = json.load(f)
+    if data.get("format") != CAS_FORMAT:
+        raise ValueError(f"Not a content-addressed backup manifest: {manifest_path}")
+    return data
+
+
+def find_previous_cas_manifest(source_f: Path, manifests_dir: Path):
+    if not manifests_dir.exists():
+        return None
+    pattern = re.compile(
+        re.escape(source_f.name)
+        + r"_backup_(\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2})(?:\((\d+)\))?\.json$"
+    )
+    latest = None
+    latest_key = None
+    for item in manifests_dir.iterdir():
+        match = pattern.match(item.name)
+        if not match:
+            continue
+        key = (match.group(1), int(match.group(2) or 0))
+        if latest_key is None or key > latest_key:
+            latest, latest_key = item, key
+    return latest
+
+
+def _write_json_atomic(path: Path, data: dict):
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, separators=(",", ":"))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def create_cas_backup(source_f: Path,
+                      backup_root: Path,
+                      total_files: int,
+                      progress_cb = None,
+                      manifest: ScanManifest = None,
+                      workers: int = None,
+                      algorithm: str = DEFAULT_HASH,
+                      index = None) -> Path:
+    """Back up `source_f` into the content-addressed store.
+
+    Each distinct content is stored once. Files whose size and mtime match
+    the previous manifest of this source reuse its digest unread, as do
+    files a file_index.FileIndex already knows. Every other file is hashed
+    while it is copied to tmp/, so an object always holds the bytes that
+    were hashed; the copy is dropped when the store already has them. Returns the path of the new manifest.
+    """
+    if not source_f.exists() or not source_f.is_dir():
+        raise ValueError("Source folder is not valid.")
+
+    objects_dir, manifests_dir, tmp_dir = store_paths(backup_root)
+    for folder in (objects_dir, manifests_dir, tmp_dir):
+        folder.mkdir(parents=True, exist_ok=True)
+
+    # marks the run for retention's garbage collector, see active_cas_runs
+    marker = tmp_dir / f"{uuid.uuid4().hex}{RUN_MARKER_SUFFIX}"
+    marker.touch()
+    try:
+        if manifest is None:
+            manifest = scan_tree(source_f)
+
+        known = {}
+        previous = find_previous_cas_manifest(source_f, manifests_dir)
+        if previous is not None:
+            previous_data = load_cas_manifest(previous)
+            if previous_data.get("algorithm") == algorithm:
+                for item in previous_data["files"]:
+                    known[item["path"]] = (item["size"], item["mtime_ns"], item["digest"])
+
+        digests = {}
+        tracker = ProgressTracker(manifest.total_bytes)
+
+        def store_file(entry):
+            src = source_f / entry.rel_path
+            key = entry.rel_path.replace(os.sep, "/")
+            cached = known.get(key)
+            if cached and cached[0] == entry.size and cached[1] == entry.mtime_ns:
+                digest = cached[2]
+            elif index is not None:
+                digest = index.cached_digest(src, entry.size, entry.mtime_ns, entry.inode, algorithm)
+            else:
+                digest = None
+
+            if digest is None or not object_path(objects_dir, digest).exists():
+                # one read serves the copy and the hash, so the object always
+                # holds exactly the bytes its name is the digest of, even if
+                # the file changes meanwhile; write under a unique name, then
+                # rename: two threads storing the same content both end with
+                # one complete object
+                tmp = tmp_dir / uuid.uuid4().hex
+                digest = copy_file(src, tmp, size=entry.size, algorithm=algorithm)
+                target = object_path(objects_dir, digest)
+                if target.exists():
+                    os.unlink(tmp)
+                else:
+                    target.parent.mkdir(exist_ok=True)
+                    os.replace(tmp, target)
+                if index is not None:
+                    st = os.stat(src)
+                    if st.st_size == entry.size and st.st_mtime_ns == entry.mtime_ns:
+                        index.remember_digest(src, digest, algorithm)
+            digests[entry.rel_path] = digest
+            tracker.add(entry.size)
+
+        run_file_tasks(manifest.files(), store_file, total_files, "Backup",
+                       "Backup Cancel", "Backup cancelled by user",
+                       progress_cb=progress_cb, workers=workers, tracker=tracker)
+
+        timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+        manifest_path = manifests_dir / f"{source_f.name}_backup_{timestamp}.json"
+        counter = 1
+        while manifest_path.exists():
+            manifest_path = manifests_dir / f"{source_f.name}_backup_{timestamp}({counter}).json"
+            counter += 1
+
+        _write_json_atomic(manifest_path, {
+            "format": CAS_FORMAT,
+            "source": str(source_f),
+            "created": timestamp,
+            "algorithm": algorithm,
+            "files": [
+                {
+                    "path": entry.rel_path.replace(os.sep, "/"),
+                    "size": entry.size,
+                    "mtime_ns": entry.mtime_ns,
+                    "digest": digests[entry.rel_path],
+                }
+                for entry in manifest.files()
+            ],
+        })
+        return manifest_path
+    finally:
+        marker.unlink(missing_ok=True)
+
+
+def restore_cas_backup(manifest_path: Path, target: Path, paths=None):
+    """Rebuild the tree described by `manifest_path` under `target`.
+
+    `paths` optionally limits the restore to those manifest paths.
+    """
+    data = load_cas_manifest(manifest_path)
+    objects_dir = manifest_path.parent.parent / "objects"
+    wanted = set(paths) if paths is not None else None
+
+    for item in data["files"]:
+        if wanted is not None and item["path"] not in wanted:
+            continue
+        dest = target / Path(*item["path"].split("/"))
+        source_object = object_path(objects_dir, item["digest"])
+        if not source_object.exists():
+            raise FileNotFoundError(f"Backup object missing for {item['path']}: {source_object}")
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(source_object, dest)
+        # one object may back files with different timestamps
+        os.utime(dest, ns=(item["mtime_ns"], item["mtime_ns"]))
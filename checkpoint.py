@@ -0,0 +1,166 @@
+import json
+import os
+import re
+import threading
+import time
+from pathlib import Path
+from logger import log_warning
+
+# A folder backup in progress has a sidecar <backup folder>.checkpoint, one
+# JSON record per line:
+#   {"op": "begin", "source": ..., "mode": ..., "algorithm": ...}
+#   {"path": rel, "size": n, "mtime_ns": n, "digest": hex or null}
+# A file is only recorded after it and its folder were fsynced, so every
+# record survives a crash together with the data it describes. The sidecar
+# is removed once the backup is complete; a folder that still has one is a
+# partial backup, which the next run of the same source resumes.
+CHECKPOINT_SUFFIX = ".checkpoint"
+CHECKPOINT_INTERVAL = 5.0
+CHECKPOINT_MAX_PENDING = 1024
+
+
+def checkpoint_path_for(backup_folder: Path) -> Path:
+    return backup_folder.with_name(backup_folder.name + CHECKPOINT_SUFFIX)
+
+
+def is_partial_backup(backup_folder: Path) -> bool:
+    return checkpoint_path_for(backup_folder).exists()
+
+
+def _fsync_path(path: str, flags: int = os.O_RDONLY):
+    fd = os.open(path, flags | getattr(os, "O_BINARY", 0))
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _fsync_file(path: str):
+    # Windows only flushes through a writable handle; a copy that kept a
+    # read-only mode can still be fsynced read-only on POSIX
+    try:
+        _fsync_path(path, os.O_RDWR)
+    except PermissionError:
+        _fsync_path(path)
+
+
+def _fsync_dir(path: str):
+    # directories cannot be opened at all on Windows; their entries are
+    # flushed with the files there
+    try:
+        _fsync_path(path)
+    except OSError:
+        pass
+
+
+class BackupCheckpoint:
+    def __init__(self, backup_folder: Path, header: dict = None):
+        self.backup_folder = backup_folder
+        self.path = checkpoint_path_for(backup_folder)
+        self._lock = threading.Lock()
+        self._pending = []
+        self._last_flush = time.monotonic()
+        resumed = self.path.exists()
+        self._file = open(self.path, "a", encoding="utf-8")
+        if not resumed:
+            self._file.write(json.dumps({"op": "begin", **(header or {})}) + "\n")
+            self._sync()
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def record(self, rel_path: str, size: int, mtime_ns: int, digest: str = None):
+        """Note a finished copy; it is persisted with the next flush. Called from worker threads.
+
+        The copy is fsynced here, by the worker that made it, so the lock
+        only ever covers appending to the checkpoint file.
+        """
+        try:
+            _fsync_file(os.path.join(self.backup_folder, rel_path))
+        except OSError as e:
+            # not vouched for, so a resumed backup copies it again
+            log_warning(f"Could not fsync {rel_path}, not checkpointed: {e}")
+            return
+        with self._lock:
+            self._pending.append({"path": rel_path, "size": size, "mtime_ns": mtime_ns, "digest": digest})
+            if len(self._pending) < CHECKPOINT_MAX_PENDING \
+                    and time.monotonic() - self._last_flush < CHECKPOINT_INTERVAL:
+                return
+            pending = self._take_pending()
+        self._write(pending)
+
+    def flush(self):
+        with self._lock:
+            pending = self._take_pending()
+        self._write(pending)
+
+    def _take_pending(self) -> list:
+        pending, self._pending = self._pending, []
+        self._last_flush = time.monotonic()
+        return pending
+
+    def _write(self, pending: list):
+        if not pending:
+            return
+        # new names must be durable in their folders before they are vouched for
+        for folder in {os.path.dirname(os.path.join(self.backup_folder, record["path"])) for record in pending}:
+            _fsync_dir(folder)
+        with self._lock:
+            for record in pending:
+                self._file.write(json.dumps(record) + "\n")
+            self._sync()
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+    def finish(self):
+        """The backup is complete: drop the sidecar so the folder counts as a normal backup."""
+        self._file.close()
+        self.path.unlink(missing_ok=True)
+
+
+def load_checkpoint(backup_folder: Path):
+    """(header, {rel path: record}) of a partial backup; a torn last line is ignored."""
+    header = {}
+    records = {}
+    with open(checkpoint_path_for(backup_folder), encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            if record.get("op") == "begin":
+                header = record
+            else:
+                records[record["path"].replace("/", os.sep)] = record
+    return header, records
+
+
+def find_partial_backup(source_f: Path, backup_root: Path, mode: str, algorithm: str = None):
+    """Newest partial backup of `source_f` taken with the same mode and checksums, or None."""
+    if not backup_root.exists():
+        return None
+    pattern = re.compile(
+        re.escape(source_f.name)
+        + r"_backup_(\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2})(?:\((\d+)\))?" + re.escape(CHECKPOINT_SUFFIX) + "$"
+    )
+    candidates = []
+    with os.scandir(backup_root) as it:
+        for item in it:
+            match = pattern.match(item.name)
+            if match:
+                candidates.append(((match.group(1), int(match.group(2) or 0)), Path(item.path)))
+    for _, path in sorted(candidates, reverse=True):
+        folder = path.with_name(path.name[:-len(CHECKPOINT_SUFFIX)])
+        if not folder.is_dir():
+            continue
+        try:
+            header, _ = load_checkpoint(folder)
+        except (OSError, ValueError, KeyError):
+            continue
+        if header.get("source") == str(Path(source_f).resolve()) and header.get("mode") == mode \
+                and header.get("algorithm") == algorithm:
+            return folder
+    return None
@@ -0,0 +1,365 @@
+"""Headless entry point: back up and organize one or more folders without the UI.
+
+    python cli.py SOURCE BACKUP
+    python cli.py --job SRC1 BKP1 --job SRC2 BKP2 --jobs 2
+    python cli.py --config jobs.json --summary summary.json
+    python cli.py --watch SOURCE BACKUP
+    python cli.py SOURCE BACKUP --dry-run
+    python cli.py SOURCE BACKUP --backup-mode incremental --keep-daily 7 --keep-weekly 4
+
+A config file looks like
+    {"defaults": {"backup_mode": "incremental"},
+     "jobs": [{"source": "...", "backup": "...", "recursive": true}, ...]}
+
+Jobs whose source or backup share a disk run one after another; jobs on
+independent disks run in parallel, up to --jobs at a time. Nothing here
+imports tkinter, so it runs from cron on machines without a display.
+"""
+import argparse
+import contextlib
+import json
+import os
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from main import run_backend
+from backup import BACKUP_MODES, BACKUP_FULL
+from copy_engine import STAGING_MODES, STAGING_AUTO, COMPARE_MTIME, COMPARE_HASH
+from organizer import ORGANIZE_MODES, ORGANIZE_STAGING, LAYOUTS, LAYOUT_FLATTEN, FILE_CATEGORIES
+from rules import load_rules
+from dedup import DEDUP_ACTIONS
+from archive_backup import ARCHIVE_COMPRESSIONS, ARCHIVE_GZIP
+from watcher import watch_folder
+from retention import RETENTION_KEYS, normalize_policy
+from logger import configure_logging, flush_logs, log_info, log_error
+import cancel_state
+from cancel_state import request_cancel
+
+# Exit codes; a batch exits with the highest code of its jobs
+EXIT_OK = 0
+EXIT_FAILED = 1          # apply failed, source rolled back
+EXIT_USAGE = 2           # bad arguments or config (argparse uses 2 as well)
+EXIT_SETUP_FAILED = 3    # backup/staging could not be prepared
+EXIT_CANCELLED = 4
+EXIT_ERROR = 5           # unexpected exception inside the job
+EXIT_VERIFY_FAILED = 6   # backup did not match its checksums; source untouched
+EXIT_INSUFFICIENT_SPACE = 7   # preflight found too little free space; nothing written
+
+STATUS_EXIT_CODES = {
+    "SUCCESS": EXIT_OK,
+    "EMPTY": EXIT_OK,
+    "FAILED": EXIT_FAILED,
+    "SETUP_FAILED": EXIT_SETUP_FAILED,
+    "CANCELLED": EXIT_CANCELLED,
+    "ERROR": EXIT_ERROR,
+    "VERIFY_FAILED": EXIT_VERIFY_FAILED,
+    "INSUFFICIENT_SPACE": EXIT_INSUFFICIENT_SPACE,
+    "DRY_RUN": EXIT_OK,
+}
+
+# run_backend keyword arguments a job may set
+JOB_OPTIONS = {
+    "copy_workers": None,
+    "staging_mode": STAGING_AUTO,
+    "backup_mode": BACKUP_FULL,
+    "organize_mode": ORGANIZE_STAGING,
+    "rules_path": None,
+    "recursive": False,
+    "max_depth": None,
+    "layout": LAYOUT_FLATTEN,
+    "keep_empty_dirs": False,
+    "backup_compare": COMPARE_MTIME,
+    "use_index": True,
+    "dedup_action": None,
+    "archive_compression": ARCHIVE_GZIP,
+    "backup_checksums": True,
+    "verify_before_apply": False,
+    "preflight_check": True,
+    "dry_run": False,
+    "retention": None,
+}
+_CHOICES = {
+    "staging_mode": STAGING_MODES,
+    "backup_mode": BACKUP_MODES,
+    "organize_mode": ORGANIZE_MODES,
+    "layout": LAYOUTS,
+    "backup_compare": (COMPARE_MTIME, COMPARE_HASH),
+    "dedup_action": (None,) + DEDUP_ACTIONS,
+    "archive_compression": ARCHIVE_COMPRESSIONS,
+}
+
+
+def make_job(source, backup, options: dict) -> dict:
+    unknown = set(options) - set(JOB_OPTIONS)
+    if unknown:
+        raise ValueError(f"Unknown job options {sorted(unknown)}")
+    for key, choices in _CHOICES.items():
+        if key in options and options[key] not in choices:
+            raise ValueError(f"Invalid {key} {options[key]!r}; expected one of {', '.join(map(str, choices))}")
+    if not source or not backup:
+        raise ValueError("Every job needs a source and a backup folder")
+    job = dict(JOB_OPTIONS)
+    job.update(options)
+    if job["retention"] is not None:
+        job["retention"] = normalize_policy(job["retention"])
+    job["source"] = str(source)
+    job["backup"] = str(backup)
+    return job
+
+
+def load_jobs(config_path: Path, overrides: dict) -> list:
+    with open(config_path, encoding="utf-8") as f:
+        config = json.load(f)
+    defaults = dict(config.get("defaults", {}))
+    defaults.update(overrides)
+    jobs = []
+    for item in config.get("jobs", []):
+        item = dict(item)
+        source = item.pop("source", None)
+        backup = item.pop("backup", None)
+        options = dict(defaults)
+        options.update(item)
+        jobs.append(make_job(source, backup, options))
+    return jobs
+
+
+def _device(path: Path) -> int:
+    # the backup folder may not exist yet: use its nearest existing parent
+    path = Path(path).resolve()
+    while not path.exists() and path.parent != path:
+        path = path.parent
+    return os.stat(path).st_dev
+
+
+def group_by_device(jobs: list) -> list:
+    """Split jobs into groups that share no disk, keeping job order in each group.
+
+    A job ties together the disks of its source and its backup, so two jobs
+    writing to the same backup disk never compete for it (and never share a
+    staging folder).
+    """
+    parent = {}
+
+    def find(device):
+        while parent.setdefault(device, device) != device:
+            device = parent[device]
+        return device
+
+    job_devices = []
+    for job in jobs:
+        try:
+            devices = (_device(job["source"]), _device(job["backup"]))
+        except OSError:
+            devices = (("missing", job["source"]),)
+        job_devices.append(devices)
+        for device in devices[1:]:
+            parent[find(device)] = find(devices[0])
+
+    groups = {}
+    for index, devices in enumerate(job_devices):
+        groups.setdefault(find(devices[0]), []).append(index)
+    return list(groups.values())
+
+
+class BatchRunner:
+    def __init__(self, jobs: list, concurrency: int = 1):
+        self.jobs = jobs
+        self.concurrency = max(1, concurrency)
+        self.results = [None] * len(jobs)
+        self.stop = threading.Event()
+
+    def interrupt(self):
+        self.stop.set()
+        request_cancel()
+
+    def _run_job(self, index: int) -> dict:
+        job = self.jobs[index]
+        summary = {"index": index, "source": job["source"], "backup": job["backup"]}
+        if self.stop.is_set():
+            summary.update(status="CANCELLED", exit_code=EXIT_CANCELLED, duration=0.0, phases={})
+            return summary
+
+        phases = {}
+
+        def progress_cb(current, total, phase, stats=None):
+            # run_backend resets the shared cancel flag when a job starts;
+            # re-assert an interrupt that arrived meanwhile
+            if self.stop.is_set() and not cancel_state.cancel_requested:
+                request_cancel()
+            if total:
+                phase_summary = {"files": current, "total_files": total}
+                if stats is not None:
+                    phase_summary["bytes"] = stats.bytes_done
+                    phase_summary["total_bytes"] = stats.bytes_total
+                phases[phase] = phase_summary
+
+        options = {key: job[key] for key in JOB_OPTIONS}
+        report = {}
+        started = time.monotonic()
+        log_info(f"CLI job {index} started: {job['source']} -> {job['backup']}")
+        try:
+            # prune in the job itself so the next job on this disk never races it
+            status = run_backend(job["source"], job["backup"], progress_cb, run_report=report,
+                                 prune_in_background=False, **options)
+        except Exception as e:
+            status = "ERROR"
+            summary["error"] = str(e)
+            log_error(f"CLI job {index} raised: {e}")
+        status = status if status in STATUS_EXIT_CODES else "ERROR"
+
+        summary.update(status=status, exit_code=STATUS_EXIT_CODES[status],
+                       duration=round(time.monotonic() - started, 3), phases=phases, **report)
+        log_info(f"CLI job {index} finished: {status}")
+        return summary
+
+    def _run_group(self, indexes: list):
+        for index in indexes:
+            self.results[index] = self._run_job(index)
+
+    def run(self) -> list:
+        groups = group_by_device(self.jobs)
+        workers = min(self.concurrency, len(groups)) or 1
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job") as executor:
+            for future in [executor.submit(self._run_group, group) for group in groups]:
+                future.result()
+        return self.results
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="smart-file-manager",
+        description="Back up and organize folders without the UI.")
+    parser.add_argument("source", nargs="?", help="source folder of a single job")
+    parser.add_argument("backup", nargs="?", help="backup location of a single job")
+    parser.add_argument("--job", nargs=2, action="append", default=[], metavar=("SOURCE", "BACKUP"),
+                        help="add a job; may be repeated")
+    parser.add_argument("--config", type=Path, help="JSON file with defaults and a list of jobs")
+    parser.add_argument("--jobs", type=int, default=1, help="jobs to run at once on independent disks")
+    parser.add_argument("--summary", type=Path, help="write the JSON summary here instead of stdout")
+
+    parser.add_argument("--backup-mode", choices=BACKUP_MODES)
+    parser.add_argument("--staging-mode", choices=STAGING_MODES)
+    parser.add_argument("--organize-mode", choices=ORGANIZE_MODES,
+                        help="staging (default) organizes a copy and swaps it in; plan renames the source "
+                             "in place through a crash-safe journal")
+    parser.add_argument("--layout", choices=LAYOUTS)
+    parser.add_argument("--rules", dest="rules_path", help="organizer rules JSON file")
+    parser.add_argument("--recursive", action="store_true", default=None)
+    parser.add_argument("--max-depth", type=int)
+    parser.add_argument("--keep-empty-dirs", action="store_true", default=None)
+    parser.add_argument("--copy-workers", type=int)
+    parser.add_argument("--compare", dest="backup_compare", choices=(COMPARE_MTIME, COMPARE_HASH),
+                        help="how incremental backups decide a file is unchanged")
+    parser.add_argument("--compression", dest="archive_compression", choices=ARCHIVE_COMPRESSIONS,
+                        help="compression of --backup-mode archive")
+    parser.add_argument("--no-checksums", dest="backup_checksums", action="store_false", default=None,
+                        help="do not hash folder backups while copying (enables in-kernel copies)")
+    parser.add_argument("--verify", dest="verify_before_apply", action="store_true", default=None,
+                        help="re-check the backup against its checksums before changing the source")
+    parser.add_argument("--dry-run", action="store_true", default=None,
+                        help="only scan and report needed space and estimated time; write nothing")
+    parser.add_argument("--no-preflight", dest="preflight_check", action="store_false", default=None,
+                        help="skip the free space check before copying")
+    parser.add_argument("--keep-last", type=int, help="retention: keep the newest N backups of each source")
+    parser.add_argument("--keep-daily", type=int, help="retention: keep the newest backup of each of the last N days")
+    parser.add_argument("--keep-weekly", type=int, help="retention: same per ISO week")
+    parser.add_argument("--keep-monthly", type=int, help="retention: same per month")
+    parser.add_argument("--max-total-size", help="retention: drop the oldest backups above this size, e.g. 500G")
+    parser.add_argument("--dedup", dest="dedup_action", choices=DEDUP_ACTIONS,
+                        help="find byte-identical files before organizing and report, hardlink or delete copies")
+    parser.add_argument("--no-index", dest="use_index", action="store_false", default=None,
+                        help="do not read or update the file index in the backup location")
+    parser.add_argument("--log-json", action="store_true", help="write the log file as JSON lines")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep running and organize new files as they arrive (single job)")
+    parser.add_argument("--poll", action="store_true", help="with --watch, poll instead of using inotify")
+    return parser
+
+
+def jobs_from_args(args) -> list:
+    overrides = {key: getattr(args, key) for key in JOB_OPTIONS if getattr(args, key, None) is not None}
+    retention = {key: getattr(args, key) for key in RETENTION_KEYS if getattr(args, key) is not None}
+    if retention:
+        overrides["retention"] = retention
+    jobs = []
+    if args.config:
+        jobs.extend(load_jobs(args.config, overrides))
+    if args.source or args.backup:
+        jobs.append(make_job(args.source, args.backup, overrides))
+    for source, backup in args.job:
+        jobs.append(make_job(source, backup, overrides))
+    return jobs
+
+
+def run_watch(job: dict, args) -> int:
+    stop = threading.Event()
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGINT, lambda _signum, _frame: stop.set())
+        signal.signal(signal.SIGTERM, lambda _signum, _frame: stop.set())
+
+    summary = {"source": job["source"], "backup": job["backup"]}
+    try:
+        rules = load_rules(Path(job["rules_path"]), FILE_CATEGORIES) if job["rules_path"] else None
+        with contextlib.redirect_stdout(sys.stderr):
+            summary.update(watch_folder(job["source"], job["backup"], rules, stop,
+                                        use_inotify=False if args.poll else None))
+        exit_code = EXIT_OK
+    except Exception as e:
+        log_error(f"Watch of {job['source']} failed: {e}")
+        summary["error"] = str(e)
+        exit_code = EXIT_ERROR
+
+    json.dump({"exit_code": exit_code, "watch": summary}, sys.stdout, indent=2)
+    print()
+    flush_logs()
+    return exit_code
+
+
+def main(argv=None) -> int:
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.log_json:
+        configure_logging(json_lines=True)
+
+    try:
+        jobs = jobs_from_args(args)
+    except (OSError, ValueError) as e:
+        print(f"error: {e}", file=sys.stderr)
+        return EXIT_USAGE
+    if not jobs:
+        parser.print_usage(sys.stderr)
+        print("error: no jobs given", file=sys.stderr)
+        return EXIT_USAGE
+
+    if args.watch:
+        if len(jobs) != 1:
+            print("error: --watch takes exactly one job", file=sys.stderr)
+            return EXIT_USAGE
+        return run_watch(jobs[0], args)
+
+    runner = BatchRunner(jobs, args.jobs)
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGINT, lambda _signum, _frame: runner.interrupt())
+        signal.signal(signal.SIGTERM, lambda _signum, _frame: runner.interrupt())
+
+    # the backend reports to stdout; keep stdout for the JSON summary
+    with contextlib.redirect_stdout(sys.stderr):
+        results = runner.run()
+
+    exit_code = max(result["exit_code"] for result in results)
+    summary = {"exit_code": exit_code, "jobs": results}
+    if args.summary:
+        with open(args.summary, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+    else:
+        json.dump(summary, sys.stdout, indent=2)
+        print()
+    flush_logs()
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
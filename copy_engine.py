@@ -0,0 +1,399 @@
+import os
+import errno
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+import cancel_state
+from cancel_state import CancellationError
+from scanner import ScanManifest
+from hashing import file_digest, DEFAULT_HASH
+import hashlib
+from progress import ProgressTracker
+
+# How often a phase reports progress while no file finishes (large files)
+PROGRESS_TICK = 0.5
+
+# Copies are I/O bound, so oversubscribe the CPUs the same way
+# ThreadPoolExecutor does by default, but keep a hard ceiling.
+DEFAULT_COPY_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+
+# Files at least this big go through copy_file_chunked so they report
+# progress and honour cancel mid-file; smaller ones use one shutil.copy2
+LARGE_FILE_THRESHOLD = 64 * 1024 * 1024
+COPY_CHUNK_SIZE = 8 * 1024 * 1024
+
+# How staging is materialised from the source
+STAGING_COPY = "copy"
+STAGING_HARDLINK = "hardlink"
+STAGING_REFLINK = "reflink"
+STAGING_AUTO = "auto"        # reflink, then hardlink, then copy
+STAGING_MODES = (STAGING_COPY, STAGING_HARDLINK, STAGING_REFLINK, STAGING_AUTO)
+
+# How an incremental backup decides a file is unchanged since the last one
+COMPARE_MTIME = "mtime"      # size + mtime, like rsync's default quick check
+COMPARE_HASH = "hash"        # size + content hash, like rsync --checksum
+
+# linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+# errors meaning "this filesystem cannot do that at all", as opposed to a
+# problem with one particular file
+_UNSUPPORTED_ERRNOS = {
+    errno.EXDEV, errno.EINVAL, errno.ENOTTY, errno.ENOSYS,
+    errno.EOPNOTSUPP, getattr(errno, "ENOTSUP", errno.EOPNOTSUPP),
+}
+
+
+def same_device(a: Path, b: Path) -> bool:
+    return os.stat(a).st_dev == os.stat(b).st_dev
+
+
+def hardlink_file(src: Path, dst: Path):
+    os.link(src, dst)
+
+
+def reflink_file(src: Path, dst: Path):
+    """Copy-on-write clone of `src` (btrfs, XFS and other FICLONE filesystems)."""
+    try:
+        import fcntl
+    except ImportError:
+        raise OSError(errno.EOPNOTSUPP, "reflink is not available on this platform")
+
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        except OSError:
+            d.close()
+            os.unlink(dst)
+            raise
+    shutil.copystat(src, dst)
+
+
+_buffers = threading.local()
+
+
+def _chunk_buffer(size: int) -> bytearray:
+    # one reusable buffer per copy thread
+    buffer = getattr(_buffers, "buffer", None)
+    if buffer is None or len(buffer) != size:
+        buffer = _buffers.buffer = bytearray(size)
+    return buffer
+
+
+def copy_file_chunked(src: Path, dst: Path, bytes_cb = None, chunk_size: int = COPY_CHUNK_SIZE):
+    """Copy `src` to `dst` chunk by chunk, like shutil.copy2.
+
+    Uses os.copy_file_range, then os.sendfile (both in-kernel, Linux), then
+    buffered readinto with a reusable per-thread buffer. `bytes_cb(n)` is
+    called after every chunk and cancel is checked between chunks; a
+    cancelled or failed copy removes the partial `dst`.
+    """
+    methods = []
+    if hasattr(os, "copy_file_range"):
+        methods.append("copy_file_range")
+    if hasattr(os, "sendfile"):
+        methods.append("sendfile")
+    methods.append("readinto")
+
+    offset = 0
+    try:
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            in_fd, out_fd = fsrc.fileno(), fdst.fileno()
+            while True:
+                if cancel_state.cancel_requested:
+                    raise CancellationError("Copy Cancel", f"Copy of {src} cancelled")
+
+                method = methods[0]
+                try:
+                    if method == "copy_file_range":
+                        n = os.copy_file_range(in_fd, out_fd, chunk_size, offset, offset)
+                    elif method == "sendfile":
+                        os.lseek(out_fd, offset, os.SEEK_SET)
+                        n = os.sendfile(out_fd, in_fd, offset, chunk_size)
+                    else:
+                        buffer = _chunk_buffer(chunk_size)
+                        fsrc.seek(offset)
+                        fdst.seek(offset)
+                        n = fsrc.readinto(buffer)
+                        if n:
+                            fdst.write(memoryview(buffer)[:n])
+                except OSError as e:
+                    if method != "readinto" and e.errno in _UNSUPPORTED_ERRNOS | {errno.EBADF}:
+                        methods.pop(0)
+                        continue
+                    raise
+
+                if not n:
+                    break
+                offset += n
+                if bytes_cb:
+                    bytes_cb(n)
+        shutil.copystat(src, dst)
+    except BaseException:
+        try:
+            os.unlink(dst)
+        except OSError:
+            pass
+        raise
+
+
+def copy_file_hashed(src: Path, dst: Path, bytes_cb = None, algorithm: str = DEFAULT_HASH,
+                     chunk_size: int = COPY_CHUNK_SIZE) -> str:
+    """Copy like copy_file_chunked, hashing the same buffers; returns the hex digest.
+
+    The in-kernel copy paths never show the data to Python, so this always
+    uses readinto: one read of the source serves both the copy and the hash.
+    """
+    h = hashlib.new(algorithm)
+    buffer = _chunk_buffer(chunk_size)
+    view = memoryview(buffer)
+    try:
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            while True:
+                if cancel_state.cancel_requested:
+                    raise CancellationError("Copy Cancel", f"Copy of {src} cancelled")
+                n = fsrc.readinto(buffer)
+                if not n:
+                    break
+                h.update(view[:n])
+                fdst.write(view[:n])
+                if bytes_cb:
+                    bytes_cb(n)
+        shutil.copystat(src, dst)
+    except BaseException:
+        try:
+            os.unlink(dst)
+        except OSError:
+            pass
+        raise
+    return h.hexdigest()
+
+
+def copy_file(src: Path, dst: Path, bytes_cb = None, size: int = None, algorithm: str = None):
+    """shutil.copy2 for small files, copy_file_chunked for large ones.
+
+    With an `algorithm` the copy is hashed on the way (copy_file_hashed) and
+    the digest is returned.
+    """
+    if algorithm is not None:
+        return copy_file_hashed(src, dst, bytes_cb, algorithm)
+    if size is None:
+        size = os.stat(src).st_size
+    if size >= LARGE_FILE_THRESHOLD:
+        return copy_file_chunked(src, dst, bytes_cb)
+    shutil.copy2(src, dst)
+    if bytes_cb:
+        bytes_cb(size)
+
+
+def make_staging_copy_fn(mode: str):
+    """Return a copy function for `mode` that degrades to a real copy.
+
+    A method that fails with an "unsupported" error is dropped for the rest
+    of the run; any other failure only falls back to copying that one file.
+    """
+    if mode not in STAGING_MODES:
+        raise ValueError(f"Unknown staging mode: {mode}")
+    if mode == STAGING_COPY:
+        return copy_file
+
+    methods = {
+        STAGING_HARDLINK: [hardlink_file],
+        STAGING_REFLINK: [reflink_file],
+        STAGING_AUTO: [reflink_file, hardlink_file],
+    }[mode]
+    lock = threading.Lock()
+
+    def copy_fn(src, dst, bytes_cb = None, size = None):
+        for method in list(methods):
+            try:
+                method(src, dst)
+            except OSError as e:
+                if e.errno in _UNSUPPORTED_ERRNOS:
+                    with lock:
+                        if method in methods:
+                            methods.remove(method)
+                    continue
+                break
+            if bytes_cb:
+                bytes_cb(size if size is not None else os.stat(dst).st_size)
+            return
+        return copy_file(src, dst, bytes_cb, size)
+
+    return copy_fn
+
+
+def make_destination_dirs(manifest: ScanManifest, dest_root: Path):
+    """Create every directory that will receive a file exactly once."""
+    dest_root.mkdir(parents=True, exist_ok=True)
+    parents = {os.path.dirname(entry.rel_path) for entry in manifest.files()}
+    parents.discard("")
+    # makedirs also creates intermediate levels that hold no files themselves
+    for rel_dir in sorted(parents):
+        os.makedirs(dest_root / rel_dir, exist_ok=True)
+
+
+def run_file_tasks(files,
+                   task,
+                   total_files: int,
+                   phase: str,
+                   cancel_phase: str,
+                   cancel_message: str,
+                   progress_cb = None,
+                   workers: int = None,
+                   tracker: ProgressTracker = None) -> int:
+    """Run `task(entry)` for every entry of `files` on a bounded thread pool.
+
+    Cancel is checked before each submission; tasks already in flight are
+    allowed to finish before CancellationError is raised. Progress is
+    reported from the calling thread so counts are always increasing. With a
+    `tracker` the tasks feed bytes into, progress_cb also gets its snapshot,
+    at least every PROGRESS_TICK seconds even while one big file copies.
+    """
+    workers = workers or DEFAULT_COPY_WORKERS
+
+    def report():
+        if not progress_cb:
+            return
+        if tracker is not None:
+            progress_cb(processed, total_files, phase, tracker.snapshot())
+        else:
+            progress_cb(processed, total_files, phase)
+
+    processed = 0
+    max_in_flight = workers * 4
+    in_flight = set()
+    failure = None
+
+    def drain(block_until):
+        nonlocal processed, in_flight, failure
+        timeout = PROGRESS_TICK if tracker is not None else None
+        done, in_flight = wait(in_flight, timeout=timeout, return_when=block_until)
+        if not done:
+            report()
+        for future in done:
+            error = future.exception()
+            if isinstance(error, CancellationError):
+                # a task stopped mid-file; reported below with our phase
+                continue
+            if error is not None:
+                failure = failure or error
+                continue
+            processed += 1
+            report()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for entry in files:
+            if cancel_state.cancel_requested or failure is not None:
+                break
+            while len(in_flight) >= max_in_flight:
+                drain(FIRST_COMPLETED)
+            in_flight.add(pool.submit(task, entry))
+        while in_flight:
+            drain(FIRST_COMPLETED)
+
+    if failure is not None:
+        raise failure
+    if cancel_state.cancel_requested:
+        raise CancellationError(cancel_phase, cancel_message)
+    return processed
+
+
+def copy_manifest(manifest: ScanManifest,
+                  dest_root: Path,
+                  total_files: int,
+                  phase: str,
+                  cancel_phase: str,
+                  cancel_message: str,
+                  progress_cb = None,
+                  workers: int = None,
+                  copy_fn = copy_file,
+                  bytes_cb = None,
+                  checksums: dict = None) -> int:
+    """Copy every file of `manifest` under `dest_root`, see run_file_tasks.
+
+    `copy_fn(src, dst, bytes_cb, size)` does one file and reports the bytes
+    it wrote through `bytes_cb(n)`, which is called from the worker threads.
+    With a `checksums` dict, whatever copy_fn returns (its digest) is stored
+    there under the file's relative path.
+    """
+    source_root = manifest.root
+    make_destination_dirs(manifest, dest_root)
+    tracker = ProgressTracker(manifest.total_bytes)
+
+    def count_bytes(n):
+        tracker.add(n)
+        if bytes_cb:
+            bytes_cb(n)
+
+    def task(entry):
+        result = copy_fn(source_root / entry.rel_path, dest_root / entry.rel_path,
+                         count_bytes, entry.size)
+        if checksums is not None:
+            checksums[entry.rel_path] = result
+
+    return run_file_tasks(manifest.files(), task, total_files, phase,
+                          cancel_phase, cancel_message,
+                          progress_cb=progress_cb, workers=workers, tracker=tracker)
+
+
+def make_link_dest_copy_fn(manifest: ScanManifest,
+                           backup_folder: Path,
+                           previous_backup: Path,
+                           compare: str = COMPARE_MTIME,
+                           index = None,
+                           algorithm: str = None,
+                           previous_checksums: dict = None):
+    """rsync --link-dest: hardlink files unchanged since `previous_backup`.
+
+    Every other file, and any file the link fails for (different device,
+    link count limit), is copied, so the new folder is a complete snapshot.
+    With a file_index.FileIndex, hash comparisons reuse the source's
+    digests from earlier runs; the previous backup's side comes from
+    `previous_checksums` (its sidecar) when it has one. With an `algorithm`,
+    copy_fn returns each file's digest: hashed during the copy, or for a
+    link taken from `previous_checksums` (the previous backup's sidecar).
+    """
+    entries = {entry.rel_path: entry for entry in manifest.files()}
+    prefix_len = len(os.path.join(str(backup_folder), ""))
+    previous_backup = str(previous_backup)
+
+    def copy_fn(src, dst, bytes_cb = None, size = None):
+        rel_path = str(dst)[prefix_len:]
+        entry = entries[rel_path]
+        previous = os.path.join(previous_backup, rel_path)
+        try:
+            st = os.stat(previous)
+        except OSError:
+            return copy_file(src, dst, bytes_cb, entry.size, algorithm)
+
+        src_digest = None
+        if st.st_size == entry.size:
+            if compare == COMPARE_HASH:
+                if index is not None:
+                    src_digest = index.digest(src, entry.size, entry.mtime_ns, entry.inode)
+                    # backup copies are described by their sidecar, not the index
+                    previous_digest = (previous_checksums or {}).get(rel_path) or file_digest(previous)
+                    unchanged = src_digest == previous_digest
+                else:
+                    unchanged = file_digest(src) == file_digest(previous)
+            else:
+                unchanged = st.st_mtime_ns == entry.mtime_ns
+            if unchanged:
+                try:
+                    os.link(previous, dst)
+                except OSError:
+                    pass
+                else:
+                    if bytes_cb:
+                        bytes_cb(entry.size)
+                    if algorithm is None:
+                        return None
+                    known = (previous_checksums or {}).get(rel_path)
+                    if known is None and algorithm == DEFAULT_HASH:
+                        known = src_digest
+                    return known if known is not None else file_digest(previous, algorithm)
+        return copy_file(src, dst, bytes_cb, entry.size, algorithm)
+
+    return copy_fn
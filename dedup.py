@@ -0,0 +1,167 @@
+import hashlib
+import os
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+from hashing import file_digest, DEFAULT_HASH
+from scanner import ScanManifest
+
+# What to do with byte-identical copies, once found
+DEDUP_REPORT = "report"        # only list them
+DEDUP_HARDLINK = "hardlink"    # replace copies with hardlinks to the kept file
+DEDUP_DELETE = "delete"        # remove copies; the backup still has them
+DEDUP_ACTIONS = (DEDUP_REPORT, DEDUP_HARDLINK, DEDUP_DELETE)
+
+# Bytes read from each end of a file for the cheap pre-hash
+PARTIAL_BLOCK = 64 * 1024
+# Below this many full hashes a process pool costs more than it saves
+PROCESS_POOL_MIN_FILES = 8
+
+
+def partial_digest(path, size: int, block: int = PARTIAL_BLOCK) -> str:
+    """Hash of the first and last `block` bytes; the whole file when it is that small."""
+    h = hashlib.new(DEFAULT_HASH)
+    with open(path, "rb") as f:
+        h.update(f.read(block))
+        if size > 2 * block:
+            f.seek(size - block)
+        h.update(f.read(block))
+    return h.hexdigest()
+
+
+def _group(items, key_fn, pool=None) -> list:
+    """Split `items` by key_fn(item), keeping only groups with more than one member."""
+    keys = pool.map(key_fn, items) if pool is not None else map(key_fn, items)
+    groups = {}
+    for item, key in zip(items, keys):
+        if key is not None:
+            groups.setdefault(key, []).append(item)
+    return [group for group in groups.values() if len(group) > 1]
+
+
+def find_duplicates(manifest: ScanManifest, workers: int = None, index = None) -> list:
+    """Groups of identical files in `manifest`, each sorted with the file to keep first.
+
+    Files are compared by size, then by a hash of their first and last
+    blocks, and only the files still tied are read in full (in a process
+    pool), so most files are never read completely. Empty files and files
+    that are already hardlinks of each other are not reported.
+    """
+    root = manifest.root
+    by_size = {}
+    for entry in manifest.files():
+        if entry.size > 0:
+            by_size.setdefault(entry.size, []).append(entry)
+
+    candidates = []
+    for entries in by_size.values():
+        # one inode is one file, however many names it has
+        unique = list({entry.inode: entry for entry in entries}.values())
+        if len(unique) > 1:
+            candidates.append(unique)
+    if not candidates:
+        return []
+
+    def partial_key(entry):
+        try:
+            return entry.size, partial_digest(root / entry.rel_path, entry.size)
+        except OSError as e:
+            print(f"Skipped (cannot read): {entry.rel_path}: {e}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        tied = _group([entry for group in candidates for entry in group], partial_key, pool)
+
+    # files no bigger than two blocks were hashed whole already
+    groups = [group for group in tied if group[0].size <= 2 * PARTIAL_BLOCK]
+    to_hash = [entry for group in tied if group[0].size > 2 * PARTIAL_BLOCK for entry in group]
+
+    digests = {}
+    missing = []
+    for entry in to_hash:
+        cached = index.cached_digest(root / entry.rel_path, entry.size, entry.mtime_ns, entry.inode) \
+            if index is not None else None
+        if cached:
+            digests[entry.rel_path] = cached
+        else:
+            missing.append(entry)
+
+    if missing:
+        paths = [str(root / entry.rel_path) for entry in missing]
+        if len(missing) >= PROCESS_POOL_MIN_FILES:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                computed = list(pool.map(file_digest, paths, chunksize=4))
+        else:
+            computed = [file_digest(path) for path in paths]
+        for entry, path, digest in zip(missing, paths, computed):
+            digests[entry.rel_path] = digest
+            if index is not None:
+                index.remember_digest(path, digest)
+
+    groups.extend(_group(to_hash, lambda entry: (entry.size, digests[entry.rel_path])))
+    for group in groups:
+        # keep the shallowest, then alphabetically first, copy
+        group.sort(key=lambda entry: (entry.depth, entry.rel_path))
+    groups.sort(key=lambda group: group[0].rel_path)
+    return groups
+
+
+def _replace_with_link(keep: Path, duplicate: Path):
+    # link under a temporary name, then swap it in, so the duplicate's name
+    # never points at nothing
+    tmp = duplicate.with_name(f".{duplicate.name}.{uuid.uuid4().hex[:8]}.link")
+    os.link(keep, tmp)
+    try:
+        os.replace(tmp, duplicate)
+    except OSError:
+        os.unlink(tmp)
+        raise
+
+
+def consolidate_duplicates(manifest: ScanManifest, action: str = DEDUP_REPORT,
+                           workers: int = None, index = None) -> dict:
+    """Find duplicates in `manifest` and apply `action` to all but the first of each group.
+
+    Returns a summary for the run result; "removed" lists the relative paths
+    that no longer exist afterwards.
+    """
+    if action not in DEDUP_ACTIONS:
+        raise ValueError(f"Unknown dedup action: {action}")
+    groups = find_duplicates(manifest, workers, index)
+
+    summary = {
+        "action": action,
+        "groups": [[entry.rel_path for entry in group] for group in groups],
+        "duplicates": sum(len(group) - 1 for group in groups),
+        "duplicate_bytes": sum(group[0].size * (len(group) - 1) for group in groups),
+        "removed": [],
+        "linked": [],
+        "failed": [],
+    }
+    if action == DEDUP_REPORT:
+        return summary
+
+    root = manifest.root
+    for group in groups:
+        keep = root / group[0].rel_path
+        for entry in group[1:]:
+            duplicate = root / entry.rel_path
+            try:
+                if action == DEDUP_HARDLINK:
+                    _replace_with_link(keep, duplicate)
+                    summary["linked"].append(entry.rel_path)
+                else:
+                    os.remove(duplicate)
+                    summary["removed"].append(entry.rel_path)
+            except OSError as e:
+                print(f"Could not {action} duplicate {entry.rel_path}: {e}")
+                summary["failed"].append(entry.rel_path)
+    return summary
+
+
+def without_paths(manifest: ScanManifest, removed) -> ScanManifest:
+    """The manifest minus the removed files, for the phases that follow dedup."""
+    removed = set(removed)
+    if not removed:
+        return manifest
+    return ScanManifest(manifest.root, [e for e in manifest.entries if e.rel_path not in removed])
@@ -0,0 +1,147 @@
+import os
+import sqlite3
+import threading
+from pathlib import Path
+from hashing import file_digest, DEFAULT_HASH
+
+# Lives next to the backups it describes: <backup root>/.file_index.sqlite
+INDEX_FILE_NAME = ".file_index.sqlite"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path      TEXT PRIMARY KEY,
+    size      INTEGER NOT NULL,
+    mtime_ns  INTEGER NOT NULL,
+    inode     INTEGER NOT NULL,
+    algorithm TEXT,
+    digest    TEXT,
+    category  TEXT,
+    rules_key TEXT
+)
+"""
+_COLUMNS = ("size", "mtime_ns", "inode", "algorithm", "digest", "category", "rules_key")
+
+
+def index_path_for(backup_root: Path) -> Path:
+    return Path(backup_root) / INDEX_FILE_NAME
+
+
+class FileIndex:
+    """Digests and categories remembered across runs, keyed by absolute path.
+
+    A row is only trusted while the file's size, mtime and inode still match.
+    A file that was renamed (organized) keeps its inode and mtime, so its
+    digest is also found by those; its category only while the file name is
+    unchanged, since the category depends on the name. The whole table is
+    read once when the index opens and changes are written in one
+    transaction by save(), so a warm run
+    costs a dict lookup per file and database work per changed file only.
+    Lookups are safe from the copy worker threads.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(_SCHEMA)
+        self._lock = threading.Lock()
+        self._rows = {}
+        self._by_identity = {}
+        self._dirty = {}
+        for row in self._db.execute(f"SELECT path, {', '.join(_COLUMNS)} FROM files"):
+            self._rows[row[0]] = row[1:]
+            self._by_identity[(row[3], row[1], row[2])] = row[0]
+
+    def _lookup(self, key: str, size: int, mtime_ns: int, inode: int):
+        row = self._rows.get(key)
+        if row is not None and row[0] == size and row[1] == mtime_ns and row[2] == inode:
+            return row
+        # renamed since: same inode, size and mtime under another path
+        other = self._by_identity.get((inode, size, mtime_ns))
+        row = self._rows.get(other) if other is not None else None
+        if row is not None and os.path.basename(other) != os.path.basename(key):
+            # a new name may mean a new category (report.txt -> report.jpg)
+            row = row[:5] + (None, None)
+        return row
+
+    def _store(self, key: str, row: tuple):
+        with self._lock:
+            self._rows[key] = row
+            self._by_identity[(row[2], row[0], row[1])] = key
+            self._dirty[key] = row
+
+    def digest(self, path, size: int, mtime_ns: int, inode: int, algorithm: str = DEFAULT_HASH) -> str:
+        key = str(path)
+        row = self._lookup(key, size, mtime_ns, inode)
+        if row is not None and row[3] == algorithm and row[4]:
+            if self._rows.get(key) is not row:
+                self._store(key, row)
+            return row[4]
+        digest = file_digest(path, algorithm)
+        self._store(key, (size, mtime_ns, inode, algorithm, digest,
+                          row[5] if row else None, row[6] if row else None))
+        return digest
+
+    def cached_digest(self, path, size: int, mtime_ns: int, inode: int, algorithm: str = DEFAULT_HASH):
+        row = self._lookup(str(path), size, mtime_ns, inode)
+        if row is not None and row[3] == algorithm and row[4]:
+            return row[4]
+        return None
+
+    def digest_of(self, path, algorithm: str = DEFAULT_HASH) -> str:
+        st = os.stat(path)
+        return self.digest(path, st.st_size, st.st_mtime_ns, st.st_ino, algorithm)
+
+    def remember_digest(self, path, digest: str, algorithm: str = DEFAULT_HASH):
+        """Record a digest computed elsewhere, e.g. for a fresh copy of a hashed file."""
+        st = os.stat(path)
+        key = str(path)
+        row = self._lookup(key, st.st_size, st.st_mtime_ns, st.st_ino)
+        self._store(key, (st.st_size, st.st_mtime_ns, st.st_ino, algorithm, digest,
+                          row[5] if row else None, row[6] if row else None))
+
+    def category(self, path, size: int, mtime_ns: int, inode: int, rules_key: str, classify) -> str:
+        key = str(path)
+        row = self._lookup(key, size, mtime_ns, inode)
+        if row is not None and row[6] == rules_key and row[5]:
+            if self._rows.get(key) is not row:
+                self._store(key, row)
+            return row[5]
+        category = classify()
+        self._store(key, (size, mtime_ns, inode, row[3] if row else None,
+                          row[4] if row else None, category, rules_key))
+        return category
+
+    def save(self, root: Path = None, seen: set = None):
+        """Write changed rows. With `root` and `seen`, forget rows under `root` not in `seen`,
+        and rows elsewhere whose file no longer exists."""
+        with self._lock:
+            dirty = self._dirty
+            self._dirty = {}
+            stale = []
+            if root is not None and seen is not None:
+                prefix = os.path.join(str(root), "")
+                stale = [key for key in self._rows if key not in seen
+                         and (key.startswith(prefix) or not os.path.lexists(key))]
+                for key in stale:
+                    del self._rows[key]
+                    dirty.pop(key, None)
+        with self._db:
+            self._db.executemany(
+                f"INSERT OR REPLACE INTO files (path, {', '.join(_COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(key, *row) for key, row in dirty.items()])
+            self._db.executemany("DELETE FROM files WHERE path = ?", [(key,) for key in stale])
+
+    def close(self):
+        self._db.close()
+
+
+def open_file_index(backup_root: Path):
+    """The index of `backup_root`, or None when it cannot be opened (runs go on without it)."""
+    try:
+        return FileIndex(index_path_for(backup_root))
+    except sqlite3.Error as e:
+        print(f"File index unavailable, continuing without it: {e}")
+        return None
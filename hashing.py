@@ -0,0 +1,18 @@
+import hashlib
+from pathlib import Path
+
+DEFAULT_HASH = "sha256"
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def file_digest(path: Path, algorithm: str = DEFAULT_HASH) -> str:
+    h = hashlib.new(algorithm)
+    buffer = bytearray(HASH_CHUNK_SIZE)
+    view = memoryview(buffer)
+    with open(path, "rb") as f:
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            h.update(view[:n])
+    return h.hexdigest()
@@ -0,0 +1,190 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+# Write-ahead journal for in-place applies. Each line is one JSON record:
+#   {"op": "begin", "root": ...}
+#   {"op": "mkdir", "path": rel}          directory created by the apply
+#   {"op": "rename", "src": rel, "dst": rel}
+#   {"op": "rmdir", "path": rel}          folder emptied by the apply
+#   {"op": "done", "upto": n}             the first n operations are on disk
+#   {"op": "undo"}                        rollback started
+#   {"op": "commit"} / {"op": "rolledback"}
+# Operations are written and fsynced before they run, one batch at a time,
+# so after a crash every started operation is in the journal.
+JOURNAL_DIR_NAME = ".journals"
+JOURNAL_BATCH_SIZE = 256
+
+
+def journal_path_for(source: Path, backup_root: Path) -> Path:
+    key = hashlib.sha1(str(Path(source).resolve()).encode("utf-8")).hexdigest()[:12]
+    return backup_root / JOURNAL_DIR_NAME / f"{Path(source).name}_{key}.journal"
+
+
+class ApplyJournal:
+    def __init__(self, path: Path, root: Path):
+        self.path = path
+        self.root = root
+        self.count = 0
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(path, "w", encoding="utf-8")
+        self._append({"op": "begin", "root": str(root)})
+        self.sync()
+
+    def _append(self, record: dict):
+        self._file.write(json.dumps(record) + "\n")
+
+    def sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def record(self, operations: list):
+        for operation in operations:
+            self._append(operation)
+        self.count += len(operations)
+        self.sync()
+
+    def mark_done(self):
+        # not fsynced on its own: losing a "done" only means resume re-checks
+        # a few operations that already happened
+        self._append({"op": "done", "upto": self.count})
+
+    def abort(self):
+        self.sync()
+        self._file.close()
+
+    def close(self, final_op: str):
+        self._append({"op": final_op})
+        self.sync()
+        self._file.close()
+
+
+def read_journal(path: Path) -> tuple:
+    """Return (root, operations, done_upto, state) from a journal file.
+
+    `state` is the last of "begin", "undo", "commit" or "rolledback". A
+    torn last line (crash mid-write) is ignored; the operation it held never
+    started because the journal is fsynced first.
+    """
+    root = None
+    operations = []
+    done_upto = 0
+    state = "begin"
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                break
+            op = record["op"]
+            if op == "begin":
+                root = Path(record["root"])
+            elif op in ("mkdir", "rename", "rmdir"):
+                operations.append(record)
+            elif op == "done":
+                done_upto = record["upto"]
+            else:
+                state = op
+    return root, operations, done_upto, state
+
+
+def _mark(path: Path, op: str):
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps({"op": op}) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _run(root: Path, operation: dict):
+    if operation["op"] == "mkdir":
+        os.makedirs(root / operation["path"], exist_ok=True)
+        return
+    if operation["op"] == "rmdir":
+        # best effort: a folder that is gone or gained content stays as is
+        try:
+            os.rmdir(root / operation["path"])
+        except OSError:
+            pass
+        return
+    src = root / operation["src"]
+    dst = root / operation["dst"]
+    if os.path.lexists(dst):
+        if not os.path.lexists(src):
+            return      # already applied before a crash
+        # os.rename silently replaces files on POSIX; never clobber
+        raise FileExistsError(f"Destination already exists: {dst}")
+    os.rename(src, dst)
+
+
+def _undo(root: Path, operation: dict):
+    if operation["op"] == "rmdir":
+        os.makedirs(root / operation["path"], exist_ok=True)
+        return
+    if operation["op"] == "mkdir":
+        path = root / operation["path"]
+        try:
+            os.rmdir(path)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            print(f"Left non-empty folder in place: {path}")
+        return
+    src = root / operation["src"]
+    dst = root / operation["dst"]
+    if os.path.lexists(dst) and not os.path.lexists(src):
+        os.rename(dst, src)
+
+
+def apply_journaled(root: Path, operations: list, journal_path: Path,
+                    batch_size: int = JOURNAL_BATCH_SIZE):
+    """Run mkdir/rename/rmdir operations under `root`, journaling each batch first.
+
+    On success the journal is removed. On failure it is kept so the caller
+    can undo_journal() it; after a crash resume_journal() finishes it.
+    """
+    journal = ApplyJournal(journal_path, root)
+    try:
+        for start in range(0, len(operations), batch_size):
+            batch = operations[start:start + batch_size]
+            journal.record(batch)
+            for operation in batch:
+                _run(root, operation)
+            journal.mark_done()
+    except Exception:
+        journal.abort()
+        raise
+    journal.close("commit")
+    journal_path.unlink()
+
+
+def undo_journal(journal_path: Path):
+    """Reverse every journaled operation, newest first. O(operations), not O(tree)."""
+    root, operations, _, _ = read_journal(journal_path)
+    # from here on a crash must finish the undo, not redo the apply
+    _mark(journal_path, "undo")
+    for operation in reversed(operations):
+        _undo(root, operation)
+    _mark(journal_path, "rolledback")
+    journal_path.unlink()
+
+
+def resume_journal(journal_path: Path) -> int:
+    """Finish whatever a crash interrupted: the apply, or its undo.
+
+    Returns the number of operations replayed.
+    """
+    root, operations, done_upto, state = read_journal(journal_path)
+    if state == "undo":
+        undo_journal(journal_path)
+        return len(operations)
+
+    pending = operations[done_upto:] if state == "begin" else []
+    # operations past the last "done" marker may or may not have run;
+    # _run skips the ones whose rename is already on disk
+    for operation in pending:
+        _run(root, operation)
+    if state == "begin":
+        _mark(journal_path, "commit")
+    journal_path.unlink()
+    return len(pending)
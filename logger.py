@@ -1,3 +1,9 @@
+import atexit
+import json
+import os
+import queue
+import threading
+import time
 from datetime import datetime
 from pathlib import Path
 
@@ -6,20 +12,161 @@ LOG_DIR = BASE_DIR / "logs"
 LOG_DIR.mkdir(exist_ok=True)
 LOG_FILE = LOG_DIR / "smart_file_manager.log"
 
+# Records are queued by the caller and written by one background thread
+# through a persistent handle, flushed every LOG_FLUSH_INTERVAL seconds or
+# LOG_BATCH_SIZE records, whichever comes first.
+LOG_FLUSH_INTERVAL = 1.0
+LOG_BATCH_SIZE = 256
+# Rotate to smart_file_manager.log.1 .. .N when the file gets too big or too old
+LOG_MAX_BYTES = 5 * 1024 * 1024
+LOG_MAX_AGE = 24 * 60 * 60
+LOG_BACKUP_COUNT = 5
+
+_settings = {
+    "json_lines": os.environ.get("SMART_FILE_MANAGER_LOG_JSON") == "1",
+    "max_bytes": LOG_MAX_BYTES,
+    "max_age": LOG_MAX_AGE,
+    "backup_count": LOG_BACKUP_COUNT,
+}
+
+
+def configure_logging(json_lines: bool = None, max_bytes: int = None,
+                      max_age: float = None, backup_count: int = None):
+    """Change the output format or rotation limits; None keeps the current value."""
+    for key, value in (("json_lines", json_lines), ("max_bytes", max_bytes),
+                       ("max_age", max_age), ("backup_count", backup_count)):
+        if value is not None:
+            _settings[key] = value
+
+
+def _format(created: float, level: str, message: str) -> str:
+    if _settings["json_lines"]:
+        return json.dumps({
+            "time": datetime.fromtimestamp(created).isoformat(timespec="milliseconds"),
+            "level": level,
+            "thread": threading.current_thread().name,
+            "message": message,
+        }) + "\n"
+    timestamp = datetime.fromtimestamp(created).strftime("%Y-%m-%d %H:%M:%S")
+    return f"{timestamp} | {level.upper()} | {message}\n"
+
+
+class _LogWriter(threading.Thread):
+    def __init__(self, path: Path):
+        super().__init__(name="log-writer", daemon=True)
+        self.path = path
+        self.records = queue.SimpleQueue()
+        self._file = None
+        self._opened_at = 0.0
+
+    def _open(self):
+        # a log left over from an earlier day starts a fresh file
+        try:
+            if time.time() - self.path.stat().st_mtime >= _settings["max_age"]:
+                self._shift_backups()
+        except FileNotFoundError:
+            pass
+        self._file = open(self.path, "a", encoding="utf-8")
+        self._opened_at = time.time()
+
+    def _shift_backups(self):
+        count = _settings["backup_count"]
+        for index in range(count - 1, 0, -1):
+            older = self.path.with_name(f"{self.path.name}.{index}")
+            if older.exists():
+                os.replace(older, self.path.with_name(f"{self.path.name}.{index + 1}"))
+        if count > 0:
+            os.replace(self.path, self.path.with_name(f"{self.path.name}.1"))
+        else:
+            self.path.unlink()
+
+    def _rotate_if_needed(self):
+        too_big = self._file.tell() >= _settings["max_bytes"]
+        too_old = time.time() - self._opened_at >= _settings["max_age"]
+        if too_big or too_old:
+            self._file.close()
+            self._shift_backups()
+            self._file = open(self.path, "a", encoding="utf-8")
+            self._opened_at = time.time()
+
+    def run(self):
+        pending = 0
+        last_flush = time.monotonic()
+        while True:
+            timeout = max(0.0, LOG_FLUSH_INTERVAL - (time.monotonic() - last_flush))
+            try:
+                record = self.records.get(timeout=timeout if pending else None)
+            except queue.Empty:
+                record = None
+
+            if isinstance(record, threading.Event):
+                # flush request (or shutdown): everything queued before it is written
+                if self._file is not None:
+                    self._file.flush()
+                pending = 0
+                last_flush = time.monotonic()
+                record.set()
+                continue
+
+            if record is not None:
+                try:
+                    if self._file is None:
+                        self._open()
+                    self._file.write(record)
+                    pending += 1
+                except OSError as e:
+                    print(f"Could not write log file {self.path}: {e}")
+                    continue
+
+            if pending and (pending >= LOG_BATCH_SIZE
+                            or time.monotonic() - last_flush >= LOG_FLUSH_INTERVAL):
+                try:
+                    self._file.flush()
+                    self._rotate_if_needed()
+                except OSError as e:
+                    print(f"Could not write log file {self.path}: {e}")
+                pending = 0
+                last_flush = time.monotonic()
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def _get_writer() -> _LogWriter:
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                writer = _LogWriter(LOG_FILE)
+                writer.start()
+                _writer = writer
+    return _writer
+
+
+def flush_logs(timeout: float = 5.0):
+    """Block until every record logged so far is in the file."""
+    if _writer is None:
+        return
+    done = threading.Event()
+    _writer.records.put(done)
+    done.wait(timeout)
+
+
+atexit.register(flush_logs)
+
+
 def _write_log(level: str, message : str):
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    line = f"{timestamp} | {level.upper()} | {message}\n"
-    
-    with open(LOG_FILE, mode="a", encoding="utf-8") as f:
-        f.write(line)
-        
+    # formatting here keeps the caller's timestamp and thread name; the
+    # file I/O happens on the writer thread
+    _get_writer().records.put(_format(time.time(), level, message))
+
 
 def log_info(message : str):
     _write_log("INFO", message)
-    
+
 def log_warning(message : str):
     _write_log("WARNING", message)
-    
+
 def log_error(message : str):
     _write_log("ERROR", message)
-    
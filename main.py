@@ -1,15 +1,24 @@
 from pathlib import Path
-from backup import prepare_backup_staging, count_files
-from organizer import file_organizer
-from apply import apply_to_original, rollback_from_backup, clear_folder_contents
+from backup import prepare_backup_staging, BACKUP_FULL
+from copy_engine import STAGING_AUTO, COMPARE_MTIME
+from archive_backup import ARCHIVE_GZIP
+from organizer import (file_organizer, plan_organization, plan_emptied_dirs, default_rules,
+                       FILE_CATEGORIES, ORGANIZE_STAGING, ORGANIZE_PLAN, LAYOUT_FLATTEN)
+from rules import load_rules
+from journal import journal_path_for, undo_journal, resume_journal
+from file_index import open_file_index
+from dedup import consolidate_duplicates, without_paths, DEDUP_REPORT
+from verify import verify_backup
+from preflight import preflight, format_preflight, record_throughput, throughput_key
+from retention import load_policy, normalize_policy, prune_backups, start_pruning, wait_for_pruning
+import time
+from scanner import ScanManifest, scan_tree
+from apply import apply_to_original, apply_plan, rollback_from_backup, clear_folder_contents
 from logger import log_info, log_error, log_warning
 import cancel_state
 from cancel_state import reset_cancel
 import shutil
 
-SOURCE_FOLDER = None
-BACKUP_FOLDER = None
-
 def cleanup_staging_and_exit(staging_folder, reason="cancelation"):
     """Clean up staging folder after cancellation"""
     sf = Path(staging_folder)
@@ -39,7 +48,18 @@ def cleanup_staging_and_exit(staging_folder, reason="cancelation"):
         print(f"   Path: {sf}")
         log_warning(f"Could not delete staging folder: {sf} :: {e}")
 
-def run_backend(source_Folder, backup_Folder, progress_cb = None):
+def run_backend(source_Folder, backup_Folder, progress_cb = None, copy_workers = None,
+                staging_mode = STAGING_AUTO, backup_mode = BACKUP_FULL,
+                organize_mode = ORGANIZE_STAGING, rules_path = None, recursive = False,
+                max_depth = None, layout = LAYOUT_FLATTEN, keep_empty_dirs = False,
+                backup_compare = COMPARE_MTIME, use_index = True, dedup_action = None,
+                archive_compression = ARCHIVE_GZIP, backup_checksums = True,
+                verify_before_apply = False, preflight_check = True, dry_run = False,
+                retention = None, prune_in_background = True, run_report = None):
+    # run_report, when given, is filled with details for callers that want
+    # more than the status string (backup location, dedup summary)
+    if run_report is None:
+        run_report = {}
     # resetting the cancel attribute
     reset_cancel()
     log_info("=" * 100)
@@ -49,98 +69,310 @@ def run_backend(source_Folder, backup_Folder, progress_cb = None):
     source_path = Path(source_Folder)
     backup_path = Path(backup_Folder)
     staging_path = backup_path.parent / "Staging"
+    use_staging = organize_mode != ORGANIZE_PLAN
+    
+    # an earlier run's prune of this backup root must not race this run
+    wait_for_pruning(backup_path)
     
     try:
-        result = prepare_backup_staging(
-            str(source_path),
-            str(backup_path),
-            str(staging_path),
-            progress_cb=progress_cb
-        )
+        rules = load_rules(Path(rules_path), FILE_CATEGORIES) if rules_path else default_rules()
+    except Exception as e:
+        print(f"Invalid organizer rules: {e}")
+        log_error(f"Invalid organizer rules: {e}")
+        return "SETUP_FAILED"
+    
+    # finish an in-place apply that a crash or power loss interrupted; a dry
+    # run only reports it
+    journal_path = journal_path_for(source_path, backup_path)
+    if journal_path.exists() and dry_run:
+        run_report["pending_journal"] = str(journal_path)
+    elif journal_path.exists():
+        try:
+            replayed = resume_journal(journal_path)
+            print(f"Resumed interrupted apply ({replayed} pending operations)")
+            log_info(f"Resumed interrupted apply from {journal_path}: {replayed} operations replayed")
+        except Exception as e:
+            print(f"Could not resume interrupted apply: {e}")
+            log_error(f"Could not resume interrupted apply from {journal_path}: {e}")
+            return "SETUP_FAILED"
+    
+    # one scan feeds the preflight and every later phase
+    try:
+        if not source_path.is_dir():
+            raise ValueError("Source folder is not valid.")
+        manifest = scan_tree(source_path)
     except Exception as e:
         print(f"Setup failed: {e}")
         log_error(f"Setup failed: {e}")
         return "SETUP_FAILED"
     
-    if result["status"] == "CANCELLED":
-        print("Operation cancelled during backup/staging.")
-        log_info("Cancelled during backup/staging phase")
-        # Clean up any partial staging that might exist
-        if staging_path.exists():
-            cleanup_staging_and_exit(staging_path, "cancelation during backup/staging")
-        return "CANCELLED"
+    # free space on every target device, and how long the copy should take
+    if (preflight_check or dry_run) and manifest.file_count:
+        try:
+            report = preflight(manifest, backup_path, staging_path if use_staging else None,
+                               backup_mode, staging_mode, measure=dry_run)
+        except Exception as e:
+            print(f"Preflight failed: {e}")
+            log_error(f"Preflight failed: {e}")
+            return "SETUP_FAILED"
+        run_report["preflight"] = report
+        print(format_preflight(report))
+        log_info(format_preflight(report))
+        if report["status"] != "OK" and not dry_run:
+            print("Not enough free space, nothing was copied")
+            log_error("Preflight: not enough free space for the run, nothing was copied")
+            return "INSUFFICIENT_SPACE"
     
-    if result["status"] == "EMPTY":
-        print("Nothing to work on. The source folder is empty")
-        log_info("Source folder is empty, nothing to organize")
-        return "EMPTY"
+    if dry_run:
+        log_info("Dry run finished, nothing was written")
+        return "DRY_RUN"
     
+    # digests and categories from earlier runs; see file_index.py
+    index = open_file_index(backup_path) if use_index else None
+    try:
+        try:
+            started = time.monotonic()
+            result = prepare_backup_staging(
+                str(source_path),
+                str(backup_path),
+                str(staging_path) if use_staging else None,
+                progress_cb=progress_cb,
+                workers=copy_workers,
+                staging_mode=staging_mode,
+                backup_mode=backup_mode,
+                backup_compare=backup_compare,
+                index=index,
+                archive_compression=archive_compression,
+                backup_checksums=backup_checksums,
+                manifest=manifest
+            )
+        except Exception as e:
+            print(f"Setup failed: {e}")
+            log_error(f"Setup failed: {e}")
+            return "SETUP_FAILED"
     
-    backup_folder = Path(result["backup_folder"])
-    log_info(f"Backup created at {backup_folder}")
+        if result["status"] == "CANCELLED":
+            print("Operation cancelled during backup/staging.")
+            log_info("Cancelled during backup/staging phase")
+            # Clean up any partial staging that might exist
+            if staging_path.exists():
+                cleanup_staging_and_exit(staging_path, "cancelation during backup/staging")
+            return "CANCELLED"
     
-    staging_folder = Path(result["staging_folder"])
-    log_info(f"Staging created at {staging_folder}")
+        if result["status"] == "EMPTY":
+            print("Nothing to work on. The source folder is empty")
+            log_info("Source folder is empty, nothing to organize")
+            return "EMPTY"
     
-    print("Organizing files in staging...")
-    log_info("Organizing files in staging...")
-    status = file_organizer(str(staging_folder))
     
-    # Cancel before apply 
-    if status == "CANCELLED":
-        print("Operation cancelled by user during organizing.")
-        log_info("Operation cancelled by the user during organizing")
-        cleanup_staging_and_exit(staging_folder, "cancelation during organizing")
-        return "CANCELLED"       
+        backup_folder = Path(result["backup_folder"])
+        log_info(f"Backup created at {backup_folder}")
+        run_report["backup_folder"] = str(backup_folder)
+        record_throughput(backup_path, throughput_key(backup_mode, use_staging),
+                          manifest.total_bytes, time.monotonic() - started)
+        
+        # nothing may touch the source until the backup is known to be good
+        if verify_before_apply:
+            print("Verifying backup...")
+            try:
+                verification = verify_backup(backup_folder, workers=copy_workers)
+            except Exception as e:
+                verification = {"backup": str(backup_folder), "ok": False, "error": str(e)}
+            run_report["verify"] = verification
+            if not verification["ok"]:
+                print(f"Backup verification failed: {verification}")
+                log_error(f"Backup verification failed, apply skipped: {verification}")
+                if use_staging:
+                    cleanup_staging_and_exit(staging_path, "failed backup verification")
+                return "VERIFY_FAILED"
+            log_info(f"Backup verified: {verification['checked']} files")
+    
+        if not use_staging:
+            organize_options = {"recursive": recursive, "max_depth": max_depth, "layout": layout}
+            status = run_plan(source_path, backup_folder, manifest, journal_path, rules,
+                              organize_options, keep_empty_dirs, progress_cb, index,
+                              dedup_action, copy_workers, run_report)
+            if status == "SUCCESS":
+                prune_after_run(source_path, backup_path, retention, prune_in_background, run_report)
+            return status
+    
+        staging_folder = Path(result["staging_folder"])
+        log_info(f"Staging created at {staging_folder}")
+        
+        if dedup_action:
+            # staging is disposable, so duplicates can go before organizing
+            staged, _ = run_dedup(ScanManifest(staging_folder, manifest.entries), dedup_action,
+                                  copy_workers, None, run_report)
+            manifest = ScanManifest(manifest.root, staged.entries)
+    
+        print("Organizing files in staging...")
+        log_info("Organizing files in staging...")
+        status = file_organizer(str(staging_folder), manifest=manifest, rules=rules,
+                                recursive=recursive, max_depth=max_depth, layout=layout,
+                                keep_empty_dirs=keep_empty_dirs)
+    
+        # Cancel before apply 
+        if status == "CANCELLED":
+            print("Operation cancelled by user during organizing.")
+            log_info("Operation cancelled by the user during organizing")
+            cleanup_staging_and_exit(staging_folder, "cancelation during organizing")
+            return "CANCELLED"       
               
-    # sanity check: files still exist
-    if count_files(staging_folder) == 0:
-        log_error("Staging folder is empty after organizing - no files found")
-        raise RuntimeError("Staging folder is empty after organizing - no files found")
+        # sanity checks use the scan manifest plus a single listing of the
+        # staging root instead of walking the whole staged tree again
+        staged_top = scan_tree(staging_folder, max_depth=0)
     
-    # sanity check: category folders created
-    if not any(staging_folder.glob("*/")):
-        log_error("File organizing failed - no category folders created")
-        raise RuntimeError("File organizing failed - no category folders created")
+        # sanity check: files still exist
+        if manifest.file_count == 0 or not staged_top.entries:
+            log_error("Staging folder is empty after organizing - no files found")
+            raise RuntimeError("Staging folder is empty after organizing - no files found")
     
-    print("Staging organized successfully.")
-    log_info("Staging organized succesfully")
+        # sanity check: category folders created
+        if not any(staged_top.dirs()):
+            log_error("File organizing failed - no category folders created")
+            raise RuntimeError("File organizing failed - no category folders created")
     
-    try:
-        if cancel_state.cancel_requested:
-            print("Operation cancelled just before apply phase.")
-            log_info("Cancelled just before apply phase")
-            cleanup_staging_and_exit(staging_folder, "cancelation before apply")
-            return "CANCELLED"
+        print("Staging organized successfully.")
+        log_info("Staging organized succesfully")
+    
+        try:
+            if cancel_state.cancel_requested:
+                print("Operation cancelled just before apply phase.")
+                log_info("Cancelled just before apply phase")
+                cleanup_staging_and_exit(staging_folder, "cancelation before apply")
+                return "CANCELLED"
          
-        print("Applying organized folder to original folder...")
-        log_info("Applying staging to original")
+            print("Applying organized folder to original folder...")
+            log_info("Applying staging to original")
         
+            if progress_cb:
+                progress_cb(0, 0, "APPLY_START")
+            
+            apply_to_original(source_path, staging_folder)
+            print("✅ Files applied successfully.")
+            log_info("Files applied succesfully to the original")
+            cleanup_staging_and_exit(staging_folder, "success")
+            prune_after_run(source_path, backup_path, retention, prune_in_background, run_report)
+            return "SUCCESS"
+    
+        except Exception as e:
+            print(f"❌ Apply failed: {e}")
+            print("↩️ Rolling back from backup...")
+            log_error("Apply failed, rollback triggered")
+            rollback_from_backup(source_path, backup_folder)
+            print("✅ Rollback completed. Original restored.")
+            log_info("Rollback Completed")
+            return "FAILED"
+    finally:
+        if index is not None:
+            try:
+                index.save(source_path, {str(source_path / e.rel_path) for e in manifest.files()}
+                           if manifest is not None else None)
+            except Exception as e:
+                log_warning(f"Could not save the file index: {e}")
+            index.close()
+
+
+def prune_after_run(source_path, backup_path, retention = None, background = True, run_report = None):
+    """Apply the retention policy (given, or <backup>/.retention.json) to this source's backups."""
+    try:
+        policy = normalize_policy(retention) if retention is not None else load_policy(backup_path)
+    except Exception as e:
+        log_warning(f"Invalid retention policy, nothing pruned: {e}")
+        return
+    if not policy:
+        return
+    if background:
+        start_pruning(backup_path, source_path.name, policy)
+        return
+    try:
+        result = prune_backups(backup_path, source_path.name, policy)
+    except Exception as e:
+        log_warning(f"Pruning backups of {source_path.name} failed: {e}")
+        result = {"error": str(e)}
+    log_info(f"Retention: {result}")
+    if run_report is not None:
+        run_report["retention"] = result
+
+
+def run_dedup(manifest, action, workers = None, index = None, run_report = None):
+    """Consolidate duplicates under manifest.root; returns (manifest without removed files, changed)."""
+    print("Looking for duplicate files...")
+    summary = consolidate_duplicates(manifest, action, workers=workers, index=index)
+    log_info(f"Dedup ({action}): {summary['duplicates']} duplicates in {len(summary['groups'])} groups, "
+             f"{summary['duplicate_bytes']} bytes; removed {len(summary['removed'])}, "
+             f"linked {len(summary['linked'])}, failed {len(summary['failed'])}")
+    if run_report is not None:
+        run_report["dedup"] = summary
+    changed = bool(summary["removed"] or summary["linked"])
+    return without_paths(manifest, summary["removed"]), changed
+
+
+def run_plan(source_path, backup_folder, manifest, journal_path, rules, organize_options,
+             keep_empty_dirs = False, progress_cb = None, index = None, dedup_action = None,
+             workers = None, run_report = None):
+    """Organize `source_path` in place from a move plan; no staging copy."""
+    if dedup_action == DEDUP_REPORT:
+        # read-only, so it may run while cancel is still possible
+        run_dedup(manifest, dedup_action, workers, index, run_report)
+        dedup_action = None
+    
+    if cancel_state.cancel_requested:
+        print("Operation cancelled just before apply phase.")
+        log_info("Cancelled just before apply phase")
+        return "CANCELLED"
+    
+    deduped = False
+    try:
         if progress_cb:
             progress_cb(0, 0, "APPLY_START")
+        
+        # removing duplicates changes the source, so it belongs to the
+        # apply phase: not cancellable, rolled back from the backup on failure
+        if dedup_action:
+            deduped = True
+            manifest, deduped = run_dedup(manifest, dedup_action, workers, index, run_report)
+        
+        print("Planning file moves...")
+        log_info("Planning file moves from the scan manifest")
+        plan = plan_organization(manifest, rules, index=index, **organize_options)
+        emptied = [] if keep_empty_dirs else plan_emptied_dirs(manifest, plan)
+        log_info(f"Planned {len(plan)} moves")
+        
+        print("Applying move plan to original folder...")
+        log_info("Applying move plan to original")
             
-        apply_to_original(source_path, staging_folder)
+        apply_plan(source_path, plan, journal_path, remove_dirs=emptied)
         print("✅ Files applied successfully.")
         log_info("Files applied succesfully to the original")
-        cleanup_staging_and_exit(staging_folder, "success")
         return "SUCCESS"
     
     except Exception as e:
         print(f"❌ Apply failed: {e}")
-        print("↩️ Rolling back from backup...")
-        log_error("Apply failed, rollback triggered")
-        rollback_from_backup(source_path, backup_folder)
-        print("✅ Rollback completed. Original restored.")
-        log_info("Rollback Completed")
+        log_error(f"Apply failed: {e}")
+        try:
+            # undo only the renames that ran, newest first
+            print("↩️ Undoing journaled moves...")
+            if journal_path.exists():
+                undo_journal(journal_path)
+            if deduped:
+                # the journal only knows the renames; bring back the duplicates
+                rollback_from_backup(source_path, backup_folder)
+            print("✅ Rollback completed. Original restored.")
+            log_info("Rollback Completed from apply journal")
+        except Exception as undo_error:
+            print("↩️ Journal undo failed, rolling back from backup...")
+            log_error(f"Journal undo failed ({undo_error}), full rollback triggered")
+            rollback_from_backup(source_path, backup_folder)
+            print("✅ Rollback completed. Original restored.")
+            log_info("Rollback Completed")
         return "FAILED"
 
     
 def main():
-    run_backend(
-        SOURCE_FOLDER,
-        BACKUP_FOLDER
-    )   
+    # headless runs go through the CLI, which takes the folders as arguments
+    from cli import main as cli_main
+    return cli_main()
 
 if __name__ == "__main__":
-    main()
-    
\ No newline at end of file
+    raise SystemExit(main())
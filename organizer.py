@@ -1,6 +1,22 @@
 from pathlib import Path
 import shutil
-from cancel_state import cancel_requested
+import os
+import time
+import cancel_state
+from scanner import ScanManifest, iter_tree
+from rules import RuleSet, RULES_FILE, load_rules, rules_from_categories
+
+# How run_backend organizes a folder
+ORGANIZE_STAGING = "staging"   # move files inside a staging copy, then swap it in
+ORGANIZE_PLAN = "plan"         # compute a move plan from the scan, rename in place
+ORGANIZE_MODES = (ORGANIZE_STAGING, ORGANIZE_PLAN)
+
+FALLBACK_CATEGORY = "Others"
+
+# Where nested files land when organizing recursively
+LAYOUT_FLATTEN = "flatten"     # sub/deep/y.png -> Images/y.png
+LAYOUT_MIRROR = "mirror"       # sub/deep/y.png -> Images/sub/deep/y.png
+LAYOUTS = (LAYOUT_FLATTEN, LAYOUT_MIRROR)
 
 FILE_CATEGORIES = {
     "Images": [
@@ -35,6 +51,90 @@ FILE_CATEGORIES = {
 }
 
 
+# suffix -> category, compiled once from FILE_CATEGORIES; reversed so the
+# first category listing a suffix wins, as with the old linear scan
+CATEGORY_BY_SUFFIX = {
+    suffix: category
+    for category, extensions in reversed(list(FILE_CATEGORIES.items()))
+    for suffix in extensions
+}
+
+THIS_FILE = Path(__file__).resolve()
+
+_default_rules = None
+
+
+def default_rules() -> RuleSet:
+    """Rules from organizer_rules.json when present, else FILE_CATEGORIES."""
+    global _default_rules
+    if _default_rules is None:
+        if RULES_FILE.exists():
+            _default_rules = load_rules(RULES_FILE, FILE_CATEGORIES)
+        else:
+            _default_rules = RuleSet(rules_from_categories(FILE_CATEGORIES), FALLBACK_CATEGORY)
+    return _default_rules
+
+
+def is_this_file(folder: Path, rel_path: str) -> bool:
+    # cheap name check first so only a same-named file pays for resolve()
+    return rel_path == THIS_FILE.name and (folder / rel_path).resolve() == THIS_FILE
+
+
+def get_category(file_name: str) -> str:
+    return CATEGORY_BY_SUFFIX.get(os.path.splitext(file_name)[1].lower(), FALLBACK_CATEGORY)
+
+
+def _list_names(folder) -> list:
+    try:
+        return os.listdir(folder)
+    except FileNotFoundError:
+        return []
+
+
+class NameAllocator:
+    """Collision-free destination names without probing the disk per file.
+
+    Each destination folder is listed once (or seeded by the caller), then
+    names are handed out from memory using the same `name(N)` convention as
+    get_unique_path. The next free N is remembered per base name, so a
+    thousand copies of invoice.pdf cost O(1) each rather than O(N).
+    Names are compared casefolded because Windows and macOS folders are
+    case-insensitive.
+    """
+
+    def __init__(self, list_dir = _list_names):
+        self._list_dir = list_dir
+        self._taken = {}
+        self._next_counter = {}
+
+    def seed(self, folder, names):
+        self._taken.setdefault(folder, set()).update(n.casefold() for n in names)
+
+    def _taken_in(self, folder) -> set:
+        taken = self._taken.get(folder)
+        if taken is None:
+            names = self._list_dir(folder) if self._list_dir else []
+            taken = self._taken[folder] = {n.casefold() for n in names}
+        return taken
+
+    def allocate(self, folder, name: str) -> str:
+        taken = self._taken_in(folder)
+        if name.casefold() not in taken:
+            taken.add(name.casefold())
+            return name
+
+        key = (folder, name.casefold())
+        counter = self._next_counter.get(key, 1)
+        stem, suffix = os.path.splitext(name)
+        candidate = f"{stem}({counter}){suffix}"
+        while candidate.casefold() in taken:
+            counter += 1
+            candidate = f"{stem}({counter}){suffix}"
+        self._next_counter[key] = counter + 1
+        taken.add(candidate.casefold())
+        return candidate
+
+
 def get_unique_path(destination_path : Path) -> Path:
     counter = 1
     new_path = destination_path
@@ -54,48 +154,149 @@ def move_file(file_to_move_path: Path, destination_path : Path):
         print(f"Error moving {file_to_move_path.name}: {e}")
 
 
-def file_organizer(folder_path: str):
+def _organizable(entries, categories: set, recursive: bool, max_depth: int = None):
+    """Files to organize: top level only, or nested ones outside category folders."""
+    for entry in entries:
+        if not entry.is_file:
+            continue
+        depth = entry.depth
+        if depth == 0:
+            yield entry
+        elif recursive and (max_depth is None or depth <= max_depth) \
+                and entry.rel_path.split(os.sep, 1)[0] not in categories:
+            yield entry
+
+
+def _destination_dir(rel_path: str, category: str, layout: str) -> str:
+    parent = os.path.dirname(rel_path)
+    if layout == LAYOUT_MIRROR and parent:
+        return os.path.join(category, parent)
+    return category
+
+
+def remove_empty_dirs(root: Path, rel_dirs: set):
+    """Remove the given folders and their emptied parents, deepest first."""
+    for rel_dir in sorted(rel_dirs, key=lambda d: d.count(os.sep), reverse=True):
+        while rel_dir:
+            try:
+                os.rmdir(root / rel_dir)
+            except OSError:
+                break
+            rel_dir = os.path.dirname(rel_dir)
+
+
+def file_organizer(folder_path: str, manifest: ScanManifest = None, rules: RuleSet = None,
+                   recursive: bool = False, max_depth: int = None,
+                   layout: str = LAYOUT_FLATTEN, keep_empty_dirs: bool = False):
     folder = Path(folder_path)
     if not folder.exists() or not folder.is_dir():
         raise ValueError("Provided path is not a valid folder")
+    if layout not in LAYOUTS:
+        raise ValueError(f"Unknown layout: {layout}")
+    if rules is None:
+        rules = default_rules()
+    categories = rules.categories
+
+    # staging mirrors the source, so the source manifest already knows the
+    # files; without one, stream the folder so memory stays flat
+    if manifest is not None:
+        entries = manifest.entries
+    else:
+        entries = iter_tree(folder, max_depth if recursive else 0, prune_top=categories)
 
-    for f in folder.iterdir():
-        if cancel_requested:
+    now = time.time()
+    created = set()
+    emptied = set()
+    names = NameAllocator()
+    for entry in _organizable(entries, categories, recursive, max_depth):
+        if cancel_state.cancel_requested:
             return "CANCELLED"
-        if not f.is_file():
-            continue
-        
-        if f.resolve() == Path(__file__).resolve():
+        if is_this_file(folder, entry.rel_path):
             continue
+        f = folder / entry.rel_path
             
-        suffix = f.suffix.lower()
-        found = False
-    
-        for category, extensions in FILE_CATEGORIES.items():
-            if suffix in extensions:
-                destination_folder = folder / category
-                destination_folder.mkdir(exist_ok=True)
-                
-                destination_path = destination_folder / f.name
-                final_path = get_unique_path(destination_path)
-                move_file(f, final_path)
-                found = True 
-                break   
-                    
-                    
-
-        if not found:
-            destination_folder = folder / 'Others'
-            destination_folder.mkdir(exist_ok=True)
+        category = rules.classify(f.name, entry.size, entry.mtime_ns, now)
+        destination_dir = _destination_dir(entry.rel_path, category, layout)
+        destination_folder = folder / destination_dir
+        if destination_dir not in created:
+            destination_folder.mkdir(parents=True, exist_ok=True)
+            created.add(destination_dir)
             
-            destination_path = destination_folder / f.name
-            final_path = get_unique_path(destination_path)
-            move_file(f, final_path)
-            found = True
+        final_path = destination_folder / names.allocate(destination_folder, f.name)
+        move_file(f, final_path)
+        if entry.depth:
+            emptied.add(os.path.dirname(entry.rel_path))
+    
+    if emptied and not keep_empty_dirs:
+        remove_empty_dirs(folder, emptied)
                     
             
-             
-            
+def plan_organization(manifest: ScanManifest, rules: RuleSet = None,
+                      recursive: bool = False, max_depth: int = None,
+                      layout: str = LAYOUT_FLATTEN, index = None) -> dict:
+    """Work out where every file would go, without touching disk.
+
+    Returns {source relative path: destination relative path}. Names already
+    present in a destination folder (according to the scan) and names handed
+    out earlier in the plan are avoided with the usual `name(N)` suffix.
+    With a file_index.FileIndex, unchanged files reuse their last category.
+    """
+    if layout not in LAYOUTS:
+        raise ValueError(f"Unknown layout: {layout}")
+    if rules is None:
+        rules = default_rules()
+    categories = rules.categories
+
+    # seeded from the scan, so planning never touches the disk
+    names = NameAllocator(list_dir=None)
+    for entry in manifest.entries:
+        parent, name = os.path.split(entry.rel_path)
+        if parent:
+            names.seed(parent, [name])
+
+    if index is not None and rules.time_dependent:
+        index = None
+
+    now = time.time()
+    plan = {}
+    for entry in _organizable(manifest.entries, categories, recursive, max_depth):
+        if is_this_file(manifest.root, entry.rel_path):
+            continue
+        name = os.path.basename(entry.rel_path)
+        if index is not None:
+            category = index.category(manifest.root / entry.rel_path, entry.size, entry.mtime_ns,
+                                      entry.inode, rules.key,
+                                      lambda: rules.classify(name, entry.size, entry.mtime_ns, now))
+        else:
+            category = rules.classify(name, entry.size, entry.mtime_ns, now)
+        destination_dir = _destination_dir(entry.rel_path, category, layout)
+        plan[entry.rel_path] = os.path.join(destination_dir, names.allocate(destination_dir, name))
+    return plan
+
+
+def plan_emptied_dirs(manifest: ScanManifest, plan: dict) -> list:
+    """Folders left with no files or kept subfolders once `plan` has run, deepest first."""
+    def ancestors(rel_path):
+        parent = os.path.dirname(rel_path)
+        while parent:
+            yield parent
+            parent = os.path.dirname(parent)
+
+    candidates = set()
+    for src in plan:
+        candidates.update(ancestors(src))
+
+    keep = set()
+    for entry in manifest.entries:
+        if entry.is_file and entry.rel_path not in plan:
+            keep.update(ancestors(entry.rel_path))
+        elif entry.is_dir and entry.rel_path not in candidates:
+            keep.add(entry.rel_path)
+            keep.update(ancestors(entry.rel_path))
+
+    return sorted(candidates - keep, key=lambda d: d.count(os.sep), reverse=True)
+
+
 if __name__ == "__main__":
     file_organizer('D:/Downloads')  # or whatever folder you want
             
@@ -0,0 +1,172 @@
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+from backup import find_previous_backup, BACKUP_INCREMENTAL, BACKUP_CAS, BACKUP_FULL
+from cas_store import store_paths, find_previous_cas_manifest, load_cas_manifest
+from copy_engine import STAGING_COPY
+from progress import format_bytes, format_duration
+from scanner import ScanManifest
+
+# Keep this much free on every target after the run, on top of the estimate
+PREFLIGHT_MIN_FREE = 256 * 1024 * 1024
+# and pad estimates for directory entries, checksum files and indexes
+PREFLIGHT_HEADROOM = 1.02
+# Without a recorded rate, read this much of the source to measure one
+PREFLIGHT_SAMPLE_BYTES = 64 * 1024 * 1024
+PREFLIGHT_SAMPLE_SECONDS = 1.0
+
+# <backup root>/.throughput.json: effective bytes/s of past runs per backup mode
+THROUGHPUT_FILE_NAME = ".throughput.json"
+
+
+def _existing(path: Path) -> Path:
+    # targets may not exist yet; measure the folder they will be created in
+    path = Path(path).absolute()
+    while not path.exists() and path.parent != path:
+        path = path.parent
+    return path
+
+
+def _backup_bytes(manifest: ScanManifest, backup_root: Path, mode: str) -> int:
+    """Bytes a backup in `mode` will write, judged by size and mtime like the backup itself."""
+    source = manifest.root
+    if mode == BACKUP_INCREMENTAL:
+        previous = find_previous_backup(source, backup_root) if backup_root.exists() else None
+        if previous is None:
+            return manifest.total_bytes
+        needed = 0
+        for entry in manifest.files():
+            try:
+                st = os.stat(previous / entry.rel_path)
+                if st.st_size == entry.size and st.st_mtime_ns == entry.mtime_ns:
+                    continue
+            except OSError:
+                pass
+            needed += entry.size
+        return needed
+    if mode == BACKUP_CAS:
+        _, manifests_dir, _ = store_paths(backup_root)
+        previous = find_previous_cas_manifest(source, manifests_dir)
+        if previous is None:
+            return manifest.total_bytes
+        known = {(item["path"], item["size"], item["mtime_ns"]) for item in load_cas_manifest(previous)["files"]}
+        return sum(entry.size for entry in manifest.files()
+                   if (entry.rel_path.replace(os.sep, "/"), entry.size, entry.mtime_ns) not in known)
+    # full copies and archives (compression only makes these smaller)
+    return manifest.total_bytes
+
+
+def _staging_bytes(manifest: ScanManifest, staging_root: Path, mode: str) -> int:
+    # links and clones on the source's filesystem cost metadata only
+    if mode != STAGING_COPY and os.stat(manifest.root).st_dev == os.stat(_existing(staging_root)).st_dev:
+        return 0
+    return manifest.total_bytes
+
+
+def throughput_key(backup_mode: str, staged: bool) -> str:
+    return f"{backup_mode}+staging" if staged else backup_mode
+
+
+def load_throughput(backup_root: Path) -> dict:
+    try:
+        with open(Path(backup_root) / THROUGHPUT_FILE_NAME, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def record_throughput(backup_root: Path, key: str, total_bytes: int, seconds: float):
+    """Remember how fast a run of kind `key` (see throughput_key) went, for later estimates."""
+    if seconds <= 0 or total_bytes <= 0:
+        return
+    rates = load_throughput(backup_root)
+    rates[key] = total_bytes / seconds
+    try:
+        with open(Path(backup_root) / THROUGHPUT_FILE_NAME, "w", encoding="utf-8") as f:
+            json.dump(rates, f)
+    except OSError as e:
+        print(f"Could not record throughput: {e}")
+
+
+def sample_read_rate(manifest: ScanManifest) -> float:
+    """Read rate of the source from its largest files; reads only, never writes."""
+    budget = PREFLIGHT_SAMPLE_BYTES
+    done = 0
+    buffer = bytearray(1024 * 1024)
+    started = time.monotonic()
+    for entry in sorted(manifest.files(), key=lambda e: e.size, reverse=True):
+        try:
+            with open(manifest.root / entry.rel_path, "rb") as f:
+                while done < budget:
+                    n = f.readinto(buffer)
+                    if not n:
+                        break
+                    done += n
+                    if time.monotonic() - started >= PREFLIGHT_SAMPLE_SECONDS:
+                        break
+        except OSError:
+            continue
+        if done >= budget or time.monotonic() - started >= PREFLIGHT_SAMPLE_SECONDS:
+            break
+    elapsed = time.monotonic() - started
+    return done / elapsed if done and elapsed > 0 else 0.0
+
+
+def preflight(manifest: ScanManifest, backup_root: Path, staging_root: Path = None,
+              backup_mode: str = BACKUP_FULL, staging_mode: str = STAGING_COPY,
+              measure: bool = True) -> dict:
+    """Check that every target device can hold what the run will write, and estimate its duration.
+
+    Returns a report whose "status" is "OK" or "INSUFFICIENT_SPACE". Nothing
+    is written; with `measure`, a short read of the source stands in for a
+    throughput no earlier run has recorded.
+    """
+    backup_root = Path(backup_root)
+    needs = [(backup_root, _backup_bytes(manifest, backup_root, backup_mode))]
+    if staging_root is not None:
+        needs.append((Path(staging_root), _staging_bytes(manifest, staging_root, staging_mode)))
+
+    devices = {}
+    for target, needed in needs:
+        existing = _existing(target)
+        device = devices.setdefault(os.stat(existing).st_dev, {"path": str(existing), "targets": [], "needed": 0})
+        device["targets"].append(str(target))
+        device["needed"] += int(needed * PREFLIGHT_HEADROOM)
+
+    ok = True
+    for device in devices.values():
+        usage = shutil.disk_usage(device["path"])
+        device["free"] = usage.free
+        device["ok"] = usage.free - device["needed"] >= PREFLIGHT_MIN_FREE
+        ok = ok and device["ok"]
+
+    throughput = load_throughput(backup_root).get(throughput_key(backup_mode, staging_root is not None))
+    throughput_source = "history" if throughput else None
+    if not throughput and measure:
+        throughput = sample_read_rate(manifest)
+        throughput_source = "sample" if throughput else None
+
+    return {
+        "status": "OK" if ok else "INSUFFICIENT_SPACE",
+        "files": manifest.file_count,
+        "bytes": manifest.total_bytes,
+        "backup_mode": backup_mode,
+        "devices": list(devices.values()),
+        "throughput": throughput,
+        "throughput_source": throughput_source,
+        "estimated_seconds": manifest.total_bytes / throughput if throughput else None,
+    }
+
+
+def format_preflight(report: dict) -> str:
+    lines = [f"Preflight: {report['files']} files, {format_bytes(report['bytes'])} ({report['backup_mode']} backup)"]
+    for device in report["devices"]:
+        mark = "ok" if device["ok"] else "NOT ENOUGH SPACE"
+        lines.append(f"  {', '.join(device['targets'])}: needs {format_bytes(device['needed'])}, "
+                     f"{format_bytes(device['free'])} free - {mark}")
+    if report["estimated_seconds"] is not None:
+        lines.append(f"  Estimated time: {format_duration(report['estimated_seconds'])} at "
+                     f"{format_bytes(report['throughput'])}/s ({report['throughput_source']})")
+    return "\n".join(lines)
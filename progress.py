@@ -0,0 +1,107 @@
+import threading
+import time
+from typing import NamedTuple
+
+# How long rate samples must be apart before they update the throughput
+RATE_SAMPLE_INTERVAL = 0.5
+# Weight of the newest sample in the smoothed throughput (EWMA)
+RATE_SMOOTHING = 0.3
+
+
+class ProgressStats(NamedTuple):
+    bytes_done: int
+    bytes_total: int
+    rate: float            # bytes/s over the last sample interval
+    smoothed_rate: float   # exponentially smoothed bytes/s
+    eta: float | None      # seconds left, None until a rate is known
+    elapsed: float
+
+
+class ProgressTracker:
+    """Byte accounting for one phase, fed from worker threads.
+
+    progress_cb receives a snapshot() of this as its optional fourth
+    argument: progress_cb(processed_files, total_files, phase, stats).
+    """
+
+    def __init__(self, bytes_total: int, smoothing: float = RATE_SMOOTHING):
+        self.bytes_total = bytes_total
+        self.smoothing = smoothing
+        self._lock = threading.Lock()
+        self._done = 0
+        self._started = time.monotonic()
+        self._sample_time = self._started
+        self._sample_bytes = 0
+        self._rate = 0.0
+        self._smoothed = 0.0
+
+    @property
+    def bytes_done(self) -> int:
+        return self._done
+
+    def add(self, n: int):
+        with self._lock:
+            self._done += n
+
+    def snapshot(self) -> ProgressStats:
+        now = time.monotonic()
+        with self._lock:
+            done = self._done
+            interval = now - self._sample_time
+            if interval >= RATE_SAMPLE_INTERVAL:
+                self._rate = (done - self._sample_bytes) / interval
+                if self._smoothed:
+                    self._smoothed += self.smoothing * (self._rate - self._smoothed)
+                else:
+                    self._smoothed = self._rate
+                self._sample_time = now
+                self._sample_bytes = done
+            rate, smoothed = self._rate, self._smoothed
+
+        eta = None
+        if smoothed > 0:
+            eta = max(0.0, (self.bytes_total - done) / smoothed)
+        return ProgressStats(done, self.bytes_total, rate, smoothed, eta, now - self._started)
+
+
+def format_bytes(n: float) -> str:
+    for unit in ("B", "KB", "MB", "GB", "TB"):
+        if abs(n) < 1024 or unit == "TB":
+            return f"{n:.0f} {unit}" if unit == "B" else f"{n:.1f} {unit}"
+        n /= 1024
+
+
+def format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    if hours:
+        return f"{hours}h {minutes:02d}m"
+    if minutes:
+        return f"{minutes}m {seconds:02d}s"
+    return f"{seconds}s"
+
+
+class ProgressChannel:
+    """Latest-value mailbox for progress between a worker and the UI thread.
+
+    Publishing overwrites the previous value of the same phase, so however
+    fast the worker reports, the reader only sees one update per phase per
+    poll and never has a backlog to chew through.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latest = {}
+
+    def publish(self, phase: str, payload):
+        with self._lock:
+            # re-insert so dict order follows the most recent publish
+            self._latest.pop(phase, None)
+            self._latest[phase] = payload
+
+    def take(self) -> list:
+        with self._lock:
+            payloads = list(self._latest.values())
+            self._latest.clear()
+        return payloads
@@ -0,0 +1,378 @@
+import json
+import os
+import re
+import shutil
+import sys
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from archive_backup import index_path_of
+from checkpoint import is_partial_backup
+from cas_store import store_paths, load_cas_manifest, active_cas_runs, object_path
+from logger import log_info, log_warning
+from verify import checksum_path_for
+
+# Policy keys; an unset or zero value means "no such rule". With none of the
+# keep_* rules set every snapshot is kept unless max_total_size forces out
+# the oldest ones. The newest snapshot is never removed.
+RETENTION_KEYS = ("keep_last", "keep_daily", "keep_weekly", "keep_monthly", "max_total_size")
+
+# <backup root>/.retention.json: the policy runs use when none is passed in
+RETENTION_FILE_NAME = ".retention.json"
+
+# CAS objects younger than this are never collected: a run in another
+# process may have stored them before writing its manifest
+CAS_GC_GRACE = 60 * 60
+
+# Snapshots are renamed to this prefix before deletion, so an interrupted
+# prune never leaves a half-deleted folder that looks like a backup
+_DELETING_PREFIX = ".pruning-"
+# CAS objects on their way out sit in cas_store/tmp/<digest>.gc
+_GC_SUFFIX = ".gc"
+
+_SIZE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+
+def parse_size(value) -> int:
+    """Bytes from an int or a string such as "500G" or "1.5T"."""
+    if isinstance(value, int):
+        return value
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*", str(value), re.IGNORECASE)
+    if not match:
+        raise ValueError(f"Invalid size: {value!r}")
+    return int(float(match.group(1)) * _SIZE_UNITS[match.group(2).upper()])
+
+
+def normalize_policy(policy: dict) -> dict:
+    if not isinstance(policy, dict):
+        raise ValueError(f"Retention policy must be a mapping, not {policy!r}")
+    unknown = set(policy) - set(RETENTION_KEYS)
+    if unknown:
+        raise ValueError(f"Unknown retention options {sorted(unknown)}")
+    normalized = {}
+    for key, value in policy.items():
+        if value is None:
+            continue
+        value = parse_size(value) if key == "max_total_size" else int(value)
+        if value < 0:
+            raise ValueError(f"Retention option {key} must not be negative")
+        if value:
+            normalized[key] = value
+    return normalized
+
+
+def load_policy(backup_root: Path) -> dict:
+    path = Path(backup_root) / RETENTION_FILE_NAME
+    if not path.is_file():
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return normalize_policy(json.load(f))
+
+
+def list_snapshots(backup_root: Path, source_name: str) -> list:
+    """Backups of `source_name` under `backup_root`, oldest first.
+
+    Each is {"name", "path", "kind", "time"} with kind "folder", "archive"
+    or "cas" (the manifest path).
+    """
+    pattern = re.compile(
+        re.escape(source_name)
+        + r"_backup_(\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2})(?:\((\d+)\))?(\.tar\.(?:gz|xz|bz2)|\.json)?$"
+    )
+    found = []
+
+    def add(item, kind, match):
+        found.append(((match.group(1), int(match.group(2) or 0)), {
+            "name": item.name,
+            "path": Path(item.path),
+            "kind": kind,
+            "time": datetime.strptime(match.group(1), "%Y-%m-%d_%H-%M-%S"),
+        }))
+
+    if backup_root.is_dir():
+        with os.scandir(backup_root) as it:
+            for item in it:
+                match = pattern.match(item.name)
+                if not match or match.group(3) == ".json":
+                    continue
+                if match.group(3) is None and item.is_dir(follow_symlinks=False):
+                    if is_partial_backup(Path(item.path)):
+                        # an unfinished backup waiting to be resumed, not a snapshot
+                        continue
+                    add(item, "folder", match)
+                elif match.group(3) and index_path_of(Path(item.path)).is_file():
+                    add(item, "archive", match)
+
+    _, manifests_dir, _ = store_paths(backup_root)
+    if manifests_dir.is_dir():
+        with os.scandir(manifests_dir) as it:
+            for item in it:
+                match = pattern.match(item.name)
+                if match and match.group(3) == ".json":
+                    add(item, "cas", match)
+
+    found.sort(key=lambda pair: pair[0])
+    return [snapshot for _, snapshot in found]
+
+
+def select_kept(snapshots: list, policy: dict) -> list:
+    """Indexes (into the oldest-first `snapshots`) that the keep_* rules retain."""
+    newest_first = list(range(len(snapshots) - 1, -1, -1))
+    if not any(policy.get(key) for key in RETENTION_KEYS[:4]):
+        return newest_first
+    kept = set(newest_first[:max(1, policy.get("keep_last", 0))])
+    periods = (
+        ("keep_daily", lambda t: t.date()),
+        ("keep_weekly", lambda t: t.isocalendar()[:2]),
+        ("keep_monthly", lambda t: (t.year, t.month)),
+    )
+    # the newest snapshot of each of the last N periods that have one
+    for key, period_of in periods:
+        count = policy.get(key)
+        if not count:
+            continue
+        seen = set()
+        for i in newest_first:
+            period = period_of(snapshots[i]["time"])
+            if period in seen:
+                continue
+            seen.add(period)
+            kept.add(i)
+            if len(seen) >= count:
+                break
+    return [i for i in newest_first if i in kept]
+
+
+def _snapshot_blobs(snapshot: dict, backup_root: Path) -> dict:
+    # {key: [size, link count, names]} of the storage a snapshot holds; the
+    # same key in two snapshots is the same bytes on disk
+    path = snapshot["path"]
+    blobs = {}
+    if snapshot["kind"] == "folder":
+        for dirpath, _, filenames in os.walk(path):
+            for filename in filenames:
+                try:
+                    st = os.lstat(os.path.join(dirpath, filename))
+                except OSError:
+                    continue
+                blob = blobs.setdefault(("inode", st.st_dev, st.st_ino), [st.st_size, st.st_nlink, 0])
+                blob[2] += 1
+        extras = [checksum_path_for(path)]
+    elif snapshot["kind"] == "archive":
+        extras = [path, index_path_of(path)]
+    else:
+        objects_dir, _, _ = store_paths(backup_root)
+        for item in load_cas_manifest(path)["files"]:
+            try:
+                size = os.stat(object_path(objects_dir, item["digest"])).st_size
+            except OSError:
+                continue
+            blobs[("object", item["digest"])] = [size, 1, 1]
+        extras = [path]
+    for extra in extras:
+        try:
+            blobs[("file", str(extra))] = [os.stat(extra).st_size, 1, 1]
+        except OSError:
+            pass
+    return blobs
+
+
+def _cas_digests(backup_root: Path, skip=()) -> set:
+    # every object any manifest in the store refers to
+    _, manifests_dir, _ = store_paths(backup_root)
+    digests = set()
+    if not manifests_dir.is_dir():
+        return digests
+    skip = {str(path) for path in skip}
+    for item in manifests_dir.glob("*.json"):
+        if str(item) in skip:
+            continue
+        digests.update(entry["digest"] for entry in load_cas_manifest(item)["files"])
+    return digests
+
+
+def _delete_snapshot(snapshot: dict):
+    path = snapshot["path"]
+    if snapshot["kind"] == "folder":
+        doomed = path.with_name(_DELETING_PREFIX + path.name)
+        os.replace(path, doomed)
+        checksum_path_for(path).unlink(missing_ok=True)
+        shutil.rmtree(doomed)
+    elif snapshot["kind"] == "archive":
+        # without its index the archive is no longer listed as a backup
+        index_path_of(path).unlink(missing_ok=True)
+        path.unlink(missing_ok=True)
+    else:
+        path.unlink()
+
+
+def collect_cas_garbage(backup_root: Path) -> dict:
+    """Delete store objects no manifest refers to; returns {"objects", "bytes"}.
+
+    A backup in another process may decide to reuse an unreferenced object
+    at any moment, so each object is first moved aside into tmp/ and only
+    deleted if no backup is running after that; otherwise it is put back
+    and collection stops. A running backup marks itself before it looks at
+    any object, so it either finds the object gone and stores it again, or
+    is seen here and gets it back.
+    """
+    objects_dir, _, tmp_dir = store_paths(backup_root)
+    collected = {"objects": 0, "bytes": 0}
+    if not objects_dir.is_dir():
+        return collected
+    # objects set aside by a collection that was interrupted go back first
+    for leftover in tmp_dir.glob(f"*{_GC_SUFFIX}") if tmp_dir.is_dir() else ():
+        digest = leftover.name[:-len(_GC_SUFFIX)]
+        os.replace(leftover, object_path(objects_dir, digest))
+    if active_cas_runs(backup_root):
+        log_info("CAS garbage collection skipped: a backup into the store is running")
+        return collected
+    live = _cas_digests(backup_root)
+    cutoff = time.time() - CAS_GC_GRACE
+    for prefix in objects_dir.iterdir():
+        if not prefix.is_dir():
+            continue
+        for item in prefix.iterdir():
+            digest = prefix.name + item.name
+            if digest in live:
+                continue
+            aside = tmp_dir / f"{digest}{_GC_SUFFIX}"
+            try:
+                st = item.stat()
+                if st.st_ctime > cutoff:
+                    continue
+                os.replace(item, aside)
+                if active_cas_runs(backup_root):
+                    os.replace(aside, item)
+                    log_info("CAS garbage collection stopped: a backup into the store started")
+                    return collected
+                aside.unlink()
+            except OSError as e:
+                log_warning(f"Could not collect CAS object {item}: {e}")
+                continue
+            collected["objects"] += 1
+            collected["bytes"] += st.st_size
+    return collected
+
+
+def prune_backups(backup_root: Path, source_name: str, policy: dict) -> dict:
+    """Apply `policy` to the backups of `source_name`, oldest removals first.
+
+    Space is accounted by inode and CAS object, so bytes still shared with a
+    kept snapshot (hardlinked incremental files, common CAS objects) or with
+    anything outside these backups are neither counted as freed nor chosen
+    to meet max_total_size. Deleting a snapshot only unlinks its own names,
+    so kept snapshots are never affected.
+    """
+    backup_root = Path(backup_root)
+    policy = normalize_policy(policy)
+    for leftover in backup_root.glob(_DELETING_PREFIX + "*"):
+        shutil.rmtree(leftover, ignore_errors=True)
+
+    snapshots = list_snapshots(backup_root, source_name)
+    result = {"kept": [], "removed": [], "failed": [], "freed_bytes": 0, "total_bytes": 0}
+    if not snapshots:
+        return result
+
+    kept = select_kept(snapshots, policy)
+    removed = [i for i in range(len(snapshots)) if i not in kept]
+    max_total = policy.get("max_total_size")
+
+    if removed or max_total:
+        blobs = [_snapshot_blobs(snapshot, backup_root) for snapshot in snapshots]
+        refs = {}
+        for snapshot_blobs in blobs:
+            for key, (_, _, names) in snapshot_blobs.items():
+                refs[key] = refs.get(key, 0) + names
+        # storage also held by something else stays allocated regardless
+        others = _cas_digests(backup_root, skip=[s["path"] for s in snapshots if s["kind"] == "cas"])
+        shared = {key for snapshot_blobs in blobs for key, (_, links, _) in snapshot_blobs.items()
+                  if links > refs[key] or (key[0] == "object" and key[1] in others)}
+        sizes = {key: blob[0] for snapshot_blobs in blobs for key, blob in snapshot_blobs.items()}
+        total = sum(sizes.values())
+
+        def release(i):
+            nonlocal total
+            freed = 0
+            for key, (_, _, names) in blobs[i].items():
+                refs[key] -= names
+                if refs[key] == 0:
+                    total -= sizes[key]
+                    if key not in shared:
+                        freed += sizes[key]
+            return freed
+
+        for i in removed:
+            result["freed_bytes"] += release(i)
+        # oldest first, and never the newest snapshot
+        for i in sorted(kept)[:-1]:
+            if not max_total or total <= max_total:
+                break
+            kept.remove(i)
+            removed.append(i)
+            result["freed_bytes"] += release(i)
+        result["total_bytes"] = total
+
+    for i in sorted(removed):
+        snapshot = snapshots[i]
+        try:
+            _delete_snapshot(snapshot)
+            result["removed"].append(snapshot["name"])
+            log_info(f"Pruned backup {snapshot['path']}")
+        except OSError as e:
+            print(f"Could not prune backup {snapshot['path']}: {e}")
+            log_warning(f"Could not prune backup {snapshot['path']}: {e}")
+            result["failed"].append(snapshot["name"])
+    result["kept"] = [snapshots[i]["name"] for i in sorted(kept)]
+
+    if any(snapshots[i]["kind"] == "cas" for i in removed):
+        result["cas_garbage"] = collect_cas_garbage(backup_root)
+    return result
+
+
+def _lower_priority():
+    # on Linux a thread id is a valid PRIO_PROCESS target and only that
+    # thread is affected; elsewhere the prune just runs at normal priority
+    if sys.platform.startswith("linux"):
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+        except OSError:
+            pass
+
+
+# backup root -> the prune thread working on it
+_pruning = {}
+_pruning_lock = threading.Lock()
+
+
+def start_pruning(backup_root: Path, source_name: str, policy: dict, on_done=None) -> threading.Thread:
+    """Run prune_backups on a low-priority background thread; on_done(result) when finished."""
+    key = str(Path(backup_root).absolute())
+
+    def work():
+        _lower_priority()
+        try:
+            result = prune_backups(backup_root, source_name, policy)
+            log_info(f"Retention for {source_name}: removed {len(result['removed'])}, "
+                     f"freed {result['freed_bytes']} bytes, kept {len(result['kept'])}")
+        except Exception as e:
+            log_warning(f"Pruning backups of {source_name} failed: {e}")
+            result = {"error": str(e)}
+        if on_done:
+            on_done(result)
+
+    wait_for_pruning(backup_root)
+    thread = threading.Thread(target=work, name="prune-backups")
+    with _pruning_lock:
+        _pruning[key] = thread
+    thread.start()
+    return thread
+
+
+def wait_for_pruning(backup_root: Path):
+    """Block until a prune of `backup_root` started by this process has finished."""
+    with _pruning_lock:
+        thread = _pruning.pop(str(Path(backup_root).absolute()), None)
+    if thread is not None:
+        thread.join()
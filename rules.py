@@ -0,0 +1,160 @@
+import fnmatch
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import time
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent
+# Optional user taxonomy, loaded by organizer.default_rules() when present
+RULES_FILE = BASE_DIR / "organizer_rules.json"
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+# Rule keys (all optional except "category"; a rule matches when every key
+# it has matches):
+#   extensions    [".jpg", ...]           case-insensitive suffixes
+#   name_glob     "invoice*"              fnmatch pattern, case-insensitive
+#   name_regex    "^IMG_\d+"              case-insensitive re.search on the name
+#   min_size / max_size                   bytes, inclusive
+#   min_age_days / max_age_days           age from mtime
+#   mime          ["image/*", "application/pdf"]   guessed from the name
+RULE_KEYS = {"category", "extensions", "name_glob", "name_regex", "min_size",
+             "max_size", "min_age_days", "max_age_days", "mime"}
+
+
+class _CompiledRule:
+    __slots__ = ("priority", "category", "extensions", "name_re", "min_size",
+                 "max_size", "min_age", "max_age", "mime_exact", "mime_prefixes")
+
+    def __init__(self, priority: int, rule: dict):
+        unknown = set(rule) - RULE_KEYS
+        if unknown:
+            raise ValueError(f"Unknown rule keys {sorted(unknown)} in rule {priority}")
+        if "category" not in rule:
+            raise ValueError(f"Rule {priority} has no category")
+
+        self.priority = priority
+        self.category = rule["category"]
+        self.extensions = frozenset(e.lower() for e in rule["extensions"]) if "extensions" in rule else None
+
+        patterns = []
+        if "name_glob" in rule:
+            patterns.append(fnmatch.translate(rule["name_glob"]))
+        if "name_regex" in rule:
+            patterns.append(f"(?=.*?(?:{rule['name_regex']}))")
+        # a glob and a regex on the same rule must both hold: lookahead + glob
+        self.name_re = re.compile("".join(reversed(patterns)), re.IGNORECASE) if patterns else None
+
+        self.min_size = rule.get("min_size")
+        self.max_size = rule.get("max_size")
+        self.min_age = rule["min_age_days"] * SECONDS_PER_DAY if "min_age_days" in rule else None
+        self.max_age = rule["max_age_days"] * SECONDS_PER_DAY if "max_age_days" in rule else None
+
+        self.mime_exact = None
+        self.mime_prefixes = None
+        if "mime" in rule:
+            mimes = rule["mime"] if isinstance(rule["mime"], list) else [rule["mime"]]
+            self.mime_exact = frozenset(m for m in mimes if not m.endswith("/*"))
+            self.mime_prefixes = tuple(m[:-1] for m in mimes if m.endswith("/*"))
+
+    @property
+    def extension_only(self) -> bool:
+        return self.extensions is not None and self.name_re is None and self.min_size is None \
+            and self.max_size is None and self.min_age is None and self.max_age is None \
+            and self.mime_exact is None
+
+    def matches(self, name: str, suffix: str, size, age) -> bool:
+        if self.extensions is not None and suffix not in self.extensions:
+            return False
+        if self.name_re is not None and not self.name_re.match(name):
+            return False
+        if self.min_size is not None and (size is None or size < self.min_size):
+            return False
+        if self.max_size is not None and (size is None or size > self.max_size):
+            return False
+        if self.min_age is not None and (age is None or age < self.min_age):
+            return False
+        if self.max_age is not None and (age is None or age > self.max_age):
+            return False
+        if self.mime_exact is not None:
+            mime = mimetypes.guess_type(name, strict=False)[0]
+            if mime is None:
+                return False
+            if mime not in self.mime_exact and not mime.startswith(self.mime_prefixes):
+                return False
+        return True
+
+
+class RuleSet:
+    """Ordered classification rules compiled for constant-time lookups.
+
+    Rules that only list extensions collapse into one suffix -> category
+    dict. The remaining rules are kept in priority order and are only
+    evaluated while they rank ahead of the dict hit, so the usual cost per
+    file is one dict lookup plus the (short) list of richer rules.
+    """
+
+    def __init__(self, rules: list, fallback: str = "Others"):
+        self.fallback = fallback
+        # identifies this rule set in the file index; categories cached under
+        # another key are recomputed
+        self.key = hashlib.sha1(json.dumps([rules, fallback], sort_keys=True).encode("utf-8")).hexdigest()[:16]
+        self.by_suffix = {}
+        self.complex_rules = []
+        for priority, rule in enumerate(rules):
+            compiled = _CompiledRule(priority, rule)
+            if compiled.extension_only:
+                for suffix in compiled.extensions:
+                    self.by_suffix.setdefault(suffix, (priority, compiled.category))
+            else:
+                self.complex_rules.append(compiled)
+
+    @property
+    def time_dependent(self) -> bool:
+        # age rules can change a file's category without the file changing
+        return any(rule.min_age is not None or rule.max_age is not None for rule in self.complex_rules)
+
+    @property
+    def categories(self) -> set:
+        found = {category for _, category in self.by_suffix.values()}
+        found.update(rule.category for rule in self.complex_rules)
+        found.add(self.fallback)
+        return found
+
+    def classify(self, name: str, size: int = None, mtime_ns: int = None, now: float = None) -> str:
+        suffix = os.path.splitext(name)[1].lower()
+        priority, category = self.by_suffix.get(suffix, (None, self.fallback))
+
+        if self.complex_rules:
+            age = None
+            if mtime_ns is not None:
+                age = (now if now is not None else time.time()) - mtime_ns / 1e9
+            for rule in self.complex_rules:
+                if priority is not None and rule.priority > priority:
+                    break
+                if rule.matches(name, suffix, size, age):
+                    return rule.category
+        return category
+
+
+def rules_from_categories(categories: dict) -> list:
+    return [{"category": category, "extensions": extensions}
+            for category, extensions in categories.items()]
+
+
+def load_rules(path: Path, default_categories: dict = None) -> RuleSet:
+    """Build a RuleSet from a JSON file.
+
+    {"fallback": "Others", "include_defaults": true, "rules": [...]}
+    Rules are tried in file order; with include_defaults the built-in
+    categories are appended after them.
+    """
+    with open(path, encoding="utf-8") as f:
+        config = json.load(f)
+    rules = list(config.get("rules", []))
+    if config.get("include_defaults", True) and default_categories:
+        rules.extend(rules_from_categories(default_categories))
+    return RuleSet(rules, fallback=config.get("fallback", "Others"))
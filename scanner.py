@@ -0,0 +1,104 @@
+import os
+from pathlib import Path
+from typing import Iterator, NamedTuple
+
+# Windows shell metadata files are never backed up, staged or organized
+IGNORED_NAMES = {"desktop.ini", "Thumbs.db"}
+
+KIND_FILE = "file"
+KIND_DIR = "dir"
+
+
+class ScanEntry(NamedTuple):
+    rel_path: str      # relative to the scanned root, os.sep separated
+    size: int
+    mtime_ns: int
+    inode: int
+    kind: str          # KIND_FILE or KIND_DIR
+
+    @property
+    def is_file(self) -> bool:
+        return self.kind == KIND_FILE
+
+    @property
+    def is_dir(self) -> bool:
+        return self.kind == KIND_DIR
+
+    @property
+    def is_top_level(self) -> bool:
+        return os.sep not in self.rel_path
+
+    @property
+    def depth(self) -> int:
+        return self.rel_path.count(os.sep)
+
+
+class ScanManifest:
+    """Result of a single walk over a folder, shared by every phase of a run."""
+
+    def __init__(self, root: Path, entries: list):
+        self.root = root
+        self.entries = entries
+        self.file_count = 0
+        self.total_bytes = 0
+        for entry in entries:
+            if entry.kind == KIND_FILE:
+                self.file_count += 1
+                self.total_bytes += entry.size
+
+    def files(self) -> Iterator[ScanEntry]:
+        return (e for e in self.entries if e.kind == KIND_FILE)
+
+    def dirs(self) -> Iterator[ScanEntry]:
+        return (e for e in self.entries if e.kind == KIND_DIR)
+
+    def top_level_files(self) -> Iterator[ScanEntry]:
+        return (e for e in self.files() if e.is_top_level)
+
+
+def iter_tree(root: Path, max_depth: int | None = None, prune_top: set = None) -> Iterator[ScanEntry]:
+    """Yield the entries below `root` lazily, one os.scandir batch at a time.
+
+    Memory stays proportional to the directory depth, not the tree size.
+    Directories are not followed through symlinks. `max_depth=0` lists only
+    the direct children of `root`. Top-level directories named in
+    `prune_top` are yielded but not descended into.
+    """
+    root = Path(root)
+    prefix_len = len(os.path.join(str(root), ""))
+    stack = [(str(root), 0)]
+
+    while stack:
+        current, depth = stack.pop()
+        try:
+            it = os.scandir(current)
+        except (PermissionError, FileNotFoundError) as e:
+            print(f"Skipped (cannot list): {current}: {e}")
+            continue
+
+        with it:
+            for item in it:
+                if item.name in IGNORED_NAMES:
+                    continue
+                try:
+                    if item.is_dir(follow_symlinks=False):
+                        st = item.stat(follow_symlinks=False)
+                        yield ScanEntry(item.path[prefix_len:], 0, st.st_mtime_ns, st.st_ino, KIND_DIR)
+                        if max_depth is not None and depth >= max_depth:
+                            continue
+                        if depth == 0 and prune_top and item.name in prune_top:
+                            continue
+                        stack.append((item.path, depth + 1))
+                    elif item.is_file():
+                        st = item.stat()
+                        yield ScanEntry(item.path[prefix_len:], st.st_size, st.st_mtime_ns, st.st_ino, KIND_FILE)
+                except OSError as e:
+                    print(f"Skipped (cannot stat): {item.path}: {e}")
+
+
+def scan_tree(root: Path, max_depth: int | None = None) -> ScanManifest:
+    """Walk `root` once with os.scandir and return its manifest."""
+    root = Path(root)
+    if not root.exists() or not root.is_dir():
+        raise ValueError("Scan root is not a valid folder.")
+    return ScanManifest(root, list(iter_tree(root, max_depth)))
@@ -0,0 +1,23 @@
+import os
+from cas_store import create_cas_backup, restore_cas_backup, store_paths
+from verify import verify_backup
+
+
+def test_cas_backup_round_trip_stores_each_content_once(tmp_path):
+    source = tmp_path / "src"
+    (source / "sub").mkdir(parents=True)
+    (source / "a.txt").write_bytes(b"same")
+    (source / "sub" / "b.txt").write_bytes(b"same")
+    (source / "c.txt").write_bytes(b"other")
+
+    manifest_path = create_cas_backup(source, tmp_path / "backup", 3)
+
+    objects_dir, _, tmp_dir = store_paths(tmp_path / "backup")
+    assert sum(len(os.listdir(d)) for d in objects_dir.iterdir()) == 2
+    assert not os.listdir(tmp_dir)
+    assert verify_backup(manifest_path)["ok"]
+
+    restore_cas_backup(manifest_path, tmp_path / "restored")
+    assert (tmp_path / "restored" / "sub" / "b.txt").read_bytes() == b"same"
+    assert (tmp_path / "restored" / "c.txt").read_bytes() == b"other"
+
@@ -0,0 +1,17 @@
+import json
+import pytest
+from cli import main, make_job, EXIT_USAGE
+
+
+def test_bad_dedup_action_is_a_value_error():
+    with pytest.raises(ValueError, match="dedup_action"):
+        make_job("src", "backup", {"dedup_action": "shred"})
+
+
+def test_bad_dedup_action_in_config_is_a_usage_error(tmp_path, capsys):
+    config = tmp_path / "jobs.json"
+    config.write_text(json.dumps({"jobs": [{"source": str(tmp_path), "backup": str(tmp_path / "b"),
+                                            "dedup_action": "shred"}]}))
+
+    assert main(["--config", str(config)]) == EXIT_USAGE
+    assert "dedup_action" in capsys.readouterr().err
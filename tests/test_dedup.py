@@ -0,0 +1,35 @@
+import os
+from dedup import consolidate_duplicates, DEDUP_DELETE, DEDUP_HARDLINK, PARTIAL_BLOCK
+from scanner import scan_tree
+
+
+def make_source(root):
+    (root / "sub").mkdir(parents=True)
+    big = b"x" * (3 * PARTIAL_BLOCK)
+    (root / "a.bin").write_bytes(big)
+    (root / "sub" / "a copy.bin").write_bytes(big)
+    # same size, same first and last blocks, different middle
+    (root / "sub" / "lookalike.bin").write_bytes(big[:PARTIAL_BLOCK] + b"y" * PARTIAL_BLOCK + big[-PARTIAL_BLOCK:])
+    (root / "small.txt").write_bytes(b"same")
+    (root / "sub" / "small.txt").write_bytes(b"same")
+
+
+def test_delete_keeps_the_shallowest_copy_only(tmp_path):
+    make_source(tmp_path)
+
+    summary = consolidate_duplicates(scan_tree(tmp_path), DEDUP_DELETE)
+
+    assert sorted(summary["removed"]) == [os.path.join("sub", "a copy.bin"), os.path.join("sub", "small.txt")]
+    assert (tmp_path / "a.bin").exists() and (tmp_path / "small.txt").exists()
+    assert (tmp_path / "sub" / "lookalike.bin").exists()
+
+
+def test_hardlink_keeps_every_name_with_its_content(tmp_path):
+    make_source(tmp_path)
+
+    summary = consolidate_duplicates(scan_tree(tmp_path), DEDUP_HARDLINK)
+
+    assert len(summary["linked"]) == 2
+    assert (tmp_path / "sub" / "a copy.bin").stat().st_ino == (tmp_path / "a.bin").stat().st_ino
+    assert (tmp_path / "sub" / "small.txt").read_bytes() == b"same"
+    assert (tmp_path / "sub" / "lookalike.bin").stat().st_ino != (tmp_path / "a.bin").stat().st_ino
@@ -0,0 +1,73 @@
+from file_index import FileIndex, index_path_for
+
+
+def test_save_forgets_rows_of_files_that_are_gone(tmp_path):
+    source = tmp_path / "src"
+    elsewhere = tmp_path / "backup" / "old_copy"
+    source.mkdir()
+    elsewhere.mkdir(parents=True)
+    kept, removed, outside = source / "kept.txt", source / "removed.txt", elsewhere / "copy.txt"
+    for path in (kept, removed, outside):
+        path.write_text(path.name)
+
+    index = FileIndex(index_path_for(tmp_path / "backup"))
+    for path in (kept, removed, outside):
+        index.digest_of(path)
+    index.save()
+    removed.unlink()
+    outside.unlink()
+    index.save(source, {str(kept)})
+    index.close()
+
+    index = FileIndex(index_path_for(tmp_path / "backup"))
+    assert set(index._rows) == {str(kept)}
+    index.close()
+
+
+def _stat(path):
+    st = path.stat()
+    return st.st_size, st.st_mtime_ns, st.st_ino
+
+
+def test_moved_file_keeps_its_category_and_its_row(tmp_path):
+    source = tmp_path / "src"
+    (source / "Documents").mkdir(parents=True)
+    before = source / "report.txt"
+    before.write_text("report")
+    index = FileIndex(index_path_for(tmp_path / "backup"))
+    assert index.category(before, *_stat(before), "rules", lambda: "Documents") == "Documents"
+
+    after = source / "Documents" / "report.txt"
+    before.rename(after)
+    assert index.category(after, *_stat(after), "rules", lambda: "Other") == "Documents"
+    index.save(source, {str(after)})
+    index.close()
+
+    index = FileIndex(index_path_for(tmp_path / "backup"))
+    assert set(index._rows) == {str(after)}
+    index.close()
+
+
+def test_renamed_file_is_classified_again(tmp_path):
+    before = tmp_path / "report.txt"
+    before.write_text("report")
+    index = FileIndex(index_path_for(tmp_path / "backup"))
+    index.category(before, *_stat(before), "rules", lambda: "Documents")
+    digest = index.digest_of(before)
+
+    after = tmp_path / "report.jpg"
+    before.rename(after)
+    assert index.digest_of(after) == digest
+    assert index.category(after, *_stat(after), "rules", lambda: "Images") == "Images"
+    index.close()
+
+
+def test_remember_digest_keeps_the_category(tmp_path):
+    path = tmp_path / "report.txt"
+    path.write_text("report")
+    index = FileIndex(index_path_for(tmp_path / "backup"))
+    index.category(path, *_stat(path), "rules", lambda: "Documents")
+    index.remember_digest(path, "abc")
+    assert index.category(path, *_stat(path), "rules", lambda: "Other") == "Documents"
+    assert index.cached_digest(path, *_stat(path)) == "abc"
+    index.close()
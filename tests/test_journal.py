@@ -0,0 +1,69 @@
+import os
+import pytest
+from apply import apply_plan
+from journal import journal_path_for, read_journal, resume_journal, undo_journal
+
+
+def make_tree(root, paths):
+    for rel_path in paths:
+        path = root / rel_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(rel_path)
+
+
+def list_tree(root):
+    return sorted(str(p.relative_to(root)) for p in root.rglob("*"))
+
+
+def test_undo_after_failed_apply_restores_tree(tmp_path):
+    original = tmp_path / "src"
+    make_tree(original, ["a.txt", os.path.join("sub", "b.txt"), "c.txt", "taken.txt"])
+    before = list_tree(original)
+    journal_path = journal_path_for(original, tmp_path / "backup")
+    plan = {
+        "a.txt": os.path.join("Documents", "a.txt"),
+        os.path.join("sub", "b.txt"): os.path.join("Documents", "sub", "b.txt"),
+        # the destination exists, so the apply fails here
+        "c.txt": "taken.txt",
+    }
+
+    with pytest.raises(FileExistsError):
+        apply_plan(original, plan, journal_path)
+    assert (original / "Documents" / "sub" / "b.txt").exists()
+
+    undo_journal(journal_path)
+
+    assert list_tree(original) == before
+    assert not journal_path.exists()
+
+
+def test_apply_journals_every_new_folder_level(tmp_path):
+    original = tmp_path / "src"
+    make_tree(original, ["a.txt"])
+    journal_path = journal_path_for(original, tmp_path / "backup")
+    plan = {"a.txt": os.path.join("Documents", "sub", "deep", "a.txt"), "missing.txt": "x.txt"}
+
+    with pytest.raises(FileNotFoundError):
+        apply_plan(original, plan, journal_path)
+
+    _, operations, _, _ = read_journal(journal_path)
+    assert [op["path"] for op in operations if op["op"] == "mkdir"] == [
+        "Documents", os.path.join("Documents", "sub"), os.path.join("Documents", "sub", "deep")]
+
+
+def test_resume_finishes_an_interrupted_apply(tmp_path):
+    original = tmp_path / "src"
+    make_tree(original, ["a.txt", "b.txt"])
+    journal_path = journal_path_for(original, tmp_path / "backup")
+    plan = {"a.txt": os.path.join("Documents", "a.txt"), "b.txt": os.path.join("Documents", "b.txt"),
+            "missing.txt": "x.txt"}
+    with pytest.raises(FileNotFoundError):
+        apply_plan(original, plan, journal_path)
+    # as after a crash: the failed rename is gone, its source reappears
+    (original / "missing.txt").write_text("late")
+
+    resume_journal(journal_path)
+
+    assert list_tree(original) == ["Documents", os.path.join("Documents", "a.txt"),
+                                   os.path.join("Documents", "b.txt"), "x.txt"]
+    assert not journal_path.exists()
@@ -0,0 +1,114 @@
+import os
+import pytest
+import backup
+import cancel_state
+import checkpoint
+from backup import create_backup, BACKUP_FULL
+from cancel_state import CancellationError, request_cancel, reset_cancel
+from checkpoint import checkpoint_path_for, load_checkpoint
+from verify import verify_backup
+
+
+@pytest.fixture
+def source(tmp_path, monkeypatch):
+    # records reach the checkpoint file right away
+    monkeypatch.setattr(checkpoint, "CHECKPOINT_MAX_PENDING", 1)
+    monkeypatch.chdir(tmp_path)
+    root = tmp_path / "src"
+    (root / "sub").mkdir(parents=True)
+    for i in range(40):
+        (root / "sub" / f"f{i:02d}.txt").write_text(f"file {i}\n" * 50)
+    yield root
+    reset_cancel()
+
+
+def count_copies(monkeypatch):
+    copied = []
+    real_copy = backup.copy_file
+
+    def copy_file(src, dst, *args, **kwargs):
+        copied.append(os.path.basename(dst))
+        return real_copy(src, dst, *args, **kwargs)
+
+    monkeypatch.setattr(backup, "copy_file", copy_file)
+    return copied
+
+
+def cancel_after(count):
+    def progress_cb(current, total, phase, stats=None):
+        if current >= count:
+            request_cancel()
+    return progress_cb
+
+
+def backups(backup_root):
+    return sorted(p.name for p in backup_root.iterdir())
+
+
+def tree(root):
+    return {str(p.relative_to(root)): p.read_bytes() for p in root.rglob("*") if p.is_file()}
+
+
+def test_cancelled_backup_resumes_from_relative_source_path(source, tmp_path, monkeypatch):
+    backup_root = tmp_path / "backup"
+    relative = source.relative_to(tmp_path)
+    with pytest.raises(CancellationError):
+        create_backup(relative, backup_root, 40, progress_cb=cancel_after(10), workers=1, mode=BACKUP_FULL)
+    reset_cancel()
+    (partial,) = [p for p in backup_root.iterdir() if p.is_dir()]
+    _, done = load_checkpoint(partial)
+    assert 10 <= len(done) < 40
+
+    copied = count_copies(monkeypatch)
+    folder = create_backup(relative, backup_root, 40, workers=1, mode=BACKUP_FULL)
+
+    assert len(copied) == 40 - len(done)
+    assert backups(backup_root) == [folder.name, folder.name + ".sha256"]
+    assert not checkpoint_path_for(folder).exists()
+    assert tree(folder) == tree(source)
+    assert verify_backup(folder)["ok"]
+
+
+def test_resume_recopies_changed_and_torn_files(source, tmp_path):
+    backup_root = tmp_path / "backup"
+    with pytest.raises(CancellationError):
+        create_backup(source, backup_root, 40, progress_cb=cancel_after(10), workers=1, mode=BACKUP_FULL)
+    reset_cancel()
+    (partial,) = [p for p in backup_root.iterdir() if p.is_dir()]
+    changed, torn = sorted(load_checkpoint(partial)[1])[:2]
+    with open(source / changed, "a") as f:
+        f.write("changed since\n")
+    os.truncate(partial / torn, 3)
+    os.remove(source / "sub" / "f39.txt")
+
+    folder = create_backup(source, backup_root, 39, workers=1, mode=BACKUP_FULL)
+
+    assert tree(folder) == tree(source)
+    assert verify_backup(folder)["ok"]
+    assert not cancel_state.cancel_requested
+
+
+def test_copy_that_cannot_be_fsynced_is_not_checkpointed(tmp_path, monkeypatch):
+    folder = tmp_path / "backup"
+    folder.mkdir()
+    (folder / "a.txt").write_text("a")
+    (folder / "b.txt").write_text("b")
+    real_fsync_path = checkpoint._fsync_path
+    opened = []
+
+    def fsync_path(path, flags=os.O_RDONLY):
+        opened.append((os.path.basename(path), flags))
+        if os.path.basename(path) == "b.txt":
+            raise OSError("flush failed")
+        real_fsync_path(path, flags)
+
+    monkeypatch.setattr(checkpoint, "_fsync_path", fsync_path)
+    cp = checkpoint.BackupCheckpoint(folder, {"source": "src"})
+    cp.record("a.txt", 1, 0)
+    cp.record("b.txt", 1, 0)
+    cp.close()
+
+    # files are flushed through a writable handle, which Windows requires
+    assert ("a.txt", os.O_RDWR) in opened
+    _, records = load_checkpoint(folder)
+    assert set(records) == {"a.txt"}
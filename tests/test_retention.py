@@ -0,0 +1,84 @@
+import os
+import retention
+from cas_store import create_cas_backup, store_paths, RUN_MARKER_SUFFIX
+from checkpoint import checkpoint_path_for
+from retention import collect_cas_garbage, list_snapshots, prune_backups
+
+
+def make_snapshots(backup_root, days):
+    """Daily folder backups of "src" sharing big.bin through hardlinks, like incremental runs."""
+    first = None
+    for day in days:
+        folder = backup_root / f"src_backup_2026-09-{day:02d}_10-00-00"
+        folder.mkdir(parents=True)
+        if first is None:
+            (folder / "big.bin").write_bytes(b"x" * 10000)
+            first = folder
+        else:
+            os.link(first / "big.bin", folder / "big.bin")
+        (folder / "day.txt").write_text(str(day))
+    return backup_root
+
+
+def names(backup_root):
+    return [snapshot["name"] for snapshot in list_snapshots(backup_root, "src")]
+
+
+def test_keep_last_and_weekly(tmp_path):
+    backup_root = make_snapshots(tmp_path, range(1, 11))
+
+    result = prune_backups(backup_root, "src", {"keep_last": 2, "keep_weekly": 2})
+
+    # 2026-09-06 is the last day of the week before the newest
+    assert names(backup_root) == ["src_backup_2026-09-06_10-00-00", "src_backup_2026-09-09_10-00-00",
+                                  "src_backup_2026-09-10_10-00-00"]
+    assert len(result["removed"]) == 7
+    # big.bin is still linked from the kept backups, so it was not freed
+    assert result["freed_bytes"] < 10000
+    assert (backup_root / "src_backup_2026-09-10_10-00-00" / "big.bin").read_bytes() == b"x" * 10000
+
+
+def test_max_total_size_never_removes_the_newest(tmp_path):
+    backup_root = make_snapshots(tmp_path, range(1, 4))
+
+    prune_backups(backup_root, "src", {"max_total_size": 1})
+
+    assert names(backup_root) == ["src_backup_2026-09-03_10-00-00"]
+    assert (backup_root / "src_backup_2026-09-03_10-00-00" / "big.bin").exists()
+
+
+def test_partial_backups_are_left_alone(tmp_path):
+    backup_root = make_snapshots(tmp_path, range(1, 3))
+    partial = tmp_path / "src_backup_2026-09-05_10-00-00"
+    partial.mkdir()
+    checkpoint_path_for(partial).write_text('{"op": "begin"}\n')
+
+    prune_backups(backup_root, "src", {"keep_last": 1})
+
+    assert names(backup_root) == ["src_backup_2026-09-02_10-00-00"]
+    assert partial.is_dir()
+
+
+def test_cas_garbage_is_collected_unless_a_backup_runs(tmp_path, monkeypatch):
+    monkeypatch.setattr(retention, "CAS_GC_GRACE", -60)
+    source = tmp_path / "src"
+    source.mkdir()
+    (source / "a.txt").write_text("first")
+    old_manifest = create_cas_backup(source, tmp_path / "backup", 1)
+    (source / "a.txt").write_text("second")
+    create_cas_backup(source, tmp_path / "backup", 1)
+    objects_dir, _, tmp_dir = store_paths(tmp_path / "backup")
+
+    def object_count():
+        return sum(len(os.listdir(d)) for d in objects_dir.iterdir())
+
+    old_manifest.unlink()
+    marker = tmp_dir / f"other{RUN_MARKER_SUFFIX}"
+    marker.touch()
+    assert collect_cas_garbage(tmp_path / "backup")["objects"] == 0
+    assert object_count() == 2
+
+    marker.unlink()
+    assert collect_cas_garbage(tmp_path / "backup")["objects"] == 1
+    assert object_count() == 1
+    assert not list(tmp_dir.iterdir())
@@ -0,0 +1,65 @@
+import os
+import shutil
+from apply import selective_rollback
+
+
+def make_tree(root, files):
+    for rel_path, data in files.items():
+        path = root / rel_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+        # same size and mtime for every file, only the content differs
+        os.utime(path, ns=(1_600_000_000_000_000_000, 1_600_000_000_000_000_000))
+
+
+def read_tree(root):
+    return {str(p.relative_to(root)): p.read_bytes() for p in sorted(root.rglob("*")) if p.is_file()}
+
+
+FILES = {"alpha.txt": b"AAAA", "beta.txt": b"BBBB", "gamma.txt": b"CCCC"}
+
+
+def organize(original):
+    (original / "Documents").mkdir()
+    for name in FILES:
+        os.rename(original / name, original / "Documents" / name)
+
+
+def test_rollback_keeps_contents_of_same_size_and_mtime_files(tmp_path):
+    original, backup = tmp_path / "src", tmp_path / "backup"
+    make_tree(original, FILES)
+    shutil.copytree(original, backup)
+    organize(original)
+
+    changes = selective_rollback(original, backup)
+
+    assert read_tree(original) == FILES
+    assert changes["renamed"] == 3
+
+
+def test_rollback_restores_renamed_files_from_backup(tmp_path):
+    original, backup = tmp_path / "src", tmp_path / "backup"
+    make_tree(original, FILES)
+    shutil.copytree(original, backup)
+    # the organizer renamed two of them; their new names prove nothing
+    os.rename(original / "alpha.txt", original / "beta (1).txt")
+    os.rename(original / "beta.txt", original / "alpha (1).txt")
+
+    changes = selective_rollback(original, backup)
+
+    assert read_tree(original) == FILES
+    assert changes["restored"] == 2
+    assert changes["deleted"] == 2
+
+
+def test_rollback_with_hash_matches_renamed_files_by_content(tmp_path):
+    original, backup = tmp_path / "src", tmp_path / "backup"
+    make_tree(original, FILES)
+    shutil.copytree(original, backup)
+    os.rename(original / "alpha.txt", original / "beta (1).txt")
+    os.rename(original / "beta.txt", original / "alpha (1).txt")
+
+    changes = selective_rollback(original, backup, verify_hash=True)
+
+    assert read_tree(original) == FILES
+    assert changes["renamed"] == 2
@@ -0,0 +1,64 @@
+import threading
+import watcher
+from watcher import FolderWatcher
+
+
+class FakeEvents:
+    """Hands out scripted batches of names, then stops the watcher."""
+
+    def __init__(self, batches, stop_event):
+        self.batches = list(batches)
+        self.stop_event = stop_event
+
+    def read(self, timeout):
+        if not self.batches:
+            self.stop_event.set()
+            return []
+        return self.batches.pop(0)
+
+    def close(self):
+        pass
+
+
+def test_file_is_handled_once_it_settles(tmp_path):
+    source = tmp_path / "src"
+    source.mkdir()
+    photo = source / "photo.jpg"
+    photo.write_bytes(b"jpeg")
+    w = FolderWatcher(source, tmp_path / "backup", debounce=2.0)
+
+    w.notice("photo.jpg", 0.0)
+    w.process_due(1.0)
+    assert photo.exists()
+
+    # still growing when the debounce ran out: wait another round
+    photo.write_bytes(b"jpeg, more of it")
+    w.process_due(2.5)
+    assert photo.exists()
+
+    w.process_due(5.0)
+    assert not photo.exists()
+    assert (source / "Images" / "photo.jpg").read_bytes() == b"jpeg, more of it"
+    assert w.stats == {"organized": 1, "failed": 0}
+
+
+def test_run_routes_files_and_skips_folders(tmp_path, monkeypatch):
+    source = tmp_path / "src"
+    (source / "Images").mkdir(parents=True)
+    (source / "projects").mkdir()
+    (source / "notes.txt").write_text("notes")
+    (source / "movie.mp4.part").write_bytes(b"partial")
+    stop = threading.Event()
+    # an overflow rescan or a poll may report anything in the folder
+    events = FakeEvents([["notes.txt", "Images", "projects", "movie.mp4.part"]], stop)
+    monkeypatch.setattr(watcher, "open_event_source", lambda *args: events)
+
+    stats = FolderWatcher(source, tmp_path / "backup", debounce=0.0).run(stop)
+
+    assert stats == {"organized": 1, "failed": 0}
+    assert (source / "Documents" / "notes.txt").exists()
+    assert (source / "Images").is_dir() and not (source / "Others").exists()
+    assert (source / "projects").is_dir()
+    assert (source / "movie.mp4.part").exists()
+    backups = list((tmp_path / "backup").iterdir())
+    assert len(backups) == 1 and [p.name for p in backups[0].iterdir()] == ["notes.txt"]
@@ -4,9 +4,26 @@ from cancel_state import request_cancel, reset_cancel
 import threading
 import queue
 from main import run_backend
+from organizer import ORGANIZE_STAGING, ORGANIZE_PLAN
+from progress import ProgressChannel, format_bytes, format_duration
+from logger import LOG_FILE, log_info, log_warning, log_error
+from collections import deque
 import sys
 from pathlib import Path
 
+# UI refresh cadence; progress is coalesced so this caps repaints per second
+UI_REFRESH_MS = 100
+# bound the work one tick may do even if the backend floods the queue
+UI_MAX_MESSAGES_PER_TICK = 500
+
+# The log pane keeps at most this many lines; the log file has the rest.
+# Trimming waits for LOG_TRIM_BATCH extra lines so it is one delete, not one per line.
+LOG_VIEW_MAX_LINES = 1000
+LOG_TRIM_BATCH = 200
+LOG_LEVELS = ("INFO", "WARNING", "ERROR")
+LOG_FILTERS = {"All": "INFO", "Warnings": "WARNING", "Errors": "ERROR"}
+_LOG_WRITERS = {"INFO": log_info, "WARNING": log_warning, "ERROR": log_error}
+
 class SmartFileManagerUI:
     def __init__(self, root):
         self.root = root
@@ -15,6 +32,10 @@ class SmartFileManagerUI:
         self.root.resizable(False, False)
         self.is_dark = True
         self.ui_queue = queue.Queue()
+        self.progress_channel = ProgressChannel()
+        # set once done/cancelled/failed is shown; late progress is dropped
+        self.run_finished = False
+        self.log_buffer = deque(maxlen=LOG_VIEW_MAX_LINES)
         
         
         # Icons (load safely for both normal runs and packaged .exe)
@@ -170,6 +191,16 @@ class SmartFileManagerUI:
             style="Dark.TButton"
         )
         self.reset_btn.pack(side="left", padx=10)
+        
+        # staging stays the default; renaming the source in place is opt-in
+        self.in_place = tk.BooleanVar(value=False)
+        self.in_place_check = ttk.Checkbutton(
+            control_frame,
+            text="Organize in place (journaled)",
+            variable=self.in_place,
+            style="Dark.TCheckbutton"
+        )
+        self.in_place_check.pack(side="left", padx=10)
     
     def update_controls_state(self):
         src = self.source_path.get()
@@ -185,11 +216,14 @@ class SmartFileManagerUI:
             
     def on_run(self):
         reset_cancel()
+        self.run_finished = False
+        self.progress_channel.take()
         print("Run clicked")
         self.log("Run Started")
         self.run_btn.config(state="disabled")
         self.cancel_btn.config(state="normal")
         self.reset_btn.config(state="disabled")
+        self.in_place_check.config(state="disabled")
         self.status_text.set("Running...")
         
         thread = threading.Thread(
@@ -202,7 +236,7 @@ class SmartFileManagerUI:
     def on_cancel(self):
         request_cancel()
         print("Cancel clicked")
-        self.log("Cancel requested by the User")
+        self.log("Cancel requested by the User", "WARNING")
         self.cancel_btn.config(state="disabled")
         self.status_text.set("Cancelling...")
         
@@ -244,8 +278,30 @@ class SmartFileManagerUI:
         log_frame = ttk.Frame(self.root, padding=(20,10), style="Dark.TFrame")
         log_frame.pack(fill="both", expand=True)
         
-        log_label = ttk.Label(log_frame, text="Logs", style="Dark.TLabel")
-        log_label.pack(anchor="w")
+        log_header = ttk.Frame(log_frame, style="Dark.TFrame")
+        log_header.pack(fill="x")
+        
+        log_label = ttk.Label(log_header, text="Logs", style="Dark.TLabel")
+        log_label.pack(side="left")
+        
+        self.log_filter = tk.StringVar(value="All")
+        filter_box = ttk.Combobox(
+            log_header,
+            textvariable=self.log_filter,
+            values=list(LOG_FILTERS),
+            state="readonly",
+            width=10
+        )
+        filter_box.pack(side="right")
+        filter_box.bind("<<ComboboxSelected>>", lambda _event: self.refresh_log_view())
+        
+        history_label = ttk.Label(
+            log_header,
+            text=f"Full history: {LOG_FILE.name}",
+            font=("Segoe UI", 8),
+            style="Dark.TLabel"
+        )
+        history_label.pack(side="right", padx=10)
         
         self.log_text = tk.Text(
             log_frame,
@@ -256,9 +312,39 @@ class SmartFileManagerUI:
         )
         self.log_text.pack(fill="both", expand = True, pady = (5,0))
 
-    def log(self, message):
+    def log(self, message, level="INFO"):
+        self.log_lines([(level, message)])
+    
+    def _log_visible(self, level):
+        minimum = LOG_FILTERS.get(self.log_filter.get(), "INFO")
+        return LOG_LEVELS.index(level) >= LOG_LEVELS.index(minimum)
+    
+    def log_lines(self, entries):
+        """Show (level, message) entries; the pane is a window, the log file keeps everything."""
+        for level, message in entries:
+            _LOG_WRITERS[level](f"UI: {message}")
+        self.log_buffer.extend(entries)
+        
+        visible = [message for level, message in entries if self._log_visible(level)]
+        if not visible:
+            return
+        
         self.log_text.config(state="normal")
-        self.log_text.insert("end", message + "\n")
+        self.log_text.insert("end", "\n".join(visible) + "\n")
+        
+        lines = int(self.log_text.index("end-1c").split(".")[0]) - 1
+        if lines > LOG_VIEW_MAX_LINES + LOG_TRIM_BATCH:
+            self.log_text.delete("1.0", f"{lines - LOG_VIEW_MAX_LINES + 1}.0")
+        
+        self.log_text.see("end")
+        self.log_text.config(state="disabled")
+    
+    def refresh_log_view(self):
+        visible = [message for level, message in self.log_buffer if self._log_visible(level)]
+        self.log_text.config(state="normal")
+        self.log_text.delete("1.0", "end")
+        if visible:
+            self.log_text.insert("end", "\n".join(visible) + "\n")
         self.log_text.see("end")
         self.log_text.config(state="disabled")
         
@@ -270,7 +356,8 @@ class SmartFileManagerUI:
             result = run_backend(
                 self.source_path.get(),
                 self.backup_path.get(),
-                self.report_progress
+                self.report_progress,
+                organize_mode=ORGANIZE_PLAN if self.in_place.get() else ORGANIZE_STAGING
                 )
         
             if result == "SUCCESS":
@@ -283,6 +370,10 @@ class SmartFileManagerUI:
                 self.ui_queue.put(("failed", "Cannot stage the folders"))
             elif result == "FAILED":
                 self.ui_queue.put(("failed", "Apply failed on source folder"))
+            elif result == "VERIFY_FAILED":
+                self.ui_queue.put(("failed", "Backup verification failed; source left untouched"))
+            elif result == "INSUFFICIENT_SPACE":
+                self.ui_queue.put(("failed", "Not enough free space for the backup; nothing was copied"))
             else:
                 self.ui_queue.put(("done", "Completed"))
         
@@ -290,52 +381,51 @@ class SmartFileManagerUI:
             self.ui_queue.put(("error", str(e)))
         
     def process_ui_queue(self):
+        # progress first: it is always older than whatever the backend
+        # queued after it (done/failed/apply_start). Once the run has ended
+        # nothing may overwrite its final status, so stragglers are dropped.
+        for payload in self.progress_channel.take():
+            if not self.run_finished:
+                self._show_progress(payload)
+        
+        pending_logs = []
         try:
-            while True:
+            for _ in range(UI_MAX_MESSAGES_PER_TICK):
                 msg_type, payload = self.ui_queue.get_nowait()
             
                 if msg_type == "log":
-                    self.log(payload)
+                    pending_logs.append(("INFO", payload))
                     
                 elif msg_type == "status":
                     self.status_text.set(payload)
                 
                 elif msg_type == "done":
-                    self.log(payload)
+                    pending_logs.append(("INFO", payload))
                     self.status_text.set("Completed")
+                    self.run_finished = True
                     self.run_btn.config(state="disabled")
                     self.cancel_btn.config(state="disabled")
                     self.reset_btn.config(state="normal")
+                    self.in_place_check.config(state="normal")
                     
                     
                 elif msg_type == "cancelled":
-                    self.log(payload)
+                    pending_logs.append(("WARNING", payload))
                     self.status_text.set("Cancelled")
+                    self.run_finished = True
                     self.run_btn.config(state="disabled")
                     self.cancel_btn.config(state="disabled")
                     self.reset_btn.config(state="normal")
+                    self.in_place_check.config(state="normal")
                     
                 elif msg_type == "failed" or msg_type == "error":
-                    self.log(payload)
+                    pending_logs.append(("ERROR", payload))
                     self.status_text.set("Failed")
+                    self.run_finished = True
                     self.run_btn.config(state="disabled")
                     self.cancel_btn.config(state="disabled")
                     self.reset_btn.config(state="normal")
-                    
-                elif msg_type == "progress":
-                    current, total, phase = payload
-                    current = int(current)
-                    total = int(total)
-                    
-                    if total == 0:
-                        self.status_text.set(f"{phase}...")
-                        continue
-                    
-                    percent = (current/ total) * 100
-                    if int(self.progress_bar["maximum"]) != total:
-                        self.progress_bar["maximum"] = total
-                    self.progress_bar["value"] = current
-                    self.status_text.set(f"{phase}: {percent:.1f}% ({current}/{total})")
+                    self.in_place_check.config(state="normal")
                     
                 elif msg_type == "apply_start":
                     self.cancel_btn.config(state="disabled")
@@ -346,13 +436,52 @@ class SmartFileManagerUI:
         except queue.Empty:
             pass
         
-        self.root.after(100, self.process_ui_queue)
+        # one Text.insert per tick, however many lines arrived
+        if pending_logs:
+            self.log_lines(pending_logs)
+        
+        self.root.after(UI_REFRESH_MS, self.process_ui_queue)
+    
+    def _show_progress(self, payload):
+        current, total, phase, stats = payload
+        current = int(current)
+        total = int(total)
+        
+        if total == 0:
+            self._set_status(f"{phase}...")
+            return
+        
+        if int(self.progress_bar["maximum"]) != 100:
+            self.progress_bar["maximum"] = 100
+        
+        # bytes when the backend sends them: one huge file
+        # followed by many tiny ones would make a file count lie
+        if stats is not None and stats.bytes_total > 0:
+            percent = (stats.bytes_done / stats.bytes_total) * 100
+            text = (f"{phase}: {percent:.1f}% ({current}/{total} files, "
+                    f"{format_bytes(stats.bytes_done)} of {format_bytes(stats.bytes_total)})")
+            if stats.smoothed_rate > 0:
+                text += f" · {format_bytes(stats.smoothed_rate)}/s"
+            if stats.eta is not None:
+                text += f" · ETA {format_duration(stats.eta)}"
+        else:
+            percent = (current/ total) * 100
+            text = f"{phase}: {percent:.1f}% ({current}/{total})"
+        
+        self.progress_bar["value"] = percent
+        self._set_status(text)
+    
+    def _set_status(self, text):
+        # skip no-op writes so Tk does not re-layout the label
+        if self.status_text.get() != text:
+            self.status_text.set(text)
         
-    def report_progress(self, current, total, phase):
+    def report_progress(self, current, total, phase, stats=None):
         if phase == "APPLY_START":
             self.ui_queue.put(("apply_start", None))
         else:
-            self.ui_queue.put(("progress", (current, total, phase)))
+            # coalesced: only the latest value per phase reaches the UI
+            self.progress_channel.publish(phase, (current, total, phase, stats))
             
     def setup_style(self):
         self.style = ttk.Style()
@@ -374,6 +503,7 @@ class SmartFileManagerUI:
 
         self.style.configure("Light.TFrame", background=light_bg)
         self.style.configure("Light.TLabel", background=light_bg, foreground=light_fg)
+        self.style.configure("Light.TCheckbutton", background=light_bg, foreground=light_fg)
         self.style.configure(
             "Light.TButton",
             padding=(14, 8),
@@ -422,6 +552,7 @@ class SmartFileManagerUI:
 
         self.style.configure("Dark.TFrame", background=dark_bg)
         self.style.configure("Dark.TLabel", background=dark_bg, foreground=dark_fg)
+        self.style.configure("Dark.TCheckbutton", background=dark_bg, foreground=dark_fg)
         self.style.configure(
             "Dark.TButton",
             padding=(14, 8),
@@ -487,6 +618,8 @@ class SmartFileManagerUI:
                 widget.configure(style=f"{theme}.TButton")
             elif isinstance(widget, ttk.Entry):
                 widget.configure(style=f"{theme}.TEntry")
+            elif isinstance(widget, ttk.Checkbutton):
+                widget.configure(style=f"{theme}.TCheckbutton")
             elif isinstance(widget, ttk.Progressbar):
                 widget.configure(style=f"{theme}.Horizontal.TProgressbar")
         except tk.TclError:
@@ -0,0 +1,117 @@
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from hashing import file_digest, DEFAULT_HASH
+from copy_engine import DEFAULT_COPY_WORKERS
+from cas_store import is_cas_manifest, load_cas_manifest, object_path
+from archive_backup import is_archive_backup, load_archive_index, ArchiveReader
+
+# Folder backups get a sidecar next to them, <backup folder>.sha256, in
+# sha256sum's format ("<hex> *<path>"), so `sha256sum -c` run from inside
+# the backup folder checks it too. CAS manifests and archive indexes
+# already carry a digest per file.
+CHECKSUM_SUFFIX = ".sha256"
+
+
+def checksum_path_for(backup_folder: Path) -> Path:
+    return backup_folder.with_name(backup_folder.name + CHECKSUM_SUFFIX)
+
+
+def write_checksums(backup_folder: Path, checksums: dict):
+    path = checksum_path_for(backup_folder)
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        for rel_path in sorted(checksums):
+            f.write(f"{checksums[rel_path]} *{rel_path.replace(os.sep, '/')}\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return path
+
+
+def load_checksums(backup_folder: Path):
+    """{relative path: digest} from a folder backup's sidecar, or None without one."""
+    path = checksum_path_for(backup_folder)
+    if not path.is_file():
+        return None
+    checksums = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            digest, _, name = line.rstrip("\n").partition(" ")
+            checksums[name.lstrip("*").replace("/", os.sep)] = digest
+    return checksums
+
+
+def _check_files(root: Path, expected: dict, algorithm: str):
+    def check(item):
+        rel_path, digest = item
+        try:
+            return rel_path, file_digest(root / rel_path, algorithm) == digest
+        except FileNotFoundError:
+            return rel_path, None
+    return check
+
+
+def _check_archive_slice(archive: Path, items: list, algorithm: str) -> list:
+    # one reader per slice: neighbouring files share decompressed blocks
+    results = []
+    with ArchiveReader(archive) as reader:
+        for item in items:
+            h = hashlib.new(algorithm)
+            for piece in reader.iter_bytes(item["offset"], item["size"]):
+                h.update(piece)
+            results.append((item["path"], h.hexdigest() == item["digest"]))
+    return results
+
+
+def verify_backup(backup: Path, workers: int = None) -> dict:
+    """Re-hash every file of `backup` on a thread pool and compare with its recorded digests.
+
+    Works for folder backups (needs the .sha256 sidecar), CAS manifests and
+    archives. Returns {"backup", "checked", "mismatched", "missing", "ok"}.
+    """
+    backup = Path(backup)
+    workers = workers or DEFAULT_COPY_WORKERS
+    mismatched = []
+    missing = []
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        if is_cas_manifest(backup):
+            data = load_cas_manifest(backup)
+            objects_dir = backup.parent.parent / "objects"
+            # each object is checked once, however many files share it
+            expected = {os.path.relpath(object_path(objects_dir, item["digest"]), objects_dir): item["digest"]
+                        for item in data["files"]}
+            results = pool.map(_check_files(objects_dir, expected, data["algorithm"]), expected.items())
+        elif is_archive_backup(backup):
+            index = load_archive_index(backup)
+            files = index["files"]
+            step = max(1, len(files) // (workers * 4) + 1)
+            slices = [files[i:i + step] for i in range(0, len(files), step)]
+            results = [result
+                       for chunk in pool.map(lambda items: _check_archive_slice(backup, items, index["algorithm"]), slices)
+                       for result in chunk]
+        elif backup.is_dir():
+            expected = load_checksums(backup)
+            if expected is None:
+                raise FileNotFoundError(f"No checksum file for {backup}: {checksum_path_for(backup)}")
+            results = pool.map(_check_files(backup, expected, DEFAULT_HASH), expected.items())
+        else:
+            raise FileNotFoundError(f"Backup not found: {backup}")
+
+        checked = 0
+        for rel_path, ok in results:
+            checked += 1
+            if ok is None:
+                missing.append(rel_path)
+            elif not ok:
+                mismatched.append(rel_path)
+
+    return {
+        "backup": str(backup),
+        "checked": checked,
+        "mismatched": sorted(mismatched),
+        "missing": sorted(missing),
+        "ok": not mismatched and not missing,
+    }
@@ -0,0 +1,269 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import stat
+import struct
+import sys
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+import cancel_state
+from copy_engine import copy_file
+from logger import log_info, log_warning, log_error
+from organizer import NameAllocator, default_rules, is_this_file
+from rules import RuleSet
+from scanner import IGNORED_NAMES
+
+# A file is handled once it has had no events for this long and its
+# size/mtime did not change in between
+WATCH_DEBOUNCE = 2.0
+WATCH_POLL_INTERVAL = 2.0
+# Browsers and editors write under these names, then rename into place
+PARTIAL_SUFFIXES = (".part", ".crdownload", ".download", ".partial", ".tmp", ".swp")
+
+# <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+_INOTIFY_EVENT = struct.Struct("iIII")   # wd, mask, cookie, len; then the name
+
+
+def regular_files(folder: Path) -> list:
+    """Names of the regular files directly in `folder` (no folders, no symlinks)."""
+    names = []
+    with os.scandir(folder) as it:
+        for item in it:
+            try:
+                if item.is_file(follow_symlinks=False):
+                    names.append(item.name)
+            except OSError:
+                pass
+    return names
+
+
+class InotifyEvents:
+    """Names of files finished (closed after writing or moved in) directly in `folder`."""
+
+    def __init__(self, folder: Path):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or None, use_errno=True)
+        self.folder = folder
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        wd = libc.inotify_add_watch(self.fd, os.fsencode(str(folder)),
+                                    IN_CLOSE_WRITE | IN_MOVED_TO | IN_DELETE_SELF | IN_MOVE_SELF)
+        if wd < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, f"inotify_add_watch failed for {folder}")
+
+    def read(self, timeout: float) -> list:
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        names = []
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = _INOTIFY_EVENT.unpack_from(data, offset)
+            offset += _INOTIFY_EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                # the kernel dropped events: fall back to one listing
+                print("Watch event queue overflowed, rescanning the folder")
+                log_warning(f"inotify queue overflow on {self.folder}, rescanning")
+                names.extend(regular_files(self.folder))
+            elif mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                raise FileNotFoundError(f"Watched folder is gone: {self.folder}")
+            elif name and not mask & IN_ISDIR:
+                names.append(name)
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingEvents:
+    """Fallback for systems without inotify: diff one listing per interval."""
+
+    def __init__(self, folder: Path, interval: float = WATCH_POLL_INTERVAL):
+        self.folder = folder
+        self.interval = interval
+        self._next_poll = 0.0
+        self._seen = self._snapshot()
+
+    def _snapshot(self) -> dict:
+        seen = {}
+        with os.scandir(self.folder) as it:
+            for item in it:
+                try:
+                    if item.is_file(follow_symlinks=False):
+                        st = item.stat(follow_symlinks=False)
+                        seen[item.name] = (st.st_size, st.st_mtime_ns)
+                except OSError:
+                    pass
+        return seen
+
+    def read(self, timeout: float) -> list:
+        wait = self._next_poll - time.monotonic()
+        if wait > 0:
+            time.sleep(min(wait, timeout))
+            if time.monotonic() < self._next_poll:
+                return []
+        self._next_poll = time.monotonic() + self.interval
+        current = self._snapshot()
+        changed = [name for name, signature in current.items() if self._seen.get(name) != signature]
+        self._seen = current
+        return changed
+
+    def close(self):
+        pass
+
+
+def open_event_source(folder: Path, use_inotify: bool = None, poll_interval: float = WATCH_POLL_INTERVAL):
+    if use_inotify is not False and sys.platform.startswith("linux"):
+        try:
+            return InotifyEvents(folder)
+        except (OSError, AttributeError) as e:
+            if use_inotify:
+                raise
+            print(f"inotify unavailable ({e}), polling every {poll_interval}s")
+            log_warning(f"inotify unavailable for {folder}: {e}; falling back to polling")
+    return PollingEvents(folder, poll_interval)
+
+
+def is_partial_name(name: str) -> bool:
+    return name.startswith((".", "~$")) or name.lower().endswith(PARTIAL_SUFFIXES)
+
+
+class FolderWatcher:
+    """Back up and file away new top-level files of `source` as they arrive.
+
+    Each settled file is copied into one `<name>_watch_<timestamp>` folder
+    under `backup_root`, then renamed into its category folder. The cost
+    per file is a stat, a copy and a rename; the tree is never rescanned.
+    """
+
+    def __init__(self, source: Path, backup_root: Path, rules: RuleSet = None,
+                 debounce: float = WATCH_DEBOUNCE, use_inotify: bool = None,
+                 poll_interval: float = WATCH_POLL_INTERVAL):
+        self.source = Path(source)
+        self.backup_root = Path(backup_root)
+        if not self.source.is_dir():
+            raise ValueError("Source folder is not valid.")
+        self.rules = rules if rules is not None else default_rules()
+        # the category folders live in `source` too; never file them away
+        self.categories = self.rules.categories
+        self.debounce = debounce
+        self.use_inotify = use_inotify
+        self.poll_interval = poll_interval
+        self.pending = {}            # name -> (deadline, (size, mtime_ns))
+        self.names = NameAllocator()
+        self.backup_names = NameAllocator()
+        self.backup_folder = None
+        self.stats = {"organized": 0, "failed": 0}
+
+    def notice(self, name: str, now: float):
+        if name in IGNORED_NAMES or name in self.categories or is_partial_name(name):
+            return
+        try:
+            st = os.stat(self.source / name, follow_symlinks=False)
+        except FileNotFoundError:
+            self.pending.pop(name, None)
+            return
+        if not stat.S_ISREG(st.st_mode):
+            return
+        self.pending[name] = (now + self.debounce, (st.st_size, st.st_mtime_ns))
+
+    def _backup(self, src: Path, size: int):
+        if self.backup_folder is None:
+            timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+            self.backup_root.mkdir(parents=True, exist_ok=True)
+            self.backup_folder = self.backup_root / self.backup_names.allocate(
+                self.backup_root, f"{self.source.name}_watch_{timestamp}")
+            self.backup_folder.mkdir()
+        copy_file(src, self.backup_folder / self.backup_names.allocate(self.backup_folder, src.name), size=size)
+
+    def handle(self, name: str, signature: tuple) -> Path:
+        """Back up one settled file and move it into its category; returns the new path."""
+        src = self.source / name
+        if is_this_file(self.source, name):
+            return None
+        size, mtime_ns = signature
+        self._backup(src, size)
+
+        category_dir = self.source / self.rules.classify(name, size, mtime_ns)
+        category_dir.mkdir(exist_ok=True)
+        # the allocator lists the category once; re-check in case something
+        # else put a file there since
+        while True:
+            dst = category_dir / self.names.allocate(category_dir, name)
+            if not os.path.lexists(dst):
+                break
+        os.rename(src, dst)
+        return dst
+
+    def process_due(self, now: float):
+        for name, (deadline, signature) in list(self.pending.items()):
+            if deadline > now:
+                continue
+            try:
+                st = os.stat(self.source / name, follow_symlinks=False)
+            except FileNotFoundError:
+                del self.pending[name]
+                continue
+            current = (st.st_size, st.st_mtime_ns)
+            if current != signature:
+                # still being written
+                self.pending[name] = (now + self.debounce, current)
+                continue
+            del self.pending[name]
+            try:
+                dst = self.handle(name, signature)
+            except Exception as e:
+                self.stats["failed"] += 1
+                print(f"Could not organize {name}: {e}")
+                log_error(f"Watch: could not organize {self.source / name}: {e}")
+                continue
+            if dst is not None:
+                self.stats["organized"] += 1
+                print(f"Organized {name} -> {dst.parent.name}/{dst.name}")
+                log_info(f"Watch: {self.source / name} -> {dst}")
+
+    def run(self, stop_event: threading.Event = None) -> dict:
+        """Watch until `stop_event` is set or a cancel is requested; returns the counts."""
+        events = open_event_source(self.source, self.use_inotify, self.poll_interval)
+        log_info(f"Watching {self.source} ({type(events).__name__})")
+        try:
+            while not (stop_event is not None and stop_event.is_set()) \
+                    and not cancel_state.cancel_requested:
+                now = time.monotonic()
+                timeout = 1.0
+                if self.pending:
+                    nearest = min(deadline for deadline, _ in self.pending.values())
+                    timeout = max(0.0, min(timeout, nearest - now))
+                for name in events.read(timeout):
+                    self.notice(name, time.monotonic())
+                self.process_due(time.monotonic())
+        finally:
+            events.close()
+            log_info(f"Stopped watching {self.source}: {self.stats}")
+        return dict(self.stats)
+
+
+def watch_folder(source, backup_root, rules: RuleSet = None, stop_event: threading.Event = None,
+                 **options) -> dict:
+    return FolderWatcher(Path(source), Path(backup_root), rules, **options).run(stop_event)